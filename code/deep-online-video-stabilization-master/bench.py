@@ -0,0 +1,320 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+from frame_source import open_source
+from frame_store import RawFrameWriter
+from frame_sink import open_sink, sink_ext, SINKS
+from config import rand_H_max, rand_H_min, rand_H_change_rate, grid_h, grid_w
+
+# Deploy benchmark on synthetic shaky videos.
+#   python bench.py make --root bench_data                      # jittered textured videos, per resolution
+#   python bench.py run --root bench_data --out new.json [--frozen-graph model.pb | --model-dir ... --model-name ...]
+#   python bench.py compare base.json new.json                  # exit code 1 on regressions
+# Without a model the network is replaced by an oracle that returns the inverse of the applied
+# jitter, which measures everything around sess.run (decode, input assembly, mesh maps, remap,
+# encode) and allows any grid size. With a model every case runs deploy_bundle.py on the data.
+
+DEPLOY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deploy_bundle.py')
+SUMMARY = re.compile(r'(\d+) videos, (\d+) frames in ([\d.]+)s')
+
+def rand_H(rng, last_H=None, shake=0.1):
+    # get_rand_H of get_data_mini_after.py in NumPy, with the range around identity scaled by shake
+    identity = np.eye(3)
+    H = identity + shake * (rng.uniform(rand_H_min, rand_H_max) - identity)
+    H[2, 2] = 1
+    if last_H is None:
+        return H
+    return H * rand_H_change_rate + last_H * (1 - rand_H_change_rate)
+
+def scale_mat(w, h):
+    # normalized [-1, 1] -> pixels, as in train_bundle_nobm.cvt_theta_mat
+    return np.array([[w / 2., 0, w / 2.], [0, h / 2., h / 2.], [0, 0, 1]])
+
+def texture(w, h, rng):
+    # smooth multi-scale noise with some edges, so that blur and interpolation errors show
+    img = np.zeros([h, w, 3], dtype=np.float32)
+    for scale in [4, 16, 64]:
+        small = rng.rand(max(h // scale, 2), max(w // scale, 2), 3).astype(np.float32)
+        img += cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC) / 3
+    for i in range(20):
+        p = (rng.randint(w), rng.randint(h))
+        cv2.rectangle(img, p, (p[0] + rng.randint(w // 8), p[1] + rng.randint(h // 8)), tuple(rng.rand(3).tolist()), 2)
+    return np.clip(img * 255, 0, 255).astype(np.uint8)
+
+class ImageDirWriter(object):
+    # a directory of image-%04d.jpg frames, as the training frames
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        if not os.path.exists(path): os.makedirs(path)
+
+    def write(self, frame):
+        self.count += 1
+        cv2.imwrite(os.path.join(self.path, 'image-{:04d}.jpg'.format(self.count)), frame)
+
+    def release(self):
+        pass
+
+def open_writer(path, fmt, fps, size):
+    if fmt == 'jpg':
+        return ImageDirWriter(path)
+    if fmt == 'raw':
+        return RawFrameWriter(path)
+    return cv2.VideoWriter(path, cv2.VideoWriter_fourcc('M','J','P','G'), fps, size)
+
+def make_video(root, name, w, h, frames, rng, shake, fmt='avi', fps=30):
+    # <root>/unstable/<name>, <root>/stable/<name> and the jitter of every frame in <root>/unstable/<name>.npy
+    base = texture(w, h, rng)
+    S = scale_mat(w, h)
+    unstable = open_writer(os.path.join(root, 'unstable', name), fmt, fps, (w, h))
+    stable = open_writer(os.path.join(root, 'stable', name), fmt, fps, (w, h))
+    Hs = []
+    H = None
+    for t in range(frames):
+        H = rand_H(rng, H, shake)
+        Hs.append(H)
+        M = np.matmul(np.matmul(S, H), np.linalg.inv(S))
+        unstable.write(cv2.warpPerspective(base, M, (w, h), flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR))
+        stable.write(base)
+    unstable.release()
+    stable.release()
+    np.save(os.path.join(root, 'unstable', name + '.npy'), np.array(Hs, dtype=np.float32))
+
+def make_dataset(root, resolutions, videos, frames, shake, seed, fmt='avi'):
+    # one directory per resolution (and source format other than avi), e.g. 512x288, 512x288_jpg
+    rng = np.random.RandomState(seed)
+    for w, h in resolutions:
+        res_root = os.path.join(root, '{}x{}'.format(w, h) + ('' if fmt == 'avi' else '_' + fmt))
+        for d in ['stable', 'unstable']:
+            if not os.path.exists(os.path.join(res_root, d)): os.makedirs(os.path.join(res_root, d))
+        names = ['bench_{}{}'.format(k, {'avi': '.avi', 'jpg': '', 'raw': '.raw'}[fmt]) for k in range(videos)]
+        for name in names:
+            make_video(res_root, name, w, h, frames, rng, shake, fmt)
+        with open(os.path.join(res_root, 'list'), 'w') as f:
+            f.write('\n'.join(names))
+        print('{}: {} videos of {} frames'.format(res_root, videos, frames))
+
+class OracleModel(object):
+    # Model.run stand-in: the mesh undoing the known jitter of the frame, on a grid_h x grid_w grid
+    net_size = None
+
+    def __init__(self, jitter, grid=(grid_h, grid_w), delay=0.):
+        self.jitter = jitter
+        self.grid = grid
+        self.delay = delay
+        self.t = 0
+
+    def run(self, in_x, refine=1, tol=None, budget=None, iterations=None):
+        b = in_x.shape[0]
+        if iterations is not None:
+            iterations += 1
+        self.t = min(self.t + 1, len(self.jitter) - 1)
+        H = np.linalg.inv(self.jitter[self.t])
+        Hs = np.tile((H / H[2, 2]).reshape(1, 1, 1, 9), (b, self.grid[0], self.grid[1], 1)).astype(np.float32)
+        if self.delay:
+            time.sleep(self.delay)
+        img = np.zeros(in_x.shape[:3] + (1,), dtype=np.float32)
+        black = np.zeros(in_x.shape[:3], dtype=np.float32)
+        return img, black, black.astype(np.int64), Hs
+
+def run_oracle(res_root, case, timing_dir):
+    # stabilizes every video of res_root in-process, like deploy_bundle.py without --deploy-vis
+    from stabilizer import Stabilizer
+    from timing import Timers
+    import pipeline
+    with open(os.path.join(res_root, 'list')) as f:
+        names = [name for name in f.read().split('\n') if name != '']
+    tot_frames = 0
+    samples = {}
+    start = time.time()
+    for name in names:
+        timers = Timers()
+        model = OracleModel(np.load(os.path.join(res_root, 'unstable', name + '.npy')), (case['grid'], case['grid']))
+        stabilizer = Stabilizer(model, refine=case['refine'], output_size='source', timers=timers,
+                                remap_threads=case['remap_threads'])
+        source = open_source(os.path.join(res_root, 'unstable', name))
+        first = stabilizer.start(source.read())
+        writer = open_sink(case['sink'], os.path.join(timing_dir, 'out' + sink_ext(case['sink'])), 30,
+                           (first.shape[1], first.shape[0]), timers=timers)
+        writer.write(first)
+        def decoded():
+            while True:
+                with timers.stage('decode'):
+                    frame = source.read()
+                if frame is None:
+                    return
+                yield frame
+        def inferred(frames):
+            for frame in frames:
+                item = stabilizer.feed(frame)
+                if item is not None:
+                    for result in stabilizer.step(item):
+                        yield result
+            for result in stabilizer.flush():
+                yield result
+        stages = []
+        if case['mode'] == 'pipeline':
+            frames = pipeline.Prefetcher(decoded(), 8, 'decode')
+            rendered = pipeline.OrderedMap(stabilizer.render, inferred(frames), 2, 8, 'render')
+            stages = [frames, rendered]
+        else:
+            rendered = map(stabilizer.render, inferred(decoded()))
+        for img in rendered:
+            with timers.stage('write'):
+                writer.write(img)
+        for stage in stages:
+            stage.close()
+        writer.release()
+        source.release()
+        stabilizer.close()
+        tot_frames += stabilizer.length
+        for name_, values in timers.samples.items():
+            samples.setdefault(name_, []).extend(values)
+    wall = time.time() - start
+    return tot_frames, wall, samples
+
+def run_model(res_root, case, timing_dir, model_args):
+    # deploy_bundle.py on the data of res_root, per-stage samples from its timing reports
+    cmd = [sys.executable, '-u', DEPLOY, '--test-list', os.path.join(res_root, 'list'), '--prefix', res_root,
+           '--output-dir', timing_dir, '--timing-dir', timing_dir, '--refine', str(case['refine']),
+           '--output-size', 'source', '--remap-threads', str(case['remap_threads']), '--sink', case['sink']] + model_args
+    if case['mode'] == 'pipeline':
+        cmd.append('--pipeline')
+    if case['mode'] == 'batch':
+        cmd += ['--batch-videos', '2']
+    out = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+    summary = [m for m in SUMMARY.finditer(out)][-1]
+    stages = {}
+    for path in glob.glob(os.path.join(timing_dir, '*.timing.json')):
+        with open(path) as f:
+            for stage in json.load(f)['stages']:
+                # per-video reports keep percentiles only: their mean weighted by count
+                total = stages.setdefault(stage['stage'], {'count': 0, 'total_ms': 0., 'p50_ms': 0., 'p95_ms': 0., 'p99_ms': 0.})
+                total['count'] += stage['count']
+                total['total_ms'] += stage['total_ms']
+                for k in ['p50_ms', 'p95_ms', 'p99_ms']:
+                    total[k] += stage[k] * stage['count']
+    for total in stages.values():
+        for k in ['p50_ms', 'p95_ms', 'p99_ms']:
+            total[k] /= max(total['count'], 1)
+    return int(summary.group(2)), float(summary.group(3)), stages
+
+def summarize(samples):
+    stages = {}
+    for name, values in samples.items():
+        ms = np.array(values) * 1000
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        stages[name] = {'count': len(ms), 'total_ms': float(ms.sum()), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+    return stages
+
+def case_key(case):
+    return ' '.join('{}={}'.format(k, case[k]) for k in sorted(case))
+
+def run(args):
+    model_args = []
+    if args.frozen_graph is not None:
+        model_args = ['--frozen-graph', args.frozen_graph]
+    elif args.model_dir is not None:
+        model_args = ['--model-dir', args.model_dir, '--model-name', args.model_name]
+    network = 'model' if model_args else 'oracle'
+    resolutions = sorted(glob.glob(os.path.join(args.root, '*x*')))
+    if args.resolutions:
+        resolutions = [os.path.join(args.root, r) for r in args.resolutions]
+    results = []
+    for res_root, refine, grid, mode, threads, sink in itertools.product(resolutions, args.refines, args.grids, args.modes,
+                                                                         args.remap_threads, args.sinks):
+        case = {'network': network, 'resolution': os.path.basename(res_root), 'refine': refine, 'grid': grid,
+                'mode': mode, 'remap_threads': threads, 'sink': sink}
+        if network == 'model' and grid != grid_h:
+            print('skip {}: the model has a {}x{} grid'.format(case_key(case), grid_h, grid_w))
+            continue
+        if network == 'oracle' and (mode == 'batch' or refine != 1):
+            print('skip {}: batching and refine only change the network'.format(case_key(case)))
+            continue
+        timing_dir = tempfile.mkdtemp(prefix='bench_')
+        if network == 'model':
+            frames, wall, stages = run_model(res_root, case, timing_dir, model_args)
+        else:
+            frames, wall, samples = run_oracle(res_root, case, timing_dir)
+            stages = summarize(samples)
+        shutil.rmtree(timing_dir)
+        result = {'case': case, 'frames': frames, 'wall_s': wall, 'fps': frames / max(wall, 1e-8), 'stages': stages}
+        print('{}: {:.2f} fps'.format(case_key(case), result['fps']))
+        results.append(result)
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': os.uname()[1], 'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('wrote {} results to {}'.format(len(results), args.out))
+
+def compare(args):
+    # flags cases whose fps dropped, or whose stage p95 grew, by more than the tolerance
+    with open(args.base) as f:
+        base = dict((case_key(r['case']), r) for r in json.load(f)['results'])
+    with open(args.new) as f:
+        new = dict((case_key(r['case']), r) for r in json.load(f)['results'])
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        change = n['fps'] / max(b['fps'], 1e-8) - 1
+        flag = change < -args.tolerance
+        print('{} {}: fps {:.2f} -> {:.2f} ({:+.1%})'.format('REGRESSION' if flag else 'ok        ', key, b['fps'], n['fps'], change))
+        regressions += flag
+        for stage in sorted(set(b['stages']) & set(n['stages'])):
+            before, after = b['stages'][stage]['p95_ms'], n['stages'][stage]['p95_ms']
+            if after > before * (1 + args.tolerance) and after - before > args.min_ms:
+                print('    {} p95 {:.2f}ms -> {:.2f}ms'.format(stage, before, after))
+    for key in sorted(set(base) ^ set(new)):
+        print('only in {}: {}'.format('base' if key in base else 'new', key))
+    print('{} regressions'.format(regressions))
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('make')
+    p.add_argument('--root', default='bench_data')
+    p.add_argument('--resolutions', nargs='+', default=['512x288', '1280x720'])
+    p.add_argument('--videos', type=int, default=2)
+    p.add_argument('--frames', type=int, default=120)
+    p.add_argument('--shake', type=float, default=0.1)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--format', default='avi', choices=['avi', 'jpg', 'raw'], help='video files, JPG directories or raw frame stores')
+    p = sub.add_parser('run')
+    p.add_argument('--root', default='bench_data')
+    p.add_argument('--out', default='bench.json')
+    p.add_argument('--resolutions', nargs='*', default=None, help='subdirectories of --root, default all')
+    p.add_argument('--refines', type=int, nargs='+', default=[1])
+    p.add_argument('--grids', type=int, nargs='+', default=[grid_h])
+    p.add_argument('--modes', nargs='+', default=['serial', 'pipeline'], choices=['serial', 'pipeline', 'batch'])
+    p.add_argument('--remap-threads', type=int, nargs='+', default=[4])
+    p.add_argument('--sinks', nargs='+', default=['mjpg'], choices=SINKS)
+    p.add_argument('--model-dir', default=None)
+    p.add_argument('--model-name', default=None)
+    p.add_argument('--frozen-graph', default=None)
+    p = sub.add_parser('compare')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--tolerance', type=float, default=0.1)
+    p.add_argument('--min-ms', type=float, default=0.5, help='ignore stage p95 changes smaller than this')
+    args = parser.parse_args()
+    if args.command == 'make':
+        make_dataset(args.root, [tuple(int(v) for v in r.split('x')) for r in args.resolutions], args.videos, args.frames, args.shake, args.seed, args.format)
+    elif args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import numpy as np
+import math
+
+def summed_area_table(mask):
+    # black_sum[i + 1][j + 1] = sum(mask[:i + 1, :j + 1])
+    h, w = mask.shape
+    table = np.zeros([h + 1, w + 1], dtype=np.int64)
+    np.cumsum(np.cumsum(mask, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    return table
+
+def right_run_length(mask):
+    # run[i][j] = number of consecutive valid (zero) pixels starting at (i, j) going right
+    h, w = mask.shape
+    valid = (mask == 0)
+    idx = np.arange(w, dtype=np.int64)
+    # column of the first black pixel at or after j, w if there is none
+    stop = np.where(valid, w, idx[None, :])
+    stop = np.minimum.accumulate(stop[:, ::-1], axis=1)[:, ::-1]
+    return stop - idx[None, :]
+
+def max_crop_rect(all_black, step=10):
+    '''
+    Largest black-free rectangle whose top-left corner lies on the `step` grid in the
+    top-left quarter of the frame. Same box as the brute force search in deploy_bundle.py:
+    anchors are visited row by row and only a strictly larger area replaces the answer.
+    return [top, left, bottom, right] (inclusive), or [] if every anchor is black
+    '''
+    height, width = all_black.shape
+    run = right_run_length(all_black)
+    rows = np.arange(0, int(math.floor(height * 0.5)), step)
+    cols = np.arange(0, int(math.floor(width * 0.5)), step)
+    max_s = 0
+    ans = []
+    for i in rows:
+        # widths[hh - i, k] = widest rectangle anchored at (i, cols[k]) spanning rows i..hh
+        widths = np.minimum.accumulate(run[i:, cols], axis=0)
+        areas = widths * np.arange(1, height - i + 1, dtype=np.int64)[:, None]
+        best_hh = np.argmax(areas, axis=0)
+        best_s = areas[best_hh, np.arange(len(cols))]
+        for k in range(len(cols)):
+            if (best_s[k] > max_s):
+                j = cols[k]
+                hh = best_hh[k]
+                max_s = best_s[k]
+                ans = [int(i), int(j), int(i + hh), int(j + widths[hh, k] - 1)]
+    return ans
+
+def max_valid_rect(all_black):
+    '''
+    Largest black-free rectangle anywhere in the frame (histogram + monotonic stack,
+    linear in the number of pixels).
+    return [top, left, bottom, right] (inclusive), or [] if every pixel is black
+    '''
+    height, width = all_black.shape
+    heights = np.zeros([width + 1], dtype=np.int64)
+    max_s = 0
+    ans = []
+    for i in range(height):
+        heights[:width] = np.where(all_black[i] == 0, heights[:width] + 1, 0)
+        # heights[width] stays 0 and flushes the stack at the end of the row
+        row = heights.tolist()
+        stack = []
+        for j in range(width + 1):
+            start = j
+            while stack and stack[-1][1] >= row[j]:
+                start, h = stack.pop()
+                s = h * (j - start)
+                if (s > max_s):
+                    max_s = s
+                    ans = [i - h + 1, start, i, j - 1]
+            stack.append((start, row[j]))
+    return ans
+
+def scale_rect(rect, sx, sy):
+    # inclusive box at network resolution -> largest box inside it at a resolution scaled by (sx, sy)
+    if len(rect) == 0:
+        return rect
+    top, left, bottom, right = rect
+    return [int(math.ceil(top * sy)), int(math.ceil(left * sx)),
+            int(math.floor((bottom + 1) * sy)) - 1, int(math.floor((right + 1) * sx)) - 1]
+
+def brute_force_crop_rect(all_black, step=10):
+    # reference search kept from deploy_bundle.py, used by test()
+    height, width = all_black.shape
+    black_sum = summed_area_table(all_black)
+    max_s = 0
+    ans = []
+    for i in range(0, int(math.floor(height * 0.5)), step):
+        for j in range(0, int(math.floor(width * 0.5)), step):
+            if (all_black[i][j] > 0):
+                continue
+            for hh in range(i, height):
+                for ww in range(j, width):
+                    if (black_sum[hh + 1][ww + 1] - black_sum[hh + 1][j] - black_sum[i][ww + 1] + black_sum[i][j] > 0):
+                        break
+                    else:
+                        s = (hh - i + 1) * (ww - j + 1)
+                        if (s > max_s):
+                            max_s = s
+                            ans = [i, j, hh, ww]
+    return ans
+
+def random_black(height, width, seed):
+    # black borders like the ones accumulated in all_black, plus some noise
+    rng = np.random.RandomState(seed)
+    mask = np.zeros([height, width], dtype=np.int64)
+    mask[:rng.randint(0, height // 3), :] += 1
+    mask[height - rng.randint(0, height // 3):, :] += 1
+    mask[:, :rng.randint(0, width // 3)] += 1
+    mask[:, width - rng.randint(0, width // 3):] += 1
+    mask += (rng.rand(height, width) < rng.rand() * 0.01).astype(np.int64)
+    return mask
+
+def test():
+    for seed in range(20):
+        all_black = random_black(72, 128, seed)
+        table = summed_area_table(all_black)
+        assert(table[-1, -1] == all_black.sum())
+        assert(table[30, 50] == all_black[:30, :50].sum())
+        ans = max_crop_rect(all_black)
+        assert ans == brute_force_crop_rect(all_black), (seed, ans)
+        best = max_valid_rect(all_black)
+        if ans:
+            assert((best[2] - best[0] + 1) * (best[3] - best[1] + 1) >= (ans[2] - ans[0] + 1) * (ans[3] - ans[1] + 1))
+        if best:
+            assert(all_black[best[0]:best[2] + 1, best[1]:best[3] + 1].sum() == 0)
+    for seed in range(20):
+        rng = np.random.RandomState(seed)
+        all_black = (rng.rand(60, 90) < 0.02 * (seed % 4)).astype(np.int64)
+        assert(max_crop_rect(all_black, 3) == brute_force_crop_rect(all_black, 3))
+    assert(max_crop_rect(np.ones([40, 40], dtype=np.int64)) == [])
+    assert(scale_rect([10, 20, 99, 199], 1, 1) == [10, 20, 99, 199])
+    assert(scale_rect([10, 20, 99, 199], 3.75, 3.75) == [38, 75, 374, 749])
+    print('crop: ok')
+
+if __name__ == '__main__':
+    test()
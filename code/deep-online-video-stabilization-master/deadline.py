@@ -0,0 +1,148 @@
+import time
+import numpy as np
+
+class Deadline(object):
+    '''
+    Keeps a Stabilizer at target_fps by degrading the work per frame. tick() at the start of
+    every frame measures the period since the last one (everything the caller did for a frame);
+    when its moving average goes over 1 / target_fps the level goes up:
+        0 full       the network with the configured refinement, budgeted to what is left of the period
+        1 single     one network run, no refinement
+        2 stride     the network on every `stride`-th frame only, the mesh extrapolated in between
+    and after `patience` frames under `slack` of the period it comes back down one level. A level
+    change waits `hold` frames for the average to follow before the next one. A recovery that has
+    to be undone within `patience` frames doubles the patience of the next one (up to 32x), so
+    that a load just over a level does not make it oscillate; a recovery that holds resets it.
+    '''
+    LEVELS = ['full', 'single', 'stride']
+
+    def __init__(self, target_fps, stride=4, slack=0.8, patience=30, hold=5, alpha=0.2):
+        self.target_fps = target_fps
+        self.period = 1. / target_fps
+        self.stride = max(2, stride)
+        self.slack = slack
+        self.patience = patience
+        self.hold = hold
+        self.alpha = alpha
+        self.level = 0
+        self.avg = None
+        self.avg_infer = 0.
+        self.last = None
+        self.calm = 0
+        self.wait = 0
+        self.backoff = 1
+        self.since_down = None
+        self.since_key = 0
+        self.latencies = []
+        # frames per decision, and level changes
+        self.counts = dict((name, 0) for name in ['full', 'single', 'extrapolated'])
+        self.changes = 0
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            dt = now - self.last
+            self.latencies.append(dt)
+            self.avg = dt if self.avg is None else self.alpha * dt + (1 - self.alpha) * self.avg
+            self.adapt()
+        self.last = now
+
+    def adapt(self):
+        if self.since_down is not None:
+            self.since_down += 1
+            if self.since_down > self.patience:
+                # the last recovery held
+                self.backoff = 1
+                self.since_down = None
+        if self.wait > 0:
+            self.wait -= 1
+            return
+        if self.avg > self.period and self.level < len(self.LEVELS) - 1:
+            if self.since_down is not None:
+                self.backoff = min(self.backoff * 2, 32)
+                self.since_down = None
+            self.set_level(self.level + 1)
+        elif self.avg < self.period * self.slack and self.level > 0:
+            self.calm += 1
+            if self.calm >= self.patience * self.backoff:
+                self.set_level(self.level - 1)
+                self.since_down = 0
+        else:
+            self.calm = 0
+
+    def set_level(self, level):
+        self.level = level
+        self.calm = 0
+        self.wait = self.hold
+        self.since_key = 0
+        self.changes += 1
+
+    def plan(self):
+        # 'full', 'single' or 'extrapolate' for the frame that just ticked
+        if self.level < 2:
+            return self.LEVELS[self.level]
+        self.since_key += 1
+        if self.since_key >= self.stride:
+            self.since_key = 0
+            return 'single'
+        return 'extrapolate'
+
+    def budget(self):
+        # seconds the network may take for a full frame: the period minus what the rest of a frame costs
+        if self.avg is None:
+            return self.period
+        return max(self.period - max(self.avg - self.avg_infer, 0.), 0.)
+
+    def record(self, decision, infer_seconds=0.):
+        self.counts['extrapolated' if decision == 'extrapolate' else decision] += 1
+        self.avg_infer = self.alpha * infer_seconds + (1 - self.alpha) * self.avg_infer
+
+    def summary(self):
+        frames = sum(self.counts.values())
+        summary = {'target_fps': self.target_fps, 'target_ms': self.period * 1000, 'frames': frames,
+                   'degraded': frames - self.counts['full'], 'level_changes': self.changes, 'level': self.LEVELS[self.level]}
+        summary.update(self.counts)
+        if self.latencies:
+            ms = np.array(self.latencies) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            summary.update({'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max()),
+                            'missed': int((ms > self.period * 1000).sum()), 'achieved_fps': 1000. / max(ms.mean(), 1e-8)})
+        return summary
+
+def format_summary(summary):
+    line = 'deadline {:.1f}fps ({:.1f}ms): {} of {} frames degraded (single {}, extrapolated {}), {} level changes'.format(
+        summary['target_fps'], summary['target_ms'], summary['degraded'], summary['frames'], summary['single'],
+        summary['extrapolated'], summary['level_changes'])
+    if 'p50_ms' in summary:
+        line += '; latency p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms, {} missed, {:.1f}fps achieved'.format(
+            summary['p50_ms'], summary['p95_ms'], summary['max_ms'], summary['missed'], summary['achieved_fps'])
+    return line
+
+def test():
+    # a frame costs what its decision costs; load doubles for a while and then drops
+    costs = {'full': 0.030, 'single': 0.012, 'extrapolate': 0.002}
+    deadline = Deadline(40, stride=3, patience=10)
+    fake_time = [0.]
+    now = time.time
+    time.time = lambda: fake_time[0]
+    try:
+        levels = []
+        for t in range(300):
+            load = 2. if 100 <= t < 200 else 1.
+            deadline.tick()
+            decision = deadline.plan()
+            cost = costs[decision] * load
+            deadline.record(decision, cost)
+            fake_time[0] += cost + 0.001
+            levels.append(deadline.level)
+    finally:
+        time.time = now
+    summary = deadline.summary()
+    print(format_summary(summary))
+    # steady at 'single' under normal load, 'stride' under double load, and back afterwards
+    assert(levels[90] == 1 and levels[190] == 2 and levels[-1] == 1)
+    assert(summary['extrapolated'] > 0 and summary['degraded'] == 300 - summary['full'])
+    print('ok')
+
+if __name__ == '__main__':
+    test()
@@ -1,17 +1,27 @@
-import tensorflow as tf
 import numpy as np
 from config import *
-from PIL import Image
 import cv2
 import time
 import os
 import traceback
-import math
 import argparse
+from frame_store import make_store
+import utils
+import pipeline
+from concurrent.futures import ThreadPoolExecutor
+from stabilizer import Model, Stabilizer, KEYFRAME_GAP
+from preprocess import Preprocessor
+from frame_source import open_source
+from frame_sink import open_sink, sink_ext, SINKS
+from timing import Timers, format_report
+from deadline import format_summary
+from render import parse_size
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--model-dir')
 parser.add_argument('--model-name')
+# load a graph frozen by export_graph.py instead of --model-dir/--model-name
+parser.add_argument('--frozen-graph', default=None)
 parser.add_argument('--before-ch', type=int)
 #parser.add_argument('--after-ch', type=int)
 parser.add_argument('--output-dir', default='data_video_local')
@@ -25,35 +35,78 @@ parser.add_argument('--random-black', type=int, default=None)
 #parser.add_argument('--indices', type=int, nargs='+', required=True)
 parser.add_argument('--start-with-stable', action='store_true')
 parser.add_argument('--refine', type=int, default=1)
+# adaptive --refine: stop once the mesh vertices move less than this many pixels (of the network frame) between runs
+parser.add_argument('--refine-tol', type=float, default=None)
+# ... or before a run would take a frame's inference over this many milliseconds
+parser.add_argument('--refine-budget-ms', type=float, default=None)
 parser.add_argument('--no_bm', type=int, default=1)
 parser.add_argument('--gpu_memory_fraction', type=float, default=0.1)
+# session thread pools, 0 lets TensorFlow pick (deploy_shards.py divides the cores among its workers)
+parser.add_argument('--intra-op-threads', type=int, default=0)
+parser.add_argument('--inter-op-threads', type=int, default=0)
 parser.add_argument('--deploy-vis', action='store_true')
+parser.add_argument('--crop-search', default='grid', choices=['grid', 'max'])
+# where warped frames wait for the crop: in RAM, in a memory-mapped scratch file, or re-read from the written .avi
+parser.add_argument('--spill', default='memory', choices=['memory', 'mmap', 'reread'])
+parser.add_argument('--spill-dir', default=None)
+# run decode, inference and remap on separate threads connected by bounded queues
+parser.add_argument('--pipeline', action='store_true')
+parser.add_argument('--queue-size', type=int, default=8)
+parser.add_argument('--render-threads', type=int, default=2)
+# resolution of the stabilized video: net (width x height of the network), source, or WxH
+parser.add_argument('--output-size', default='net')
+# WxH the network runs at, the config's 512x288 by default (other sizes need a graph from export_graph.py --rebuild)
+parser.add_argument('--net-size', default=None)
+# row bands remapped in parallel for every output frame
+parser.add_argument('--remap-threads', type=int, default=4)
+# run the network only on every n-th frame and interpolate the mesh in between
+parser.add_argument('--keyframe-stride', type=int, default=None)
+# ... or also earlier, when a frame differs from the last keyframe by more than this (mean abs, gray in [-0.5, 0.5]);
+# --keyframe-stride is then the longest gap, KEYFRAME_GAP (8) frames by default
+parser.add_argument('--keyframe-threshold', type=float, default=None)
+# real-time target: drop the refinement, then run the network on every --deadline-stride-th frame
+# only, while frames take longer than 1 / target-fps (deadline.py)
+parser.add_argument('--target-fps', type=float, default=None)
+parser.add_argument('--deadline-stride', type=int, default=4)
+# write per-stage timings of every video to <timing-dir>/<name>.timing.json/.csv (off by default)
+parser.add_argument('--timing-dir', default=None)
+# ... and a Chrome trace, <timing-dir>/<name>.trace.json
+parser.add_argument('--trace', action='store_true')
+# stabilize this many videos of the test list in lockstep, stacking their inputs into one batch
+parser.add_argument('--batch-videos', type=int, default=1)
+# <prefix>/unstable/<name> may also be a directory of JPG frames (decoded on this many threads) or a raw
+# frame store (frame_store.py); those have no frame rate of their own
+parser.add_argument('--source-threads', type=int, default=4)
+parser.add_argument('--source-fps', type=float, default=30.)
+# how the outputs are written: MJPG .avi (cv2), an ffmpeg pipe, a raw frame store or nowhere (benchmarks)
+parser.add_argument('--sink', default='mjpg', choices=SINKS)
+parser.add_argument('--ffmpeg-codec', default='libx264')
+parser.add_argument('--ffmpeg-preset', default='veryfast')
+parser.add_argument('--ffmpeg-crf', type=int, default=23)
+parser.add_argument('--ffmpeg-container', default='mp4')
+# frames waiting for every encoder thread, 0 encodes on the writing thread
+parser.add_argument('--encode-queue', type=int, default=8)
+# draw and write the --deploy-vis panel for every n-th frame only
+parser.add_argument('--vis-every', type=int, default=1)
 args = parser.parse_args()
+if args.keyframe_threshold is not None and args.keyframe_stride is not None and args.keyframe_stride <= 1:
+    parser.error('--keyframe-threshold needs a --keyframe-stride > 1, the longest gap between keyframes')
+if args.keyframe_stride is None:
+    args.keyframe_stride = KEYFRAME_GAP if args.keyframe_threshold is not None else 1
+if args.batch_videos > 1 and (args.keyframe_stride > 1 or args.keyframe_threshold is not None):
+    parser.error('--keyframe-stride / --keyframe-threshold do not work with --batch-videos')
+if args.target_fps is not None and (args.batch_videos > 1 or args.keyframe_stride > 1 or args.keyframe_threshold is not None):
+    parser.error('--target-fps does not work with --batch-videos or keyframes')
+if args.spill == 'reread' and args.sink == 'null':
+    parser.error('--spill reread needs an output to read back, not --sink null')
 
-MaxSpan = args.max_span
 args.indices = indices[1:]
 
-
-sess = tf.Session(config=tf.ConfigProto(gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_memory_fraction)))
-
-model_dir = args.model_dir#'models/vbeta-1.1.0/'
-model_name = args.model_name#'model-5000'
+model = Model(args.model_dir, args.model_name, args.frozen_graph, args.gpu_memory_fraction,
+              args.intra_op_threads, args.inter_op_threads)
+net_width, net_height = parse_size(args.net_size, (width, height), None) if args.net_size is not None else (width, height)
 before_ch = max(args.indices)#args.before_ch
 after_ch = max(1, -min(args.indices) + 1)
-#after_ch = args.after_ch
-#after_ch = 0
-new_saver = tf.train.import_meta_graph(model_dir + model_name + '.meta')
-new_saver.restore(sess, model_dir + model_name)
-graph = tf.get_default_graph()
-x_tensor = graph.get_tensor_by_name('stable_net/input/x_tensor:0')
-#output = graph.get_tensor_by_name('stable_net/SpatialTransformer/_transform/Reshape_7:0')
-#black_pix = graph.get_tensor_by_name('stable_net/SpatialTransformer/_transform/Reshape_6:0')
-output = graph.get_tensor_by_name('stable_net/inference/SpatialTransformer/_transform/output_img:0')
-black_pix = graph.get_tensor_by_name('stable_net/inference/SpatialTransformer/_transform/black_pix:0')
-#theta_mat_tensor = graph.get_tensor_by_name('stable_net/feature_loss/Reshape:0')
-Hs_tensor = graph.get_tensor_by_name('stable_net/inference/SpatialTransformer/_transform/get_Hs/Hs:0')
-x_map = graph.get_tensor_by_name("stable_net/inference/SpatialTransformer/_transform/x_map:0")
-y_map = graph.get_tensor_by_name("stable_net/inference/SpatialTransformer/_transform/y_map:0")
 
 
 #black_pix = graph.get_tensor_by_name('stable_net/img_loss/StopGradient:0')
@@ -72,7 +125,7 @@ for list_path in args.test_list:
 def make_dirs(path):
     if not os.path.exists(path): os.makedirs(path)
 
-cvt_train2img = lambda x: ((np.reshape(x, (height, width)) + 0.5) * 255).astype(np.uint8)
+cvt_train2img = lambda x: ((np.reshape(x, (net_height, net_width)) + 0.5) * 255).astype(np.uint8)
 
 def draw_imgs(net_output, stable_frame, unstable_frame, inputs):
     cvt2int32 = lambda x: x.astype(np.int32)
@@ -98,278 +151,317 @@ def getNext(delta, bound, speed = 5):
     return delta + speed, speed
     # return np.random.randint(0, bound), 5
 
-def cvt_theta_mat(theta_mat):
-    # theta_mat * x = x'
-    # ret * scale_mat * x = scale_mat * x'
-    # ret = scale_mat * theta_mat * scale_mat^-1
-    scale_mat = np.eye(3)
-    scale_mat[0, 0] = width / 2.
-    scale_mat[0, 2] = width / 2.
-    scale_mat[1, 1] = height / 2.
-    scale_mat[1, 2] = height / 2.
-    assert(theta_mat.shape == (3, 3))
-    from numpy.linalg import inv
-    return np.matmul(np.matmul(scale_mat, theta_mat), inv(scale_mat))
-
-def warpRev(img, theta):
-    assert(img.ndim == 3)
-    assert(img.shape[-1] == 3)
-    theta_mat_cvt = cvt_theta_mat(theta)
-    return cv2.warpPerspective(img, theta_mat_cvt, dsize=(width, height), flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR)
-
-
-def cvt_theta_mat_bundle(Hs):
-    # theta_mat * x = x'
-    # ret * scale_mat * x = scale_mat * x'
-    # ret = scale_mat * theta_mat * scale_mat^-1
-    scale_mat = np.eye(3)
-    scale_mat[0, 0] = width / 2.
-    scale_mat[0, 2] = width / 2.
-    scale_mat[1, 1] = height / 2.
-    scale_mat[1, 2] = height / 2.
-
-    Hs = Hs.reshape((grid_h, grid_w, 3, 3))
-    from numpy.linalg import inv
-
-    return np.matmul(np.matmul(scale_mat, Hs), inv(scale_mat))
-
-
-#####======================================== 图像重映射 =======================================
-def warpRevBundle2(img, x_map, y_map):
-    assert(img.ndim == 3)
-    assert(img.shape[-1] == 3)
-    rate = 4
-    x_map = cv2.resize(cv2.resize(x_map, (int(width / rate), int(height / rate))), (width, height))
-    y_map = cv2.resize(cv2.resize(y_map, (int(width / rate), int(height / rate))), (width, height))
-    x_map = (x_map + 1) / 2 * width
-    y_map = (y_map + 1) / 2 * height
-    dst = cv2.remap(img, x_map, y_map, cv2.INTER_LINEAR)
-    assert(dst.shape == (height, width, 3))
-    return dst
-
-def warpRevBundle(img, Hs):
-    assert(img.ndim == 3)
-    assert(img.shape[-1] == 3)
-    Hs_cvt = cvt_theta_mat_bundle(Hs)
-
-    gh = int(math.floor(height / grid_h))
-    gw = int(math.floor(width / grid_w))
-    img_ = []
-    for i in range(grid_h):
-        row_img_ = []
-        for j in range(grid_w):
-            H = Hs_cvt[i, j, :, :]
-            sh = i * gh
-            eh = (i + 1) * gh - 1
-            sw = j * gw
-            ew = (j + 1) * gw - 1
-            if (i == grid_h - 1):
-                eh = height - 1
-            if (j == grid_w - 1):
-                ew = width - 1
-            temp = cv2.warpPerspective(img, H, dsize=(width, height), flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR)
-            row_img_.append(temp[sh:eh+1, sw:ew+1, :])
-        img_.append(np.concatenate(row_img_, axis=1))
-    img = np.concatenate(img_, axis=0)    
-    assert(img.shape == (height, width, 3))
-    return img
-
+output_ext = sink_ext(args.sink, args.ffmpeg_container)
 
+def make_sink(path, fps, size, timers, name):
+    return open_sink(args.sink, path, fps, size, args.ffmpeg_codec, args.ffmpeg_preset, args.ffmpeg_crf,
+                     args.encode_queue, timers, name)
 
 production_dir = os.path.join(args.output_dir, 'output')
 visual_dir = os.path.join(args.output_dir, 'output-vis')
 make_dirs(production_dir)
 make_dirs(visual_dir)
-
-print('inference with {}'.format(args.indices))
-for video_name in video_list:
-    tot_time = 0
-    if (video_name == ""):
-        continue
-    print(video_name)
-    stable_cap = cv2.VideoCapture(os.path.join(args.prefix,'stable', video_name)) 
-    unstable_cap = cv2.VideoCapture(os.path.join(args.prefix,'unstable', video_name))
-    fps = unstable_cap.get(cv2.CAP_PROP_FPS)
-    cut_fps = False
-    if (fps > 40):
-        fps /= 2
-        cut_fps = True
-    print(fps)
-    print(os.path.join(args.prefix,'unstable', video_name))
-    videoWriter = cv2.VideoWriter(os.path.join(production_dir, video_name + '.avi'), 
-            cv2.VideoWriter_fourcc('M','J','P','G'), fps, (width, height))
-    #videoWriterTest = cv2.VideoWriter(os.path.join(production_dir, video_name + '_test.avi'), 
-    #        cv2.VideoWriter_fourcc('M','J','P','G'), fps, (width, height))
-    if (args.deploy_vis):
-        videoWriterVis = cv2.VideoWriter(os.path.join(visual_dir, video_name + '.avi'), 
-                cv2.VideoWriter_fourcc('M','J','P','G'), fps, (width * 2, height * 2))
-    before_frames = []
-    before_masks = []
-    after_frames = []
-    after_temp = []
-    print(video_name)
-    ret, stable_cap_frame = stable_cap.read()
-    ret, unstable_cap_frame = unstable_cap.read()
-    if (args.start_with_stable):
-        frame = stable_cap_frame
-    else:
-        frame = unstable_cap_frame
-    videoWriter.write(cv2.resize(frame, (width, height)))
-    for i in range(before_ch):
-        before_frames.append(cvt_img2train(frame, crop_rate))
-        before_masks.append(np.zeros([1, height, width, 1], dtype=np.float))
-        temp = before_frames[i]
-        temp = ((np.reshape(temp, (height, width)) + 0.5) * 255).astype(np.uint8)
-        #videoWriter.write(cv2.resize(stable_cap_frame, (width, height)))
-        temp = np.concatenate([temp, np.zeros_like(temp)], axis=1)
-        temp = np.concatenate([temp, np.zeros_like(temp)], axis=0)
-        if args.deploy_vis: videoWriterVis.write(cv2.cvtColor(temp, cv2.COLOR_GRAY2BGR))
-    # for i in range(after_ch + 1):
-    for i in range(after_ch):
-        if (cut_fps):
-            ret, frame = unstable_cap.read() 
-        ret, frame = unstable_cap.read()
-        frame_unstable = frame
-        after_temp.append(frame)
-        after_frames.append(cvt_img2train(frame, 1))
-
-    length = 0
-    in_xs = []
+spill_dir = args.spill_dir if args.spill_dir is not None else production_dir
+make_dirs(spill_dir)
+timing_dir = args.timing_dir
+if timing_dir is not None:
+    make_dirs(timing_dir)
+
+def read_frames(source, timers=Timers(enabled=False)):
+    while True:
+        with timers.stage('decode'):
+            frame = source.read()
+        if frame is None:
+            return
+        yield frame
+
+def decode_frames(unstable_source, stable_source, timers):
+    # yields (unstable frame, stable_train_frame) for every frame after the first
     delta = 0
     speed = args.random_black
-    dh = int(height * 0.8 / 2)
-    dw = int(width * 0.8 / 2)
-    all_black = np.zeros([height, width], dtype=np.int64)
-    frames = []
-
-    black_mask = np.zeros([dh, width], dtype=np.float)
-    temp_mask = np.concatenate([np.zeros([height - 2 * dh, dw], dtype=np.float), np.ones([height - 2 * dh, width - 2 * dw], dtype=np.float), np.zeros([height - 2 * dh, dw], dtype=np.float)], axis=1)
-    black_mask = np.reshape(np.concatenate([black_mask, temp_mask, black_mask], axis=0),[1, height, width, 1]) 
-
-    try:
-        while(True):
+    # decode runs on its own thread with --pipeline, so it has its own scratch buffers
+    preprocess = Preprocessor((net_width, net_height))
+    for frame in read_frames(unstable_source, timers):
+        stable_train_frame = None
+        if (args.deploy_vis or args.infer_with_stable):
+            with timers.stage('stable'):
+                stable_cap_frame = stable_source.read()
+                stable_train_frame = preprocess.train(stable_cap_frame, crop_rate=crop_rate)
+            if args.random_black is not None:
+                delta, speed = getNext(delta, 50, speed)
+                print(delta, speed)
+                stable_train_frame[:, :, delta:net_width, ...] = stable_train_frame[:, :, 0:net_width-delta, ...]
+                stable_train_frame[:, :, :delta, ...] = -1
+        yield frame, stable_train_frame
+
+def infer_frames(decoded, stabilizer):
+    for frame, stable_train_frame in decoded:
+        item = stabilizer.feed(frame, stable_train_frame)
+        if item is not None:
+            for result in stabilizer.step(item):
+                yield result
+    for result in stabilizer.flush():
+        yield result
+
+refine_budget = args.refine_budget_ms / 1000. if args.refine_budget_ms is not None else None
+remap_pool = ThreadPoolExecutor(max_workers=args.remap_threads) if args.remap_threads > 1 else None
+
+def make_stabilizer(timers):
+    return Stabilizer(model, args.indices, args.refine, args.output_size, args.no_bm, args.infer_with_stable,
+                      args.infer_with_last, args.max_span, keep_inputs=args.deploy_vis,
+                      remap_threads=args.remap_threads, pool=remap_pool,
+                      keyframe_stride=args.keyframe_stride, keyframe_threshold=args.keyframe_threshold,
+                      timers=timers, refine_tol=args.refine_tol, refine_budget=refine_budget,
+                      target_fps=args.target_fps, deadline_stride=args.deadline_stride,
+                      net_size=(net_width, net_height))
+
+class VideoJob(object):
+    # opens the streams and writers of one video, writes its frames and finally its crop
+    def __init__(self, video_name):
+        self.video_name = video_name
+        print(video_name)
+        self.unstable_source = open_source(os.path.join(args.prefix,'unstable', video_name),
+                                           threads=args.source_threads, fps=args.source_fps)
+        # the stable video is only read for the visualization, --infer-with-stable and --start-with-stable
+        self.stable_source = None
+        if (args.deploy_vis or args.infer_with_stable or args.start_with_stable):
+            self.stable_source = open_source(os.path.join(args.prefix,'stable', video_name),
+                                             threads=args.source_threads, fps=args.source_fps)
+        fps = self.unstable_source.fps
+        if (fps > 40):
+            # every other frame, the dropped ones are not decoded
+            fps /= 2
+            self.unstable_source.step = 2
+        self.fps = fps
+        print(fps)
+        print(os.path.join(args.prefix,'unstable', video_name))
+        stable_cap_frame = self.stable_source.read() if self.stable_source is not None else None
+        unstable_cap_frame = self.unstable_source.read()
+        if (args.start_with_stable):
+            frame = stable_cap_frame
+        else:
+            frame = unstable_cap_frame
+        # the network runs at --net-size, the stabilized video is rendered at --output-size
+        self.timers = Timers(enabled=args.timing_dir is not None, trace=args.trace)
+        # peak memory of this video, ru_maxrss only knows the process's
+        self.rss = utils.RssMonitor()
+        self.stabilizer = make_stabilizer(self.timers)
+        first = self.stabilizer.start(frame)
+        self.out_width, self.out_height = self.stabilizer.out_width, self.stabilizer.out_height
+        self.output_path = os.path.join(production_dir, video_name + output_ext)
+        self.videoWriter = make_sink(self.output_path, fps, (self.out_width, self.out_height), self.timers, 'encode')
+        if (args.deploy_vis):
+            self.videoWriterVis = make_sink(os.path.join(visual_dir, video_name + output_ext), fps / args.vis_every,
+                                            (net_width * 2, net_height * 2), self.timers, 'encode_vis')
+        self.videoWriter.write(first)
+        for i in range(before_ch):
+            temp = cvt_train2img(self.stabilizer.history.frame(i))
+            temp = np.concatenate([temp, np.zeros_like(temp)], axis=1)
+            temp = np.concatenate([temp, np.zeros_like(temp)], axis=0)
+            if args.deploy_vis: self.videoWriterVis.write(cv2.cvtColor(temp, cv2.COLOR_GRAY2BGR))
+
+        if args.spill == 'reread':
+            # the output starts with the unwarped first frame, which is not part of the cut
+            self.frames = make_store('reread', self.output_path, skip=1)
+        else:
+            self.frames = make_store(args.spill, os.path.join(spill_dir, video_name + '.frames'))
+        self.decoded = decode_frames(self.unstable_source, self.stable_source, self.timers)
+        self.produced = 0
+        self.length = 0
+        self.start = time.time()
+
+    def next_item(self):
+        # the next frame with its look-ahead, StopIteration at the end of the video
+        while True:
+            item = self.stabilizer.feed(*next(self.decoded))
+            if item is not None:
+                return item
+
+    def number(self, result):
+        # (index, result) in stabilization order, so that render threads know which frames to visualize
+        index = self.produced
+        self.produced += 1
+        return index, result
+
+    def render(self, numbered):
+        index, item = numbered
+        frame_unstable, Hs, img, inputs, after_frame, stable_train_frame = item
+        ####=================== 不稳定帧，与 网络输出的Hs 进行warped ================================
+        img_warped = self.stabilizer.render(item)
+        vis = None
+        if args.deploy_vis and index % args.vis_every == 0:
+            if inputs is None:
+                # interpolated frame, the network did not see its inputs
+                inputs = np.reshape(img, (1, net_height, net_width, 1))
+            with self.timers.stage('vis'):
+                vis = draw_imgs(cvt_train2img(img), cvt_train2img(stable_train_frame), cvt_train2img(after_frame), inputs)
+        return img_warped, vis
+
+    def write(self, img_warped, vis, stages=None):
+        with self.timers.stage('write'):
+            self.frames.append(img_warped)
+            self.videoWriter.write(img_warped)
+            if vis is not None:
+                self.videoWriterVis.write(vis)
+        self.length = self.length + 1
+        if (self.length % 10 == 0):
+            print("length: " + str(self.length))      
+            print('fps={}, wall fps={}'.format(self.length / self.stabilizer.tot_time, self.length / (time.time() - self.start)))
+            if stages:
+                print('queues: ' + pipeline.format_stats(stages))
+
+    def finish(self):
+        print('total length={}'.format(self.length + 1))
+        if self.stabilizer.keyframing():
+            print('keyframes={}/{}, network runs {:.2f}x fewer'.format(self.stabilizer.keyframes, self.length,
+                  self.length / float(max(self.stabilizer.keyframes, 1))))
+        refine_mean, refine_counts = self.stabilizer.refine_summary()
+        if args.refine > 1:
+            print('refine iterations: mean {:.2f} of {}, frames per iterations {}'.format(refine_mean, args.refine, refine_counts))
+        deadline = self.stabilizer.deadline.summary() if self.stabilizer.deadline is not None else None
+        if deadline is not None:
+            print(format_summary(deadline))
+        with self.timers.stage('flush'):
+            self.videoWriter.release()
             if (args.deploy_vis):
-                _, stable_cap_frame = stable_cap.read()
-                stable_train_frame = cvt_img2train(stable_cap_frame, crop_rate)
-                if args.random_black is not None:
-                    delta, speed = getNext(delta, 50, speed)
-                    print(delta, speed)
-                    stable_train_frame[:, :, delta:width, ...] = stable_train_frame[:, :, 0:width-delta, ...]
-                    stable_train_frame[:, :, :delta, ...] = -1
-                stable_frame = cvt_train2img(stable_train_frame)
-                unstable_frame = cvt_train2img(after_frames[0])
-                print('deploy_vis')
-            in_x = []
-            if input_mask:
-                for i in args.indices:
-                    if (i > 0):
-                        in_x.append(before_masks[-i])
-            for i in args.indices:
-                if (i > 0):
-                    in_x.append(before_frames[-i])
-            in_x.append(after_frames[0])
-            for i in args.indices:
-                if (i < 0):
-                    in_x.append(after_frames[-i])
-            if (args.no_bm == 0):
-                in_x.append(black_mask)
-            # for i in range(after_ch + 1):
-            in_x = np.concatenate(in_x, axis = 3)
-            # for max span
-            if MaxSpan != 1:
-                in_xs.append(in_x)
-                if len(in_xs) > MaxSpan: 
-                    in_xs = in_xs[-1:]
-                    print('cut')
-                in_x = in_xs[0].copy()
-                in_x[0, ..., before_ch] = after_frames[0][..., 0]
-            tmp_in_x = in_x.copy()
-            for j in range(args.refine):
-                start = time.time()
-                img, black, Hs, x_map_, y_map_ = sess.run([output, black_pix, Hs_tensor, x_map, y_map], feed_dict={x_tensor:tmp_in_x})
-                tot_time += time.time() - start
-                black = black[0, :, :]
-                xmap = x_map_[0, :, :, 0]
-                ymap = y_map_[0, :, :, 0]
-                all_black = all_black + np.round(black).astype(np.int64)
-                img = img[0, :, :, :].reshape(height, width)
-                frame = img + black * (-1)
-                frame = frame.reshape(1, height, width, 1)
-                tmp_in_x[..., -1] = frame[..., 0]
-            img = ((np.reshape(img, (height, width)) + 0.5) * 255).astype(np.uint8)
-            
-            net_output = img
-            img = cv2.cvtColor(img,cv2.COLOR_GRAY2BGR)
-            #videoWriterTest.write(img)
-
-            #img_warped = warpRevBundle(cv2.resize(frame_unstable, (width, height)), Hs[0])
-            ####=================== 不稳定帧，与 网络输出的xmap , ymap 进行warped ================================
-            img_warped = warpRevBundle2(cv2.resize(after_temp[0], (width, height)), xmap, ymap)
-            frames.append(img_warped)
-            videoWriter.write(img_warped)
-            if args.deploy_vis: 
-                videoWriterVis.write(draw_imgs(net_output, stable_frame, unstable_frame, in_x))
-
-            if (cut_fps):
-                ret, frame_unstable = unstable_cap.read() 
-            ret, frame_unstable = unstable_cap.read() 
-            
-            if (not ret):
+                self.videoWriterVis.release()
+        self.unstable_source.release()
+        if self.stable_source is not None:
+            self.stable_source.release()
+
+        with self.timers.stage('crop'):
+            ans = self.stabilizer.crop_rect(args.crop_search)
+        print('crop={}'.format(ans))
+        no_crop_path = os.path.join(production_dir, self.video_name + '_cut.nocrop')
+        if (len(ans) == 0):
+            print('no black-free crop found, skipping ' + self.video_name + '_cut' + output_ext)
+            # tells deploy_shards.py the video is done: the number of frames the cut would have had
+            with open(no_crop_path, 'w') as f:
+                f.write('{}\n'.format(self.length))
+        else:
+            if os.path.exists(no_crop_path):
+                os.remove(no_crop_path)
+            with self.timers.stage('cut'):
+                videoWriter_cut = make_sink(os.path.join(production_dir, self.video_name + '_cut' + output_ext),
+                                            self.fps, (ans[3] - ans[1] + 1, ans[2] - ans[0] + 1), self.timers, 'encode_cut')
+                for frame in self.frames.frames():
+                    frame_ = frame[ans[0]:ans[2] + 1, ans[1]:ans[3] + 1, :]
+                    videoWriter_cut.write(frame_)
+                videoWriter_cut.release()
+        self.frames.close()
+        self.stabilizer.close()
+        peak_rss = self.rss.stop()
+        print('peak rss={:.1f}MB (this video), process peak rss={:.1f}MB, rss={:.1f}MB'.format(
+            peak_rss, utils.peak_rss_mb(), utils.rss_mb()))
+        if self.timers.enabled:
+            report = self.timers.write(os.path.join(timing_dir, self.video_name), self.length, time.time() - self.start,
+                                       {'video': self.video_name, 'keyframes': self.stabilizer.keyframes,
+                                        'refine_mean': refine_mean, 'refine_counts': refine_counts, 'deadline': deadline,
+                                        'peak_rss_mb': peak_rss})
+            print(format_report(report))
+
+def process_video(video_name):
+    # returns the number of stabilized frames
+    job = VideoJob(video_name)
+    stages = []
+    try:
+        # decode -> infer -> render -> encode; with --pipeline every arrow is a bounded queue and
+        # decode, infer and render run on their own threads while this thread encodes
+        decoded = job.decoded
+        if args.pipeline:
+            decoded = pipeline.Prefetcher(decoded, args.queue_size, 'decode')
+            stages.append(decoded)
+        inferred = map(job.number, infer_frames(decoded, job.stabilizer))
+        if args.pipeline:
+            rendered = pipeline.OrderedMap(job.render, inferred, args.render_threads, args.queue_size, 'render')
+            stages.append(rendered)
+        else:
+            rendered = map(job.render, inferred)
+        for img_warped, vis in rendered:
+            job.write(img_warped, vis, stages)
+    except Exception as e:
+        traceback.print_exc()
+    finally:
+        for stage in stages:
+            stage.close()
+        job.finish()
+    return job.length
+
+def process_videos_batched(video_names, batch_videos):
+    # advances up to batch_videos videos in lockstep, one stacked sess.run per step; a video that
+    # ends hands its slot to the next one in the list. returns the number of stabilized frames
+    names = iter(video_names)
+    def next_job():
+        for video_name in names:
+            try:
+                return VideoJob(video_name)
+            except Exception as e:
+                traceback.print_exc()
+        return None
+    jobs = [next_job() for i in range(batch_videos)]
+    renderer = ThreadPoolExecutor(max_workers=max(1, args.render_threads))
+    batch_in_x = None
+    tot_length = 0
+    try:
+        while any(job is not None for job in jobs):
+            active = []
+            items = []
+            for k in range(batch_videos):
+                while jobs[k] is not None:
+                    try:
+                        items.append(jobs[k].next_item())
+                        active.append(jobs[k])
+                        break
+                    except StopIteration:
+                        pass
+                    except Exception as e:
+                        traceback.print_exc()
+                    jobs[k].finish()
+                    tot_length += jobs[k].length
+                    jobs[k] = next_job()
+            if len(active) == 0:
                 break
-            length = length + 1
-            if (length % 10 == 0):
-                print("length: " + str(length))      
-                print('fps={}'.format(length / tot_time))
-            if args.infer_with_stable:
-                before_frames.append(stable_train_frame)
-            else:
-                before_frames.append(frame)
-                before_masks.append(black.reshape((1, height, width, 1)))
-            if args.infer_with_last:
-                for i in range(len(before_frames)):
-                    before_frames[i] = before_frames[-1]
-            before_frames.pop(0)
-            before_masks.pop(0)
-            after_frames.append(cvt_img2train(frame_unstable, 1))
-            after_frames.pop(0)
-            after_temp.append(frame_unstable)
-            after_temp.pop(0)
-
-            #if (len == 100):
-            #    break
+            if batch_in_x is None:
+                batch_in_x = np.zeros((batch_videos, ) + active[0].stabilizer.history.in_x.shape[1:], dtype=np.float32)
+            in_xs = []
+            for b in range(len(active)):
+                out = batch_in_x[b:b + 1]
+                with active[b].timers.stage('input'):
+                    in_x = active[b].stabilizer.make_input(items[b][1], out=out)
+                if in_x is not out:
+                    out[...] = in_x
+                in_xs.append(out)
+            start = time.time()
+            iterations = np.zeros([len(active)], dtype=np.int64)
+            img, black, black_count, Hs = model.run(batch_in_x[:len(active)], args.refine, args.refine_tol, refine_budget, iterations)
+            elapsed = time.time() - start
+            results = []
+            for b in range(len(active)):
+                active[b].stabilizer.tot_time += elapsed
+                active[b].timers.add('infer', elapsed, start)
+                results.append(active[b].number(active[b].stabilizer.finish_step(items[b], in_xs[b], img[b], black[b], black_count[b],
+                                                                                 Hs[b], iterations[b])))
+            for job, (img_warped, vis) in zip(active, renderer.map(lambda pair: pair[0].render(pair[1]), zip(active, results))):
+                job.write(img_warped, vis)
     except Exception as e:
         traceback.print_exc()
     finally:
-        print('total length={}'.format(length + 2))
-        videoWriter.release()
-        #videoWriterTest.release()
-        unstable_cap.release()
-
-        black_sum = np.zeros([height + 1, width + 1], dtype=np.int64)
-        for i in range(height):
-            for j in range(width):
-                black_sum[i + 1][j + 1] = black_sum[i][j + 1] + black_sum[i + 1][j] - black_sum[i][j] + all_black[i][j]
-        max_s = 0
-        ans = []
-        for i in range(0, int(math.floor(height * 0.5)), 10):
-            print(i)
-            print(max_s)
-            for j in range(0, int(math.floor(width * 0.5)), 10):
-                if (all_black[i][j] > 0):
-                    continue
-                for hh in range(i, height):
-                    dw = int(math.floor(float(max_s) / (hh - i + 1)))
-                    for ww in range(j, width):
-                        if (black_sum[hh + 1][ww + 1] - black_sum[hh + 1][j] - black_sum[i][ww + 1] + black_sum[i][j] > 0):
-                            break
-                        else:
-                            s = (hh - i + 1) * (ww - j + 1)
-                            if (s > max_s):
-                                max_s = s
-                                ans = [i, j, hh, ww]
-        videoWriter_cut = cv2.VideoWriter(os.path.join(production_dir, video_name + '_cut.avi'), 
-            cv2.VideoWriter_fourcc('M','J','P','G'), fps, (ans[3] - ans[1] + 1, ans[2] - ans[0] + 1))
-        for frame in frames:
-            frame_ = frame[ans[0]:ans[2] + 1, ans[1]:ans[3] + 1, :]
-            videoWriter_cut.write(frame_)
-        videoWriter_cut.release()
+        renderer.shutdown(wait=True)
+        for job in jobs:
+            if job is not None:
+                job.finish()
+                tot_length += job.length
+    return tot_length
+
+print('inference with {}'.format(args.indices))
+run_start = time.time()
+video_list = [video_name for video_name in video_list if video_name != ""]
+if args.batch_videos > 1:
+    tot_length = process_videos_batched(video_list, args.batch_videos)
+else:
+    tot_length = 0
+    for video_name in video_list:
+        tot_length += process_video(video_name)
+run_time = time.time() - run_start
+print('{} videos, {} frames in {:.1f}s, aggregate fps={:.2f} ({})'.format(len(video_list), tot_length, run_time, tot_length / max(run_time, 1e-8),
+    'batch of {} videos'.format(args.batch_videos) if args.batch_videos > 1 else 'sequential'))
@@ -0,0 +1,142 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+import multiprocessing
+from frame_source import open_source
+from frame_sink import sink_ext, SINKS
+
+# Runs deploy_bundle.py over the test lists in several worker processes, each with its own
+# session. Videos are dealt longest first to the least loaded worker, and videos whose
+# output/<name>.avi and output/<name>_cut.avi (or the _cut.nocrop marker) are complete are skipped. Every argument this
+# script does not know is passed on to deploy_bundle.py.
+parser = argparse.ArgumentParser()
+parser.add_argument('--test-list', nargs='+', default=['data_video/test_list', 'data_video/train_list_deploy'])
+parser.add_argument('--prefix', default='data_video')
+parser.add_argument('--output-dir', default='data_video_local')
+parser.add_argument('--workers', type=int, default=2)
+# intra-op threads of every worker's session, defaults to the cores divided among the workers
+parser.add_argument('--intra-op-threads', type=int, default=None)
+parser.add_argument('--shard-dir', default=None, help='defaults to <output-dir>/shards')
+parser.add_argument('--redo', action='store_true', help='do not skip complete videos')
+parser.add_argument('--dry-run', action='store_true')
+# passed on to deploy_bundle.py, and tell which output files to check for completeness
+parser.add_argument('--sink', default='mjpg', choices=SINKS)
+parser.add_argument('--ffmpeg-container', default='mp4')
+
+DEPLOY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deploy_bundle.py')
+SUMMARY = re.compile(r'(\d+) videos, (\d+) frames in ([\d.]+)s')
+
+def read_video_list(list_paths):
+    video_list = []
+    for list_path in list_paths:
+        if os.path.isfile(list_path):
+            print('adding ' + list_path)
+            with open(list_path, 'r') as f:
+                video_list.extend(f.read().split('\n'))
+    return [video_name for video_name in video_list if video_name != '']
+
+def frame_count(path):
+    if not os.path.exists(path):
+        return 0
+    source = open_source(path, threads=0)
+    count = source.count
+    source.release()
+    return count
+
+def is_complete(production_dir, video_name, ext='.avi'):
+    # deploy_bundle.py writes the unwarped first frame plus every stabilized frame to <name>.avi and
+    # the stabilized frames only to <name>_cut.avi, which is written after <name>.avi is closed.
+    # An interrupted run leaves the cut missing, truncated or unreadable. When no black-free crop
+    # exists there is no cut, <name>_cut.nocrop holds the number of frames it would have had.
+    no_crop_path = os.path.join(production_dir, video_name + '_cut.nocrop')
+    if os.path.exists(no_crop_path):
+        with open(no_crop_path, 'r') as f:
+            cut = int(f.read().strip() or 0)
+    else:
+        cut = frame_count(os.path.join(production_dir, video_name + '_cut' + ext))
+    return cut > 0 and frame_count(os.path.join(production_dir, video_name + ext)) == cut + 1
+
+def make_shards(videos, workers):
+    # longest processing time first: every video goes to the worker with the fewest frames so far
+    shards = [[] for i in range(workers)]
+    loads = [0] * workers
+    for video_name, frames in sorted(videos, key=lambda v: -v[1]):
+        k = loads.index(min(loads))
+        shards[k].append(video_name)
+        loads[k] += frames
+    return shards, loads
+
+def main():
+    args, deploy_args = parser.parse_known_args()
+    production_dir = os.path.join(args.output_dir, 'output')
+    ext = sink_ext(args.sink, args.ffmpeg_container)
+    deploy_args = ['--sink', args.sink, '--ffmpeg-container', args.ffmpeg_container] + deploy_args
+    shard_dir = args.shard_dir if args.shard_dir is not None else os.path.join(args.output_dir, 'shards')
+    if not os.path.exists(shard_dir): os.makedirs(shard_dir)
+
+    videos = []
+    skipped = 0
+    for video_name in read_video_list(args.test_list):
+        if not args.redo and args.sink != 'null' and is_complete(production_dir, video_name, ext):
+            skipped += 1
+            continue
+        videos.append((video_name, frame_count(os.path.join(args.prefix, 'unstable', video_name))))
+    print('{} videos to stabilize, {} complete ones skipped'.format(len(videos), skipped))
+    if len(videos) == 0:
+        return
+
+    workers = max(1, min(args.workers, len(videos)))
+    intra_op_threads = args.intra_op_threads
+    if intra_op_threads is None:
+        intra_op_threads = max(1, multiprocessing.cpu_count() // workers)
+    shards, loads = make_shards(videos, workers)
+
+    procs = []
+    for k in range(workers):
+        list_path = os.path.join(shard_dir, 'shard_{}'.format(k))
+        with open(list_path, 'w') as f:
+            f.write('\n'.join(shards[k]))
+        cmd = [sys.executable, '-u', DEPLOY, '--test-list', list_path, '--prefix', args.prefix,
+               '--output-dir', args.output_dir, '--intra-op-threads', str(intra_op_threads)] + deploy_args
+        print('worker {}: {} videos, {} frames: {}'.format(k, len(shards[k]), loads[k], ' '.join(cmd)))
+        if args.dry_run:
+            continue
+        log = open(os.path.join(shard_dir, 'shard_{}.log'.format(k)), 'w')
+        procs.append((k, subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log, time.time()))
+
+    run_start = time.time()
+    # poll so that every worker's time ends when it exits, not when it is waited for
+    running = list(procs)
+    ends = {}
+    while running:
+        for item in list(running):
+            if item[1].poll() is not None:
+                ends[item[0]] = time.time()
+                running.remove(item)
+        time.sleep(0.5)
+    tot_frames = 0
+    for k, proc, log, start in procs:
+        elapsed = ends[k] - start
+        log.close()
+        summary = None
+        with open(log.name, 'r') as f:
+            for line in f:
+                match = SUMMARY.search(line)
+                if match:
+                    summary = match
+        if summary is None:
+            print('worker {}: exit code {}, no summary in {}'.format(k, proc.returncode, log.name))
+            continue
+        frames = int(summary.group(2))
+        tot_frames += frames
+        print('worker {}: exit code {}, {} videos, {} frames in {:.1f}s, fps={:.2f}'.format(
+            k, proc.returncode, summary.group(1), frames, elapsed, frames / max(elapsed, 1e-8)))
+    run_time = time.time() - run_start
+    if procs:
+        print('{} workers, {} frames in {:.1f}s, aggregate fps={:.2f}'.format(len(procs), tot_frames, run_time, tot_frames / max(run_time, 1e-8)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import tensorflow as tf
+import argparse
+import os
+from tensorflow.python.framework import graph_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# Freezes the deploy path of a training checkpoint, stable_net/input/x_tensor -> inference transformer,
+# into one constant-folded GraphDef. Node names are kept, so deploy_bundle.py --frozen-graph finds
+# the same tensors as in the meta graph.
+INPUT = 'stable_net/input/x_tensor'
+INFERENCE_SCOPE = 'stable_net/inference/SpatialTransformer/_transform/'
+OUTPUTS = ['get_Hs/Hs', 'x_map', 'y_map']
+OPTIONAL_OUTPUTS = ['black_pix', 'output_img']
+TRANSFORMS = ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms']
+
+def restore_saver(checkpoint, rebuild=False, **kwargs):
+    '''
+    Builds the deploy path of checkpoint in the default graph and returns the Saver to restore it:
+    the .meta graph when it has the inference branch, else (or with rebuild) deploy_stable_net() from
+    s_net_bundle_nobm.py, with the same node and variable names.
+    '''
+    meta_graph_def = tf.MetaGraphDef()
+    with tf.gfile.GFile(checkpoint + '.meta', 'rb') as f:
+        meta_graph_def.ParseFromString(f.read())
+    names = set(node.name for node in meta_graph_def.graph_def.node)
+    if not rebuild and INFERENCE_SCOPE + OUTPUTS[0] in names:
+        return tf.train.import_meta_graph(meta_graph_def, **kwargs)
+    import s_net_bundle_nobm as s_net
+    s_net.deploy_stable_net()
+    return tf.train.Saver(tf.global_variables())
+
+def freeze(sess, input_name, output_names):
+    graph_def = sess.graph.as_graph_def()
+    # keeps only the subgraph the outputs depend on and turns its variables into constants
+    frozen = graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+    frozen = graph_util.remove_training_nodes(frozen)
+    return TransformGraph(frozen, [input_name], output_names, TRANSFORMS)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--model-name', required=True)
+    parser.add_argument('--output', default=None, help='defaults to <model-dir>/<model-name>.pb')
+    parser.add_argument('--skip', nargs='*', default=[], choices=OPTIONAL_OUTPUTS,
+                        help='optional outputs to leave out (deploy_bundle.py needs both)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build the graph from s_net_bundle_nobm.py instead of the .meta, e.g. to drop the fixed '
+                             'input size of older checkpoints (deploy_bundle.py --net-size); always done for checkpoints '
+                             'of the shared-trunk training graph, which has no inference branch')
+    args = parser.parse_args()
+
+    output_names = [INFERENCE_SCOPE + name for name in OUTPUTS + OPTIONAL_OUTPUTS if name not in args.skip]
+    output_path = args.output if args.output is not None else os.path.join(args.model_dir, args.model_name + '.pb')
+    with tf.Session() as sess:
+        saver = restore_saver(os.path.join(args.model_dir, args.model_name), args.rebuild, clear_devices=True)
+        saver.restore(sess, os.path.join(args.model_dir, args.model_name))
+        print('meta graph: {} nodes'.format(len(sess.graph.as_graph_def().node)))
+        frozen = freeze(sess, INPUT, output_names)
+    with tf.gfile.GFile(output_path, 'wb') as f:
+        f.write(frozen.SerializeToString())
+    print('frozen graph: {} nodes, {:.1f}MB -> {}'.format(len(frozen.node), frozen.ByteSize() / 1024. / 1024., output_path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import cv2
+from frame_store import RawFrameWriter
+
+# Frame sinks take BGR uint8 frames with write(frame) and are closed with release(), like
+# cv2.VideoWriter. open_sink() picks the backend, and by default encodes on a thread of its own.
+class MjpgSink(object):
+    # cv2.VideoWriter with MJPG, what deploy_bundle.py always wrote
+    def __init__(self, path, fps, size):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc('M','J','P','G'), fps, size)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+class FfmpegSink(object):
+    # raw BGR frames piped into an ffmpeg process; odd sizes are padded to even for yuv420p
+    def __init__(self, path, fps, size, codec='libx264', preset='veryfast', crf=23, ffmpeg='ffmpeg'):
+        self.path = path
+        cmd = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+               '-s', '{}x{}'.format(size[0], size[1]), '-r', str(fps), '-i', '-', '-an', '-c:v', codec]
+        if preset:
+            cmd += ['-preset', preset]
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        if size[0] % 2 or size[1] % 2:
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += ['-pix_fmt', 'yuv420p', path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+    def release(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        code = self.proc.wait()
+        self.proc = None
+        if code != 0:
+            raise IOError('ffmpeg exited with code {} writing {}'.format(code, self.path))
+
+class StoreSink(object):
+    # a raw frame store (frame_store.py) that downstream tools can np.memmap
+    def __init__(self, path):
+        self.writer = RawFrameWriter(path)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+class NullSink(object):
+    # drops every frame, to time everything but the encoder
+    def write(self, frame):
+        pass
+
+    def release(self):
+        pass
+
+_END = object()
+
+class ThreadedSink(object):
+    '''
+    Encodes on a thread of its own through a bounded queue of `maxsize` frames, so that encoding
+    overlaps inference and rendering. Frames must not be modified after write(). An encoder
+    error is re-raised by the next write() or by release(), which waits for the queue to drain.
+    Time spent encoding is recorded as the 'encode' stage of `timers`.
+    '''
+    def __init__(self, sink, maxsize=8, timers=None, name='encode'):
+        self.sink = sink
+        self.timers = timers
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _END:
+                break
+            if self.error is not None:
+                continue
+            try:
+                if self.timers is not None:
+                    with self.timers.stage(self.name):
+                        self.sink.write(frame)
+                else:
+                    self.sink.write(frame)
+            except Exception:
+                self.error = sys.exc_info()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[1].with_traceback(error[2])
+
+    def write(self, frame):
+        self._raise()
+        self.queue.put(frame)
+
+    def release(self):
+        if self.thread is not None:
+            self.queue.put(_END)
+            self.thread.join()
+            self.thread = None
+            try:
+                self.sink.release()
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()
+        self._raise()
+
+SINKS = ['mjpg', 'ffmpeg', 'raw', 'null']
+
+def sink_ext(kind, container='mp4'):
+    return {'mjpg': '.avi', 'ffmpeg': '.' + container, 'raw': '.raw', 'null': ''}[kind]
+
+def open_sink(kind, path, fps, size, codec='libx264', preset='veryfast', crf=23, queue_size=8, timers=None, name='encode'):
+    # path including sink_ext(kind); queue_size 0 encodes on the caller's thread
+    if kind == 'mjpg':
+        sink = MjpgSink(path, fps, size)
+    elif kind == 'ffmpeg':
+        sink = FfmpegSink(path, fps, size, codec, preset, crf)
+    elif kind == 'raw':
+        sink = StoreSink(path)
+    elif kind == 'null':
+        return NullSink()
+    else:
+        raise ValueError('unknown sink: ' + kind)
+    if queue_size > 0:
+        sink = ThreadedSink(sink, queue_size, timers, name)
+    return sink
+
+def test():
+    import tempfile
+    import shutil
+    from frame_source import open_source, iter_frames
+    rng = np.random.RandomState(0)
+    frames = [np.full((48, 64, 3), i * 20, dtype=np.uint8) + rng.randint(0, 3, (48, 64, 3)).astype(np.uint8) for i in range(7)]
+    root = tempfile.mkdtemp()
+    try:
+        kinds = ['mjpg', 'raw'] + (['ffmpeg'] if shutil.which('ffmpeg') else [])
+        for kind in kinds:
+            for queue_size in [0, 2]:
+                path = os.path.join(root, 'out{}{}'.format(queue_size, sink_ext(kind)))
+                sink = open_sink(kind, path, 30, (64, 48), queue_size=queue_size)
+                for frame in frames:
+                    sink.write(frame)
+                sink.release()
+                source = open_source(path)
+                got = list(iter_frames(source))
+                source.release()
+                assert(len(got) == len(frames))
+                for a, b in zip(got, frames):
+                    diff = np.abs(a.astype(np.int64) - b).max()
+                    assert(diff == 0 if kind == 'raw' else diff < 16)
+            print('{}: ok'.format(kind))
+        class Failing(object):
+            def write(self, frame):
+                raise IOError('disk full')
+            def release(self):
+                pass
+        sink = ThreadedSink(Failing(), 2)
+        try:
+            for frame in frames:
+                sink.write(frame)
+            sink.release()
+            assert(False)
+        except IOError:
+            pass
+        print('ok')
+    finally:
+        shutil.rmtree(root)
+
+def benchmark(n=100, size=(1280, 720)):
+    import tempfile
+    import shutil
+    from timing import Timers
+    rng = np.random.RandomState(0)
+    frame = cv2.resize(rng.randint(0, 256, (size[1] // 8, size[0] // 8, 3)).astype(np.uint8), size)
+    root = tempfile.mkdtemp()
+    try:
+        for kind in SINKS:
+            if kind == 'ffmpeg' and not shutil.which('ffmpeg'):
+                continue
+            for queue_size in [0, 8]:
+                timers = Timers()
+                path = os.path.join(root, 'out' + sink_ext(kind))
+                sink = open_sink(kind, path, 30, size, queue_size=queue_size, timers=timers)
+                start = time.time()
+                for i in range(n):
+                    # what the caller spends per frame, the rest overlaps
+                    with timers.stage('write'):
+                        sink.write(frame)
+                sink.release()
+                elapsed = time.time() - start
+                report = timers.report()
+                write_ms = [s['mean_ms'] for s in report['stages'] if s['stage'] == 'write'][0]
+                mb = os.path.getsize(path) / 1e6 if os.path.exists(path) else 0.
+                print('{:6s} queue={}: {:.1f} fps, write() {:.2f}ms, {:.1f}MB'.format(kind, queue_size, n / elapsed, write_ms, mb))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,183 @@
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from frame_store import open_frame_store, meta_path
+
+# Frame sources: read() returns the next BGR uint8 frame or None at the end, with `step - 1`
+# frames dropped between two returned frames (not before the first one). The dropped frames
+# are not decoded where the backend allows it. `fps` is the rate of the underlying stream,
+# `count` the number of frames read() will return (the container's estimate for videos).
+class VideoSource(object):
+    # a video file; dropped frames are only grab()bed, not retrieve()d
+    def __init__(self, path, step=1):
+        self.path = path
+        self.step = step
+        self.cap = cv2.VideoCapture(path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.started = False
+
+    @property
+    def count(self):
+        total = max(int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) if self.cap.isOpened() else 0
+        return (total + self.step - 1) // self.step
+
+    def read(self):
+        if self.started:
+            for i in range(self.step - 1):
+                if not self.cap.grab():
+                    return None
+        self.started = True
+        ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def release(self):
+        self.cap.release()
+
+def natural_key(name):
+    # image-2.jpg before image-10.jpg
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+class ImageDirSource(object):
+    # a directory of JPG (or PNG) frames in natural name order, decoded ahead on a thread pool
+    def __init__(self, path, step=1, threads=4, fps=30., pool=None):
+        self.path = path
+        self.step = step
+        self.fps = fps
+        self.names = sorted([name for name in os.listdir(path) if name.lower().endswith(('.jpg', '.jpeg', '.png'))],
+                            key=natural_key)
+        self.ahead = max(1, threads) * 2
+        self.own_pool = None
+        self.pool = pool
+        if self.pool is None and threads > 0:
+            self.own_pool = ThreadPoolExecutor(max_workers=threads)
+            self.pool = self.own_pool
+        self.next = 0
+        self.jobs = deque()
+
+    @property
+    def count(self):
+        return (len(self.names) + self.step - 1) // self.step
+
+    def _decode(self, i):
+        return cv2.imread(os.path.join(self.path, self.names[i]), cv2.IMREAD_COLOR)
+
+    def read(self):
+        if self.pool is None:
+            if self.next >= len(self.names):
+                return None
+            frame = self._decode(self.next)
+            self.next += self.step
+            return frame
+        while len(self.jobs) < self.ahead and self.next < len(self.names):
+            self.jobs.append(self.pool.submit(self._decode, self.next))
+            self.next += self.step
+        if len(self.jobs) == 0:
+            return None
+        return self.jobs.popleft().result()
+
+    def release(self):
+        for job in self.jobs:
+            job.cancel()
+        self.jobs.clear()
+        if self.own_pool is not None:
+            self.own_pool.shutdown(wait=True)
+            self.own_pool = None
+
+class StoreSource(object):
+    # a raw uint8 frame store (frame_store.py), memory-mapped; frames are read-only views
+    def __init__(self, path, step=1, fps=30.):
+        self.path = path
+        self.step = step
+        self.fps = fps
+        self.frames = open_frame_store(path)
+        self.next = 0
+
+    @property
+    def count(self):
+        return (self.frames.shape[0] + self.step - 1) // self.step
+
+    def read(self):
+        if self.next >= self.frames.shape[0]:
+            return None
+        frame = self.frames[self.next]
+        self.next += self.step
+        if frame.shape[2] == 1:
+            frame = cv2.cvtColor(np.asarray(frame), cv2.COLOR_GRAY2BGR)
+        return frame
+
+    def release(self):
+        self.frames = None
+
+def open_source(path, step=1, threads=4, fps=30., pool=None):
+    # a directory is an image sequence, a file with a .json sidecar a raw store, anything else a
+    # video; fps is only used where the source has no rate of its own
+    if os.path.isdir(path):
+        return ImageDirSource(path, step, threads, fps, pool)
+    if os.path.isfile(meta_path(path)):
+        return StoreSource(path, step, fps)
+    return VideoSource(path, step)
+
+def iter_frames(source, max_frames=None):
+    n = 0
+    while max_frames is None or n < max_frames:
+        frame = source.read()
+        if frame is None:
+            return
+        n += 1
+        yield frame
+
+def benchmark(path, steps=[1, 2], threads=[0, 4]):
+    # frames per second read from path
+    for step in steps:
+        for t in threads:
+            source = open_source(path, step, t)
+            start = time.time()
+            n = sum(1 for frame in iter_frames(source))
+            source.release()
+            elapsed = time.time() - start
+            print('{} step={} threads={}: {} frames, {:.1f} fps'.format(type(source).__name__, step, t, n, n / max(elapsed, 1e-8)))
+
+def test():
+    import tempfile
+    import shutil
+    from frame_store import RawFrameWriter
+    rng = np.random.RandomState(0)
+    frames = [np.full((48, 64, 3), i * 10, dtype=np.uint8) + rng.randint(0, 3, (48, 64, 3)).astype(np.uint8) for i in range(9)]
+    root = tempfile.mkdtemp()
+    try:
+        video = os.path.join(root, 'v.avi')
+        writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc('M','J','P','G'), 30, (64, 48))
+        images = os.path.join(root, 'frames')
+        os.makedirs(images)
+        store = RawFrameWriter(os.path.join(root, 'v.raw'))
+        for i, frame in enumerate(frames):
+            writer.write(frame)
+            cv2.imwrite(os.path.join(images, 'image-{}.png'.format(i + 1)), frame)
+            store.write(frame)
+        writer.release()
+        store.release()
+        for path, exact in [(video, False), (images, True), (os.path.join(root, 'v.raw'), True)]:
+            for step in [1, 2, 3]:
+                for threads in [0, 2]:
+                    source = open_source(path, step, threads)
+                    got = list(iter_frames(source))
+                    assert(source.count == len(got) == len(frames[::step]))
+                    source.release()
+                    for a, b in zip(got, frames[::step]):
+                        diff = np.abs(a.astype(np.int64) - b).max()
+                        assert(diff == 0 if exact else diff < 12)
+            print('{}: ok'.format(type(source).__name__))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    import sys
+    # python frame_source.py [video | frame directory | raw store]
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+    else:
+        test()
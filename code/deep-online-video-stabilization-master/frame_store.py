@@ -0,0 +1,112 @@
+import numpy as np
+import json
+import os
+
+# A raw frame store is a flat file of uint8 frames (count, height, width, channels)
+# plus a json sidecar holding the shape, so it can be np.memmap'ed back.
+def meta_path(path):
+    return path + '.json'
+
+def open_frame_store(path, mode='r'):
+    with open(meta_path(path), 'r') as f:
+        meta = json.load(f)
+    shape = (meta['count'], meta['height'], meta['width'], meta['channels'])
+    if meta['count'] == 0:
+        return np.zeros(shape, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode=mode, shape=shape)
+
+class RawFrameWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.shape = None
+        self.count = 0
+        self.f = open(path, 'wb')
+
+    def write(self, frame):
+        if frame.ndim == 2:
+            frame = frame[..., None]
+        if self.shape is None:
+            self.shape = frame.shape
+        assert(frame.shape == self.shape)
+        self.f.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self.count += 1
+
+    def release(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        height, width, channels = self.shape if self.shape is not None else (0, 0, 0)
+        with open(meta_path(self.path), 'w') as f:
+            json.dump({'count': self.count, 'height': height, 'width': width, 'channels': channels}, f)
+
+# Spill stores hold the warped frames of one video until the crop is known.
+# append() is called once per frame, then frames() iterates them back in order.
+class MemoryStore(object):
+    def __init__(self):
+        self.buf = []
+
+    def append(self, frame):
+        self.buf.append(frame)
+
+    def frames(self):
+        return iter(self.buf)
+
+    def close(self):
+        self.buf = []
+
+class MmapStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.writer = RawFrameWriter(path)
+
+    def append(self, frame):
+        self.writer.write(frame)
+
+    def frames(self):
+        self.writer.release()
+        store = open_frame_store(self.path)
+        for i in range(store.shape[0]):
+            yield store[i]
+
+    def close(self):
+        self.writer.release()
+        for p in [self.path, meta_path(self.path)]:
+            if os.path.exists(p):
+                os.remove(p)
+
+class RereadStore(object):
+    # frames are read back from a video that was already written, skipping the first `skip`
+    def __init__(self, path, skip=0):
+        self.path = path
+        self.skip = skip
+
+    def append(self, frame):
+        pass
+
+    def frames(self):
+        # any output frame_source.py reads: a video or a raw store
+        from frame_source import open_source
+        source = open_source(self.path)
+        try:
+            for i in range(self.skip):
+                source.read()
+            while True:
+                frame = source.read()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            source.release()
+
+    def close(self):
+        pass
+
+def make_store(kind, path, skip=0):
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'mmap':
+        return MmapStore(path)
+    if kind == 'reread':
+        return RereadStore(path, skip)
+    raise ValueError('unknown spill store: ' + kind)
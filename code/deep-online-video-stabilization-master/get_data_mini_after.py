@@ -4,14 +4,18 @@ import random
 from config import *
 import utils
 logger = utils.get_logger()
-def get_rand_para(seed): 
+# the resolution the flow of the tfrecords is stored at; frames and flow are resized to the
+# training resolution, the height / width arguments below (configs by default)
+DATA_SIZE = (width, height)
+
+def get_rand_para(seed, height=height, width=width):
     h = int(height / random_crop_rate)
     w = int(width / random_crop_rate)
     hh = tf.random_uniform([], minval=0, maxval=h - height, dtype=tf.int32, seed=seed)
     ww = tf.random_uniform([], minval=0, maxval=w - width, dtype=tf.int32, seed=seed)
     return {"h": hh, "w": ww, "flip": (hh + ww) % 2}
 
-def warp_img(image, seed, para):
+def warp_img(image, seed, para, height=height, width=width):
     h = int(height / random_crop_rate)
     w = int(width / random_crop_rate)
     image = tf.image.resize_images(image, (h, w), method=tf.image.ResizeMethod.BILINEAR)
@@ -28,7 +32,7 @@ def warp_img(image, seed, para):
 
     return tf.clip_by_value(image, -0.5, 0.5)
 
-def warp_flow(flow, para):
+def warp_flow(flow, para, height=height, width=width):
     flow_x = tf.slice(flow, [0, 0, 0], [-1, -1, 1])
     flow_y = tf.slice(flow, [0, 0, 1], [-1, -1, 1])
     h = int(height / random_crop_rate)
@@ -47,7 +51,7 @@ def warp_flow(flow, para):
     flow_y = tf.cond(tf.equal(para['flip'], 0), lambda: flow_y, lambda: fliped_y)
     return tf.concat([flow_x, flow_y], axis=2)
 
-def warp_point(points, mask, para):
+def warp_point(points, mask, para, height=height, width=width):
     h = int(height / random_crop_rate)
     w = int(width / random_crop_rate)
 
@@ -90,7 +94,7 @@ def mesh_grid(height, width):
         grid = tf.concat([x_t_flat, y_t_flat, ones], 0)
     return grid
 
-def get_rand_mask(is_first, last_H):
+def get_rand_mask(is_first, last_H, height=height, width=width):
     H = get_rand_H(is_first, last_H)
     grid = mesh_grid(height, width)
     T_g = tf.matmul(H, grid)
@@ -107,7 +111,7 @@ def get_rand_mask(is_first, last_H):
     black_pix = tf.reshape(tf.where(cond, t_1, t_0), [height, width])
     return black_pix, H
 
-def get_rand_black_mask():
+def get_rand_black_mask(height=height, width=width):
     max_dh = int(height * max_crop_rate / 2)
     max_dh = max(0, max_dh)
     max_dw = int(width * max_crop_rate / 2)
@@ -124,12 +128,12 @@ def get_rand_black_mask():
     mask = tf.reshape(mask, [height, width, 1])
     return mask 
 
-def add_mask(pics):
+def add_mask(pics, height=height, width=width):
     is_first = True
     last_H = tf.zeros([3, 3]) 
     for i in range(before_ch):
         temp = tf.reshape(tf.slice(pics, [0, 0, i], [-1, -1, 1]), [height, width])
-        mask, last_H = get_rand_mask(is_first, last_H)
+        mask, last_H = get_rand_mask(is_first, last_H, height, width)
         is_first = False
         temp = temp * (1 -  mask) + mask * -1
         temp = tf.expand_dims(temp, 2)
@@ -146,7 +150,7 @@ def add_mask(pics):
     else:
         return ans
 
-def get_img(path, pos):
+def get_img(path, pos, height=height, width=width):
     image = tf.image.decode_jpeg( tf.read_file(tf.string_join([path, tf.as_string(pos), '.jpg'])))
     image = tf.image.rgb_to_grayscale(image)
     image = tf.image.convert_image_dtype(image, dtype=tf.float32)
@@ -155,7 +159,7 @@ def get_img(path, pos):
     image = tf.reshape(image, [1, height, width, 1])
     return image
 
-def read_and_decode(filepath, num_epochs, shuffle=True):
+def read_and_decode(filepath, num_epochs, shuffle=True, height=height, width=width):
     file_obj = open(filepath + 'list.txt')
     file_txt = file_obj.read()
     file_list = []
@@ -175,18 +179,19 @@ def read_and_decode(filepath, num_epochs, shuffle=True):
                                            'feature_matches2': tf.VarLenFeature(tf.float32),
                                        })
     pos = tf.cast(features['pos'], tf.int64)
-    unstable_ = tf.concat([get_img(features['unstable_path'], pos - 1), get_img(features['unstable_path'], pos)], axis=0)
+    unstable_ = tf.concat([get_img(features['unstable_path'], pos - 1, height, width),
+                           get_img(features['unstable_path'], pos, height, width)], axis=0)
     unstable1 = []
     unstable2 = []
     stable1 = []
     stable2 = []
     for i in indices:
         if (i >= 0):
-            stable1.append(get_img(features['stable_path'], pos - 1 - i))
-            stable2.append(get_img(features['stable_path'], pos - i))
+            stable1.append(get_img(features['stable_path'], pos - 1 - i, height, width))
+            stable2.append(get_img(features['stable_path'], pos - i, height, width))
         if (i <= 0):
-            unstable1.append(get_img(features['unstable_path'], pos - 1 - i))
-            unstable2.append(get_img(features['unstable_path'], pos - i))
+            unstable1.append(get_img(features['unstable_path'], pos - 1 - i, height, width))
+            unstable2.append(get_img(features['unstable_path'], pos - i, height, width))
     stable1_ = tf.concat(stable1, axis=3)
     stable2_ = tf.concat(stable2, axis=3)
     stable_ = tf.concat([stable1_, stable2_], axis=0)
@@ -207,7 +212,7 @@ def read_and_decode(filepath, num_epochs, shuffle=True):
     logger.info('unstable_[0].shape={}'.format(unstable_[0].shape))
     stable_ = tf.concat([stable_[0], stable_[1]], axis=2)
     unstable_ = tf.concat([unstable_[0], unstable_[1]], axis=2)
-    flow_ = tf.reshape(tf.sparse_tensor_to_dense(features['flow']), [height, width, -1])[:, :, :2]
+    flow_ = tf.reshape(tf.sparse_tensor_to_dense(features['flow']), [DATA_SIZE[1], DATA_SIZE[0], -1])[:, :, :2]
 
     feature_matches1_ = tf.reshape(tf.sparse_tensor_to_dense(features['feature_matches1']), [-1, 4])
     feature_matches2_ = tf.reshape(tf.sparse_tensor_to_dense(features['feature_matches2']), [-1, 4])
@@ -226,30 +231,30 @@ def read_and_decode(filepath, num_epochs, shuffle=True):
     mask2_ = tf.sequence_mask([num_matches2_], max_matches)[0]
 
     seed = random.randint(0, 2**31 - 1)
-    para = get_rand_para(seed) 
+    para = get_rand_para(seed, height, width)
     for i in range((before_ch + 1) * 2):
         temp = tf.slice(stable_, [0, 0, i], [-1, -1, 1])
         if (i == 0):
-            stable = warp_img(temp, seed, para)
+            stable = warp_img(temp, seed, para, height, width)
         else:
-            stable = tf.concat([stable, warp_img(temp, seed, para)], 2)
+            stable = tf.concat([stable, warp_img(temp, seed, para, height, width)], 2)
     for i in range((after_ch + 1) * 2):
         temp = tf.slice(unstable_, [0, 0, i], [-1, -1, 1])
         if (i == 0):
-            unstable = warp_img(temp, seed, para)
+            unstable = warp_img(temp, seed, para, height, width)
         else:
-            unstable = tf.concat([unstable, warp_img(temp, seed, para)], 2)
+            unstable = tf.concat([unstable, warp_img(temp, seed, para, height, width)], 2)
 
-    x1 = tf.concat([add_mask(tf.slice(stable, [0, 0, 1], [-1, -1, before_ch])), 
+    x1 = tf.concat([add_mask(tf.slice(stable, [0, 0, 1], [-1, -1, before_ch]), height, width),
                     tf.slice(unstable, [0, 0, 0], [-1, -1, after_ch + 1])], 2)
     y1 = tf.slice(stable, [0, 0, 0], [-1, -1, 1])
-    x2 = tf.concat([add_mask(tf.slice(stable, [0, 0, before_ch + 2], [-1, -1, before_ch])), 
+    x2 = tf.concat([add_mask(tf.slice(stable, [0, 0, before_ch + 2], [-1, -1, before_ch]), height, width),
                     tf.slice(unstable, [0, 0, after_ch + 1], [-1, -1, after_ch + 1])], 2)
     y2 = tf.slice(stable, [0, 0, before_ch + 1], [-1, -1, 1])
 
-    flow = warp_flow(flow_, para)
-    feature_matches1, mask1 = warp_point(feature_matches1_, mask1_, para)
-    feature_matches2, mask2 = warp_point(feature_matches2_, mask2_, para)
+    flow = warp_flow(flow_, para, height, width)
+    feature_matches1, mask1 = warp_point(feature_matches1_, mask1_, para, height, width)
+    feature_matches2, mask2 = warp_point(feature_matches2_, mask2_, para, height, width)
     return x1, y1, x2, y2, flow, feature_matches1, mask1, feature_matches2, mask2
 
 def run():
@@ -0,0 +1,156 @@
+import numpy as np
+import time
+
+class InputHistory(object):
+    '''
+    Network input history of one video, kept in a preallocated float32 bank of shape
+    [slots, height, width]. Past frames and masks live in rings indexed by `head`, the
+    current (and look-ahead) frames and the optional black mask in fixed slots.
+    make_input() gathers the channels in the order deploy_bundle.py feeds them:
+        masks of before frames (input_mask), before frames, after_frames[0],
+        after frames of negative indices, black mask (if given)
+    into a preallocated [1, height, width, C] tensor, without allocating. Planes are
+    contiguous so that writing a frame is cheap; the gather and one transposing copy
+    interleave them into the channel-last input.
+    '''
+    def __init__(self, indices, height, width, input_mask=True, after_ch=1, black_mask=None):
+        self.n = max([i for i in indices if i > 0] + [1])
+        self.height = height
+        self.width = width
+        self.frame_base = 0
+        self.mask_base = self.n
+        self.after_base = 2 * self.n
+        self.black_slot = self.after_base + after_ch
+        slots = self.black_slot + (1 if black_mask is not None else 0)
+        self.bank = np.zeros([slots, height, width], dtype=np.float32)
+        if black_mask is not None:
+            self.bank[self.black_slot] = black_mask.reshape(height, width)
+        self.head = 0
+
+        # every channel is either a ring slot, base + (head - age) % n, or a fixed slot
+        # (ring base, age, fixed slot); ring base -1 marks a fixed slot
+        channels = []
+        if input_mask:
+            for i in indices:
+                if (i > 0):
+                    channels.append((self.mask_base, i - 1, 0))
+        for i in indices:
+            if (i > 0):
+                channels.append((self.frame_base, i - 1, 0))
+        channels.append((-1, 0, self.after_base))
+        for i in indices:
+            if (i < 0):
+                channels.append((-1, 0, self.after_base - i))
+        if black_mask is not None:
+            channels.append((-1, 0, self.black_slot))
+        self.channels = len(channels)
+        self.is_ring = np.array([c[0] >= 0 for c in channels])
+        self.ring_base = np.array([max(c[0], 0) for c in channels], dtype=np.int64)
+        self.ring_age = np.array([c[1] for c in channels], dtype=np.int64)
+        self.fixed = np.array([c[2] for c in channels], dtype=np.int64)
+        self.cmap = np.zeros([self.channels], dtype=np.int64)
+        self.ring_pos = np.zeros([self.channels], dtype=np.int64)
+        self.planes = np.zeros([self.channels, height, width], dtype=np.float32)
+        self.in_x = np.zeros([1, height, width, self.channels], dtype=np.float32)
+
+    def seed(self, train_frame):
+        # every past frame is the first frame and nothing is black yet
+        self.bank[self.frame_base:self.frame_base + self.n] = train_frame.reshape(1, self.height, self.width)
+        self.bank[self.mask_base:self.mask_base + self.n] = 0
+        self.head = 0
+
+    def frame(self, age=0):
+        # before_frames[-(age + 1)]
+        return self.bank[self.frame_base + (self.head - age) % self.n]
+
+    def mask(self, age=0):
+        return self.bank[self.mask_base + (self.head - age) % self.n]
+
+    def set_after(self, after_frames):
+        for k in range(len(after_frames)):
+            self.bank[self.after_base + k] = after_frames[k].reshape(self.height, self.width)
+
+    def push(self, frame=None, mask=None):
+        # advances the ring and returns the new (frame, mask) slots; the caller may write into them
+        self.head = (self.head + 1) % self.n
+        frame_slot = self.bank[self.frame_base + self.head]
+        mask_slot = self.bank[self.mask_base + self.head]
+        if frame is not None:
+            frame_slot[...] = frame.reshape(self.height, self.width)
+        if mask is not None:
+            mask_slot[...] = mask.reshape(self.height, self.width)
+        return frame_slot, mask_slot
+
+    def push_output(self, img, black):
+        # before_frames.append(img - black), before_masks.append(black)
+        frame_slot, mask_slot = self.push()
+        np.subtract(img.reshape(self.height, self.width), black.reshape(self.height, self.width), out=frame_slot)
+        mask_slot[...] = black.reshape(self.height, self.width)
+
+    def fill_frames(self, frame):
+        # every past frame becomes `frame` (--infer-with-last)
+        self.bank[self.frame_base:self.frame_base + self.n] = frame.reshape(1, self.height, self.width)
+
+    def make_input(self, out=None):
+        if out is None:
+            out = self.in_x
+        np.subtract(self.head, self.ring_age, out=self.ring_pos)
+        np.mod(self.ring_pos, self.n, out=self.ring_pos)
+        np.add(self.ring_pos, self.ring_base, out=self.ring_pos)
+        np.copyto(self.cmap, self.fixed)
+        np.copyto(self.cmap, self.ring_pos, where=self.is_ring)
+        np.take(self.bank, self.cmap, axis=0, out=self.planes, mode='clip')
+        np.copyto(out[0], self.planes.transpose(1, 2, 0))
+        return out
+
+def make_input_lists(before_masks, before_frames, after_frames, indices):
+    # the list + np.concatenate assembly deploy_bundle.py used before InputHistory
+    in_x = []
+    for i in indices:
+        if (i > 0):
+            in_x.append(before_masks[-i])
+    for i in indices:
+        if (i > 0):
+            in_x.append(before_frames[-i])
+    in_x.append(after_frames[0])
+    return np.concatenate(in_x, axis=3).copy()
+
+def benchmark(height=288, width=512, indices=[1, 2, 4, 8, 16, 32], frames=200):
+    import tracemalloc
+    n = max(indices)
+    rng = np.random.RandomState(0)
+    train = [rng.rand(1, height, width, 1) - 0.5 for i in range(8)]
+    blacks = [np.round(rng.rand(height, width) * 0.6) for i in range(8)]
+
+    def run_lists():
+        before_frames = [train[0]] * n
+        before_masks = [np.zeros([1, height, width, 1], dtype=np.float64)] * n
+        for t in range(frames):
+            in_x = make_input_lists(before_masks, before_frames, [train[t % 8]], indices)
+            before_frames.append(train[t % 8] - blacks[t % 8].reshape(1, height, width, 1))
+            before_masks.append(blacks[t % 8].reshape(1, height, width, 1))
+            before_frames.pop(0)
+            before_masks.pop(0)
+        return in_x
+
+    history = InputHistory(indices, height, width)
+    history.seed(train[0])
+    def run_ring():
+        for t in range(frames):
+            history.set_after([train[t % 8]])
+            in_x = history.make_input()
+            history.push_output(train[t % 8], blacks[t % 8])
+        return in_x
+
+    assert(np.allclose(run_lists(), run_ring(), atol=1e-6))
+    for name, fn in [('lists', run_lists), ('ring', run_ring)]:
+        tracemalloc.start()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:6s}: {:.2f}ms/frame, peak traced allocation {:.1f}MB'.format(name, elapsed * 1000 / frames, peak / 1024. / 1024.))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import time
+import numpy as np
+from config import *
+from stabilizer import Model, Stabilizer, KEYFRAME_GAP
+from mesh_warp import hs_to_vertices
+from frame_source import open_source, iter_frames
+from render import parse_size
+
+# Runs every video of the test lists once with the network on every frame (--refine times) and once
+# per keyframe, adaptive refine or network resolution setting, and reports the speedup of the mesh
+# estimation against how much the meshes move:
+#   delta      mean distance (pixels, at the config resolution) of the vertices to those of the full run
+#   stability  mean |second difference| of the vertex trajectories (pixels / frame^2), lower is smoother
+#   distortion mean over frames of the worst cell's singular value ratio of its affine part (1 = no shear)
+parser = argparse.ArgumentParser()
+parser.add_argument('--model-dir')
+parser.add_argument('--model-name')
+parser.add_argument('--frozen-graph', default=None)
+parser.add_argument('--gpu_memory_fraction', type=float, default=0.1)
+parser.add_argument('--test-list', nargs='+', default=['data_video/test_list'])
+parser.add_argument('--prefix', default='data_video')
+parser.add_argument('--refine', type=int, default=1)
+parser.add_argument('--strides', type=int, nargs='+', default=[2, 4])
+parser.add_argument('--thresholds', type=float, nargs='*', default=[0.02])
+# adaptive --refine settings, compared with the fixed --refine run
+parser.add_argument('--refine-tols', type=float, nargs='*', default=[])
+parser.add_argument('--refine-budget-ms', type=float, default=None)
+# WxH network resolutions, compared with the full run at the config's (needs a graph from export_graph.py --rebuild)
+parser.add_argument('--net-sizes', nargs='*', default=[])
+parser.add_argument('--max-frames', type=int, default=None)
+
+def read_video(path, max_frames=None):
+    source = open_source(path)
+    frames = list(iter_frames(source, max_frames))
+    source.release()
+    return frames
+
+def run(model, frames, refine, stride=None, threshold=None, refine_tol=None, refine_budget=None, net_size=None):
+    # the meshes of every frame after the first, the time spent computing them and the network runs
+    stabilizer = Stabilizer(model, refine=refine, keyframe_stride=stride, keyframe_threshold=threshold,
+                            refine_tol=refine_tol, refine_budget=refine_budget, net_size=net_size)
+    stabilizer.start(frames[0])
+    Hs = []
+    start = time.time()
+    for frame in frames[1:]:
+        item = stabilizer.feed(frame)
+        if item is not None:
+            Hs.extend([result[1] for result in stabilizer.step(item)])
+    Hs.extend([result[1] for result in stabilizer.flush()])
+    elapsed = time.time() - start
+    stabilizer.close()
+    runs = sum(k * n for k, n in stabilizer.refine_counts.items())
+    return np.stack([hs_to_vertices(h) for h in Hs]), np.stack(Hs), elapsed, runs
+
+def to_pixels(vertices):
+    return (vertices + 1) * np.array([width / 2., height / 2.])
+
+def stability(vertices):
+    v = to_pixels(vertices)
+    if len(v) < 3:
+        return 0.
+    return np.mean(np.linalg.norm(v[2:] - 2 * v[1:-1] + v[:-2], axis=-1))
+
+def distortion(Hs):
+    # affine part of every cell in pixel units
+    A = Hs.reshape(Hs.shape[:3] + (3, 3))[..., :2, :2] * np.array([[1., float(width) / height], [float(height) / width, 1.]])
+    # degenerate meshes (e.g. of an untrained checkpoint) count as nan instead of failing the SVD
+    finite = np.isfinite(A).all(axis=(-2, -1))
+    ratio = np.full(A.shape[:-2], np.nan)
+    s = np.linalg.svd(A[finite], compute_uv=False)
+    ratio[finite] = s[..., 1] / np.maximum(s[..., 0], 1e-8)
+    return np.mean(ratio.reshape(len(Hs), -1).min(axis=1))
+
+def main():
+    args = parser.parse_args()
+    model = Model(args.model_dir, args.model_name, args.frozen_graph, args.gpu_memory_fraction)
+    video_list = []
+    for list_path in args.test_list:
+        if os.path.isfile(list_path):
+            with open(list_path, 'r') as f:
+                video_list.extend([name for name in f.read().split('\n') if name != ''])
+    budget = args.refine_budget_ms / 1000. if args.refine_budget_ms is not None else None
+    settings = [('stride {}'.format(stride), {'stride': stride}) for stride in args.strides]
+    # a threshold keyframes at the latest after the longest stride (KEYFRAME_GAP if no stride is > 1)
+    gap = max(args.strides) if max(args.strides) > 1 else KEYFRAME_GAP
+    settings += [('threshold {} (max stride {})'.format(t, gap), {'stride': gap, 'threshold': t})
+                 for t in args.thresholds]
+    settings += [('refine tol {}px'.format(tol), {'refine_tol': tol, 'refine_budget': budget}) for tol in args.refine_tols]
+    settings += [('net {}'.format(size), {'net_size': parse_size(size, None, None)}) for size in args.net_sizes]
+    totals = {}
+    for video_name in video_list:
+        frames = read_video(os.path.join(args.prefix, 'unstable', video_name), args.max_frames)
+        if len(frames) < 2:
+            continue
+        full_vertices, full_Hs, full_time, full_runs = run(model, frames, args.refine)
+        rows = [('full', full_time, full_runs, 0., stability(full_vertices), distortion(full_Hs))]
+        for name, setting in settings:
+            vertices, Hs, elapsed, runs = run(model, frames, args.refine, **setting)
+            delta = np.mean(np.linalg.norm(to_pixels(vertices) - to_pixels(full_vertices), axis=-1))
+            rows.append((name, elapsed, runs, delta, stability(vertices), distortion(Hs)))
+        print('{}: {} frames'.format(video_name, len(frames)))
+        for name, elapsed, runs, delta, stab, dist in rows:
+            print('  {:32s} speedup {:.2f}x ({:.1f} fps), {} network runs, delta {:.2f}px, stability {:.3f}, distortion {:.4f}'.format(
+                name, full_time / max(elapsed, 1e-8), (len(frames) - 1) / max(elapsed, 1e-8), runs, delta, stab, dist))
+            total = totals.setdefault(name, [0., 0, 0., 0., 0., 0, 0])
+            total[0] += elapsed
+            total[1] += runs
+            total[2] += delta
+            total[3] += stab
+            total[4] += dist
+            total[5] += 1
+            total[6] += len(frames) - 1
+    if 'full' in totals:
+        print('all videos:')
+        full_time = totals['full'][0]
+        for name, (elapsed, runs, delta, stab, dist, n, count) in totals.items():
+            print('  {:32s} speedup {:.2f}x ({:.1f} fps), {} network runs, delta {:.2f}px, stability {:.3f}, distortion {:.4f}'.format(
+                name, full_time / max(elapsed, 1e-8), count / max(elapsed, 1e-8), runs, delta / n, stab / n, dist / n))
+    model.close()
+
+if __name__ == '__main__':
+    main()
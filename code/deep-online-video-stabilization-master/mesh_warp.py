@@ -0,0 +1,280 @@
+import numpy as np
+import cv2
+import math
+import time
+
+# NumPy version of the mesh warp in spatial_transformer3._transform3. Hs[i, j] maps normalized
+# output coordinates of cell (i, j) to normalized source coordinates; cells are
+# floor(height / grid_h) x floor(width / grid_w) net pixels, the last row / column of cells
+# absorbs the remainder. Coordinates are given as (fractional) net pixel positions, so the
+# maps can be evaluated at net resolution or directly on a coarser / finer lattice.
+
+def cell_index(pos, size, cells):
+    # cell of every net pixel position along one axis
+    g = int(math.floor(size / cells))
+    return np.minimum(np.floor(pos / g), cells - 1).astype(np.int64)
+
+def mesh_maps(Hs, height, width, rows, cols, align_corners=True):
+    '''
+    Hs: [grid_h, grid_w, 9] (or [grid_h, grid_w, 3, 3]), rows / cols: sorted net pixel positions.
+    Returns normalized float32 x_map, y_map of shape [len(rows), len(cols)]. Runs one band of
+    rows per row of cells, with the homography of every column gathered from its cell, so the
+    cost grows with grid_h only. Pixel p is normalized like linspace(-1, 1, size), or like
+    p * 2 / size - 1 with align_corners=False.
+    '''
+    grid_h, grid_w = Hs.shape[:2]
+    Hs = np.asarray(Hs, dtype=np.float32).reshape(grid_h, grid_w, 9)
+    dx, dy = (width - 1, height - 1) if align_corners else (width, height)
+    x = np.asarray(cols, dtype=np.float32) * np.float32(2. / dx) - 1
+    y = (np.asarray(rows, dtype=np.float32) * np.float32(2. / dy) - 1)[:, None]
+    row_cells = cell_index(rows, height, grid_h)
+    bounds = np.searchsorted(row_cells, np.arange(grid_h + 1))
+    # [9, grid_h, len(cols)] coefficients of every column
+    h = Hs[:, cell_index(cols, width, grid_w)].transpose(2, 0, 1).copy()
+    x_map = np.empty([len(rows), len(cols)], dtype=np.float32)
+    y_map = np.empty([len(rows), len(cols)], dtype=np.float32)
+    for i in range(grid_h):
+        r0, r1 = bounds[i], bounds[i + 1]
+        if r1 == r0:
+            continue
+        yi = y[r0:r1]
+        c = h[:, i]
+        # T_g = H * [x, y, 1]
+        z = c[7] * yi + (c[6] * x + c[8])
+        z += np.where(z >= 0, np.float32(1e-8), np.float32(-1e-8))
+        np.divide(c[1] * yi + (c[0] * x + c[2]), z, out=x_map[r0:r1])
+        np.divide(c[4] * yi + (c[3] * x + c[5]), z, out=y_map[r0:r1])
+    return x_map, y_map
+
+def net_maps(Hs, height, width):
+    # the x_map / y_map tensors of the inference graph, [height, width]
+    return mesh_maps(Hs, height, width, np.arange(height), np.arange(width))
+
+_lattices = {}
+
+def small_lattice(height, width, grid_h, grid_w, rate):
+    '''
+    The centres of the pixels of the height x width net maps shrunk by rate, as cv2.resize maps
+    them: normalized float32 x [1, small_w], y [small_h, 1] and the flat index of the mesh cell
+    of every low-res pixel [small_h, small_w]. Cached, it only depends on the sizes.
+    '''
+    key = (height, width, grid_h, grid_w, rate)
+    if key not in _lattices:
+        small_h, small_w = int(height / rate), int(width / rate)
+        rows = np.maximum((np.arange(small_h) + 0.5) * (float(height) / small_h) - 0.5, 0)
+        cols = np.maximum((np.arange(small_w) + 0.5) * (float(width) / small_w) - 0.5, 0)
+        x = (cols * (2. / (width - 1)) - 1).astype(np.float32)[None]
+        y = (rows * (2. / (height - 1)) - 1).astype(np.float32)[:, None]
+        cells = cell_index(rows, height, grid_h)[:, None] * grid_w + cell_index(cols, width, grid_w)[None]
+        _lattices[key] = (x, y, cells)
+    return _lattices[key]
+
+def smooth_maps(Hs, height, width, rate=4, out_size=None):
+    '''
+    The net maps evaluated straight at width / rate x height / rate, with the homography of every
+    low-res pixel gathered from its cell, so the cost does not grow with the grid. Upsampling the
+    result once gives the smoothed maps the original deploy built with a down- and an up-resize of
+    the full maps (as close to the exact maps, see test()). With out_size (width, height) the maps
+    are pixel coordinates of a frame of that size instead of normalized ones, the scaling is
+    folded into the homographies.
+    '''
+    grid_h, grid_w = Hs.shape[:2]
+    Hs = np.asarray(Hs, dtype=np.float64).reshape(grid_h, grid_w, 3, 3)
+    if out_size is not None:
+        scale_mat = np.array([[out_size[0] / 2., 0, out_size[0] / 2.], [0, out_size[1] / 2., out_size[1] / 2.], [0, 0, 1]])
+        Hs = np.matmul(scale_mat, Hs)
+    x, y, cells = small_lattice(height, width, grid_h, grid_w, rate)
+    # [9, small_h, small_w] coefficients of every low-res pixel
+    c = np.take(Hs.reshape(-1, 9).T.astype(np.float32), cells, axis=1)
+    # T_g = H * [x, y, 1]
+    z = c[6] * x
+    z += c[7] * y
+    z += c[8]
+    z += np.where(z >= 0, np.float32(1e-8), np.float32(-1e-8))
+    maps = []
+    for k in [0, 3]:
+        m = c[k] * x
+        m += c[k + 1] * y
+        m += c[k + 2]
+        m /= z
+        maps.append(m)
+    return maps[0], maps[1]
+
+def transform3_maps(Hs, height, width):
+    # reference: the cell by cell loop of _transform3
+    grid_h, grid_w = Hs.shape[:2]
+    Hs = np.asarray(Hs, dtype=np.float64).reshape(grid_h, grid_w, 3, 3)
+    gh = int(math.floor(height / grid_h))
+    gw = int(math.floor(width / grid_w))
+    lin_x = np.linspace(-1.0, 1.0, width)
+    lin_y = np.linspace(-1.0, 1.0, height)
+    x_map = np.zeros([height, width])
+    y_map = np.zeros([height, width])
+    for i in range(grid_h):
+        for j in range(grid_w):
+            sh, eh = i * gh, (i + 1) * gh - 1
+            sw, ew = j * gw, (j + 1) * gw - 1
+            if (i == grid_h - 1):
+                eh = height - 1
+            if (j == grid_w - 1):
+                ew = width - 1
+            x_t, y_t = np.meshgrid(lin_x[sw:ew + 1], lin_y[sh:eh + 1])
+            grid = np.stack([x_t.flatten(), y_t.flatten(), np.ones(x_t.size)])
+            T_g = np.matmul(Hs[i, j], grid)
+            z = T_g[2] + (np.where(T_g[2] >= 0, 1., 0.) * 2 - 1) * 1e-8
+            x_map[sh:eh + 1, sw:ew + 1] = (T_g[0] / z).reshape(x_t.shape)
+            y_map[sh:eh + 1, sw:ew + 1] = (T_g[1] / z).reshape(x_t.shape)
+    return x_map.astype(np.float32), y_map.astype(np.float32)
+
+def get_H(ori, tar):
+    # NumPy get_H of spatial_transformer3: ori, tar [..., 8] corner lists -> [..., 9]
+    x, y = ori[..., 0::2], ori[..., 1::2]
+    u, v = tar[..., 0::2], tar[..., 1::2]
+    one, zero = np.ones_like(x), np.zeros_like(x)
+    A = np.concatenate([np.stack([x, y, one, zero, zero, zero, -x * u, -y * u], axis=-1),
+                        np.stack([zero, zero, zero, x, y, one, -x * v, -y * v], axis=-1)], axis=-2)
+    b = np.concatenate([u, v], axis=-1)[..., None]
+    h = np.matmul(np.linalg.inv(A + np.eye(8) * 1e-4), b)[..., 0]
+    return np.concatenate([h, np.ones(h.shape[:-1] + (1, ))], axis=-1)
+
+def vertices_to_hs(vertices):
+    # [grid_h + 1, grid_w + 1, 2] normalized mesh vertices (the network's theta) -> Hs [grid_h, grid_w, 9]
+    regular = regular_vertices(vertices.shape[0] - 1, vertices.shape[1] - 1)
+    def corners(v):
+        return np.concatenate([v[:-1, :-1], v[:-1, 1:], v[1:, :-1], v[1:, 1:]], axis=-1)
+    return get_H(corners(regular), corners(np.asarray(vertices, dtype=np.float64)))
+
+def regular_vertices(grid_h, grid_w):
+    # vertices of the identity mesh
+    return np.stack(np.meshgrid(np.linspace(-1, 1, grid_w + 1), np.linspace(-1, 1, grid_h + 1)), axis=-1)
+
+def hs_to_vertices(Hs):
+    # Hs [grid_h, grid_w, 9] -> [grid_h + 1, grid_w + 1, 2] vertices, every regular corner mapped by the
+    # homographies of its cells and averaged (they agree up to the 1e-4 damping of get_H)
+    grid_h, grid_w = Hs.shape[:2]
+    Hs = np.asarray(Hs, dtype=np.float64).reshape(grid_h, grid_w, 3, 3)
+    regular = regular_vertices(grid_h, grid_w)
+    points = np.concatenate([regular, np.ones([grid_h + 1, grid_w + 1, 1])], axis=-1)
+    total = np.zeros([grid_h + 1, grid_w + 1, 2])
+    count = np.zeros([grid_h + 1, grid_w + 1, 1])
+    for di in [0, 1]:
+        for dj in [0, 1]:
+            # cell (i, j) has corner (i + di, j + dj)
+            p = np.matmul(Hs, points[di:di + grid_h, dj:dj + grid_w, :, None])[..., 0]
+            total[di:di + grid_h, dj:dj + grid_w] += p[..., :2] / p[..., 2:]
+            count[di:di + grid_h, dj:dj + grid_w] += 1
+    return total / count
+
+def vertex_shift(Hs0, Hs1, height, width):
+    # how far (pixels of a height x width frame) the mesh vertices of Hs1 are from those of Hs0, the max over vertices
+    d = (hs_to_vertices(Hs1) - hs_to_vertices(Hs0)) * np.array([width / 2., height / 2.])
+    return np.sqrt((d ** 2).sum(-1)).max()
+
+def warp_net_frame(frame, Hs):
+    '''
+    What the inference graph's output_img and black_pix are for Hs: frame [height, width] (or a
+    [1, height, width, 1] train frame) sampled at the net maps like _interpolate (clamped borders), and the pixels whose
+    source lies outside [-1, 1].
+    '''
+    frame = np.squeeze(frame)
+    height, width = frame.shape
+    x_map, y_map = net_maps(Hs, height, width)
+    black = ((x_map < -1) | (x_map > 1) | (y_map < -1) | (y_map > 1)).astype(np.float32)
+    x_map += 1
+    x_map *= width / 2.
+    y_map += 1
+    y_map *= height / 2.
+    img = cv2.remap(frame.astype(np.float32), x_map, y_map, cv2.INTER_LINEAR,
+                    borderMode=cv2.BORDER_REPLICATE)
+    return img, black
+
+def random_vertices(grid_h, grid_w, rng, shake=0.05):
+    vertices = regular_vertices(grid_h, grid_w)
+    # a global similarity plus per-vertex jitter
+    angle, scale = rng.uniform(-0.05, 0.05), rng.uniform(0.9, 1.0)
+    rot = np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]) * scale
+    vertices = np.matmul(vertices, rot.T) + rng.uniform(-0.05, 0.05, [2])
+    return vertices + rng.uniform(-shake, shake, vertices.shape)
+
+def test():
+    height, width = 288, 512
+    rng = np.random.RandomState(0)
+    for grid_h, grid_w in [(4, 4), (8, 8), (3, 5)]:
+        Hs = vertices_to_hs(random_vertices(grid_h, grid_w, rng))
+        ref_x, ref_y = transform3_maps(Hs, height, width)
+        x_map, y_map = net_maps(Hs, height, width)
+        assert(np.abs(x_map - ref_x).max() < 1e-5 and np.abs(y_map - ref_y).max() < 1e-5)
+        # the low-res maps sampled straight from Hs, upsampled, vs the original down + up resize
+        # of the full maps: as close to the exact maps, and the same (pixels) but where the resize
+        # blends two cells
+        small_x, small_y = smooth_maps(Hs, height, width)
+        size = (width, height)
+        for small, ref, scale in [(small_x, ref_x, width / 2.), (small_y, ref_y, height / 2.)]:
+            old = cv2.resize(cv2.resize(ref, (int(width / 4), int(height / 4))), size)
+            new = cv2.resize(small, size)
+            assert(np.abs(new - ref).mean() < np.abs(old - ref).mean() * 1.01)
+            assert(np.percentile(np.abs(new - old), 95) * scale < 0.01)
+        # pixel coordinates of another frame size folded into Hs
+        pix_x, pix_y = smooth_maps(Hs, height, width, out_size=(1920, 1080))
+        assert(np.abs(pix_x - (small_x + 1) * 960).max() < 1e-2 and np.abs(pix_y - (small_y + 1) * 540).max() < 1e-2)
+    # vertices of an identity mesh give identity maps
+    Hs = vertices_to_hs(regular_vertices(4, 4))
+    x_map, y_map = net_maps(Hs, height, width)
+    x_t, y_t = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    assert(np.abs(x_map - x_t).max() < 1e-3 and np.abs(y_map - y_t).max() < 1e-3)
+    # vertices survive the round trip through Hs
+    vertices = random_vertices(4, 4, rng)
+    assert(np.abs(hs_to_vertices(vertices_to_hs(vertices)) - vertices).max() < 1e-3)
+    print('mesh_warp: ok')
+
+def fetch_times(height=288, width=512, grid=4, frames=200):
+    # ms per session run of the transformer fetching Hs vs the full x_map / y_map, None without TensorFlow
+    try:
+        import tensorflow as tf
+        from spatial_transformer3 import transformer
+    except ImportError:
+        return None
+    rng = np.random.RandomState(0)
+    graph = tf.Graph()
+    with graph.as_default():
+        U = tf.placeholder(tf.float32, [1, height, width, 1])
+        theta = tf.placeholder(tf.float32, [1, grid + 1, grid + 1, 2])
+        transformer(U, theta)
+        def tensor(name):
+            return graph.get_tensor_by_name('SpatialTransformer/_transform/' + name + ':0')
+        fetches = [[tensor('output_img'), tensor('black_pix'), tensor('get_Hs/Hs')],
+                   [tensor('output_img'), tensor('black_pix'), tensor('x_map'), tensor('y_map')]]
+        feed = {U: rng.rand(1, height, width, 1), theta: random_vertices(grid, grid, rng)[None]}
+        times = [[], []]
+        with tf.Session(graph=graph) as sess:
+            for t in range(frames):
+                for k in range(2):
+                    start = time.time()
+                    sess.run(fetches[k], feed)
+                    times[k].append(time.time() - start)
+    return [np.median(t) * 1000 for t in times]
+
+def benchmark(height=288, width=512, frames=200):
+    # per frame: session run + pixel maps of the renderer, fetching x_map / y_map vs fetching Hs
+    from render import Renderer
+    rng = np.random.RandomState(0)
+    Hs = vertices_to_hs(random_vertices(4, 4, rng))
+    x_map, y_map = net_maps(Hs, height, width)
+    fetch = fetch_times(height, width) or [0, 0]
+    for out_size in [(width, height), (1920, 1080)]:
+        renderer = Renderer(out_size[0], out_size[1], bands=1, net_size=(width, height))
+        times = []
+        for fn, args in [(renderer.pixel_maps, (x_map, y_map)), (renderer.hs_maps, (Hs, ))]:
+            t = []
+            for k in range(frames):
+                start = time.time()
+                fn(*args)
+                t.append(time.time() - start)
+            times.append(np.median(t) * 1000)
+        renderer.close()
+        print('{}x{} output: x_map / y_map {:.2f}ms + {:.3f}ms maps, Hs {:.2f}ms + {:.3f}ms maps (session run + maps per frame)'.format(
+            out_size[0], out_size[1], fetch[1], times[0], fetch[0], times[1]))
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,123 @@
+import threading
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+class Prefetcher(object):
+    '''
+    Runs `iterable` in a background thread and keeps up to `maxsize` of its items
+    waiting in a bounded queue. Iterating the Prefetcher yields the items in order;
+    an exception raised by `iterable` is re-raised in the consumer.
+    '''
+    def __init__(self, iterable, maxsize=8, name='stage'):
+        self.name = name
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.done = False
+        self.error = None
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.gets = 0
+        self.thread = threading.Thread(target=self._run, args=(iterable,), name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self._put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        depth = self.queue.qsize()
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.gets += 1
+        item = self.queue.get()
+        if item is _END:
+            self.done = True
+            if self.error is not None:
+                raise self.error[1].with_traceback(self.error[2])
+            raise StopIteration
+        return item
+
+    next = __next__
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {'name': self.name, 'size': self.maxsize, 'depth': self.depth(), 'max': self.depth_max,
+                'mean': float(self.depth_sum) / max(self.gets, 1)}
+
+    def close(self):
+        # stop the producer, unblock it if it waits on a full queue and wake up a waiting consumer
+        self.stopped.set()
+        while True:
+            self._drain()
+            self.thread.join(0.1)
+            if not self.thread.is_alive():
+                break
+        self._drain()
+        self.queue.put(_END)
+
+    def _drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+class OrderedMap(object):
+    '''
+    Applies `fn` to the items of `iterable` on `workers` threads and yields the results
+    in input order. `iterable` itself is consumed by a feeder thread, and at most
+    `maxsize` results are in flight ahead of the consumer.
+    '''
+    def __init__(self, fn, iterable, workers=2, maxsize=8, name='map'):
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.feeder = Prefetcher((self.pool.submit(fn, item) for item in iterable), maxsize, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.feeder).result()
+
+    next = __next__
+
+    def depth(self):
+        return self.feeder.depth()
+
+    def stats(self):
+        return self.feeder.stats()
+
+    def close(self):
+        self.feeder.close()
+        self.pool.shutdown(wait=True)
+
+def format_stats(stages):
+    return ' '.join(['{}={}/{} (mean {:.1f}, max {})'.format(s['name'], s['depth'], s['size'], s['mean'], s['max'])
+                     for s in [stage.stats() for stage in stages]])
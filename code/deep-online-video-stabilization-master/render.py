@@ -0,0 +1,201 @@
+import numpy as np
+import cv2
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mesh_warp import smooth_maps, net_maps, vertices_to_hs, random_vertices
+
+class Renderer(object):
+    '''
+    Warps frames with the network's normalized sampling maps (x_map / y_map in [-1, 1],
+    at network resolution) at any output resolution. Like the original deploy the maps are
+    smoothed by going down `rate` times first; they are then upsampled straight to the
+    output size, converted to fixed point (CV_16SC2) and remapped in row bands on a
+    thread pool (cv2 releases the GIL). render_hs() builds the smoothed maps from the mesh
+    homographies instead, which needs the network resolution `net_size`.
+    '''
+    def __init__(self, out_width, out_height, rate=4, bands=4, pool=None, net_size=None):
+        self.out_width = out_width
+        self.out_height = out_height
+        self.net_size = net_size
+        self.rate = rate
+        self.bands = max(1, bands)
+        self.pool = pool
+        self.own_pool = None
+        if self.pool is None and self.bands > 1:
+            self.own_pool = ThreadPoolExecutor(max_workers=self.bands)
+            self.pool = self.own_pool
+        rows = np.linspace(0, out_height, self.bands + 1).astype(np.int64)
+        self.rows = [(rows[i], rows[i + 1]) for i in range(self.bands) if rows[i + 1] > rows[i]]
+
+    def pixel_maps(self, x_map, y_map):
+        # normalized net-resolution maps -> float32 pixel coordinates at output resolution
+        height, width = x_map.shape[:2]
+        small = (int(width / self.rate), int(height / self.rate))
+        return self.upsample(cv2.resize(x_map, small), cv2.resize(y_map, small))
+
+    def upsample(self, x_map, y_map):
+        # smoothed low-resolution normalized maps -> float32 pixel coordinates at output resolution
+        size = (self.out_width, self.out_height)
+        x_map = cv2.resize(x_map, size)
+        y_map = cv2.resize(y_map, size)
+        x_map = (x_map + 1) * (self.out_width / 2.)
+        y_map = (y_map + 1) * (self.out_height / 2.)
+        return x_map, y_map
+
+    def hs_maps(self, Hs):
+        # Hs of the network -> float32 pixel coordinates at output resolution, scaled at 1 / rate
+        net_width, net_height = self.net_size
+        size = (self.out_width, self.out_height)
+        x_map, y_map = smooth_maps(Hs, net_height, net_width, self.rate, out_size=size)
+        return cv2.resize(x_map, size), cv2.resize(y_map, size)
+
+    def _remap_band(self, img, x_map, y_map, dst, r0, r1):
+        map1, map2 = cv2.convertMaps(x_map[r0:r1], y_map[r0:r1], cv2.CV_16SC2)
+        dst[r0:r1] = cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    def remap(self, img, x_map, y_map):
+        # img and the pixel maps are at output resolution
+        dst = np.empty((self.out_height, self.out_width) + img.shape[2:], dtype=img.dtype)
+        if self.pool is None or len(self.rows) == 1:
+            for r0, r1 in self.rows:
+                self._remap_band(img, x_map, y_map, dst, r0, r1)
+        else:
+            jobs = [self.pool.submit(self._remap_band, img, x_map, y_map, dst, r0, r1) for r0, r1 in self.rows]
+            for job in jobs:
+                job.result()
+        return dst
+
+    def render(self, frame, x_map, y_map):
+        # frame at any resolution, x_map / y_map normalized at network resolution
+        if frame.shape[:2] != (self.out_height, self.out_width):
+            frame = cv2.resize(frame, (self.out_width, self.out_height))
+        x_map, y_map = self.pixel_maps(x_map, y_map)
+        return self.remap(frame, x_map, y_map)
+
+    def render_hs(self, frame, Hs):
+        # frame at any resolution, Hs [grid_h, grid_w, 9] of the network
+        if frame.shape[:2] != (self.out_height, self.out_width):
+            frame = cv2.resize(frame, (self.out_width, self.out_height))
+        x_map, y_map = self.hs_maps(Hs)
+        return self.remap(frame, x_map, y_map)
+
+    def close(self):
+        if self.own_pool is not None:
+            self.own_pool.shutdown(wait=True)
+
+def parse_size(size, net_size, source_size):
+    # 'net', 'source' or 'WxH' -> (width, height)
+    if size == 'net':
+        return net_size
+    if size == 'source':
+        return source_size
+    w, h = size.lower().split('x')
+    return (int(w), int(h))
+
+def warp_rev_bundle2(img, x_map, y_map, width, height):
+    # reference: the remap of the original deploy_bundle.py, at the config resolution
+    rate = 4
+    x_map = cv2.resize(cv2.resize(x_map, (int(width / rate), int(height / rate))), (width, height))
+    y_map = cv2.resize(cv2.resize(y_map, (int(width / rate), int(height / rate))), (width, height))
+    x_map = (x_map + 1) / 2 * width
+    y_map = (y_map + 1) / 2 * height
+    return cv2.remap(img, x_map, y_map, cv2.INTER_LINEAR)
+
+def warp_rev_bundle_tiles(img, Hs):
+    # reference: the exact warp of the original deploy_bundle.py, one full-frame warpPerspective per cell
+    height, width = img.shape[:2]
+    grid_h, grid_w = Hs.shape[:2]
+    scale_mat = np.eye(3)
+    scale_mat[0, 0] = width / 2.
+    scale_mat[0, 2] = width / 2.
+    scale_mat[1, 1] = height / 2.
+    scale_mat[1, 2] = height / 2.
+    Hs_cvt = np.matmul(np.matmul(scale_mat, Hs.reshape(grid_h, grid_w, 3, 3)), np.linalg.inv(scale_mat))
+    gh = int(math.floor(height / grid_h))
+    gw = int(math.floor(width / grid_w))
+    img_ = []
+    for i in range(grid_h):
+        row_img_ = []
+        for j in range(grid_w):
+            sh, eh = i * gh, (i + 1) * gh - 1
+            sw, ew = j * gw, (j + 1) * gw - 1
+            if (i == grid_h - 1):
+                eh = height - 1
+            if (j == grid_w - 1):
+                ew = width - 1
+            temp = cv2.warpPerspective(img, Hs_cvt[i, j], dsize=(width, height), flags=cv2.WARP_INVERSE_MAP|cv2.INTER_LINEAR)
+            row_img_.append(temp[sh:eh+1, sw:ew+1])
+        img_.append(np.concatenate(row_img_, axis=1))
+    return np.concatenate(img_, axis=0)
+
+def test():
+    height, width = 288, 512
+    rng = np.random.RandomState(0)
+    # smooth content: fixed-point maps are exact to 1/32 pixel, which only shows on pixel noise
+    img = cv2.GaussianBlur((rng.rand(height, width, 3) * 255).astype(np.uint8), (0, 0), 2)
+    x, y = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    x_map = (x * 0.9 + 0.05 * y + 0.02).astype(np.float32)
+    y_map = (y * 0.95 - 0.03 * x).astype(np.float32)
+    renderer = Renderer(width, height, bands=3)
+    out = renderer.render(img, x_map, y_map)
+    ref = warp_rev_bundle2(img, x_map, y_map, width, height)
+    assert(np.abs(out.astype(np.int32) - ref).max() <= 2)
+    # a 2x source rendered at 2x matches the net-resolution render upsampled
+    big = cv2.resize(img, (width * 2, height * 2), interpolation=cv2.INTER_NEAREST)
+    out2 = Renderer(width * 2, height * 2, bands=5).render(big, x_map, y_map)
+    assert(out2.shape == (height * 2, width * 2, 3))
+    diff = np.abs(cv2.resize(out2, (width, height), interpolation=cv2.INTER_AREA).astype(np.float64) - out)
+    assert(diff[8:-8, 8:-8].mean() < 8), diff.mean()
+    # maps built from Hs vs the net maps of the same mesh
+    Hs = vertices_to_hs(random_vertices(4, 4, rng))
+    x_map, y_map = net_maps(Hs, height, width)
+    renderer = Renderer(width, height, bands=3, net_size=(width, height))
+    diff = np.abs(renderer.render_hs(img, Hs).astype(np.int32) - renderer.render(img, x_map, y_map))
+    # away from the black border, where a 1/32 pixel rounding step blends in a different amount of it
+    map_x, map_y = renderer.pixel_maps(x_map, y_map)
+    inside = (map_x >= 1) & (map_x <= width - 2) & (map_y >= 1) & (map_y <= height - 2)
+    assert(diff[inside].max() <= 2), diff[inside].max()
+    renderer.close()
+    # render_hs vs the tile by tile warpPerspective of the original deploy, at net and 1080p output. The
+    # network normalizes pixels like linspace(-1, 1, size), the tiles like p * 2 / size - 1, which puts
+    # the two up to a net pixel apart at the borders, and the maps are smoothed at 1 / rate: close on
+    # average, a few levels on edges, away from a 2 net pixel margin of the black border
+    img = cv2.GaussianBlur((rng.rand(height, width, 3) * 255).astype(np.uint8), (0, 0), 4)
+    for grid_h, grid_w in [(4, 4), (8, 8), (16, 16), (3, 5)]:
+        Hs = vertices_to_hs(random_vertices(grid_h, grid_w, rng, shake=0.2 / max(grid_h, grid_w)))
+        for out_width, out_height in [(width, height), (1920, 1080)]:
+            frame = cv2.resize(img, (out_width, out_height))
+            renderer = Renderer(out_width, out_height, bands=3, net_size=(width, height))
+            diff = np.abs(renderer.render_hs(frame, Hs).astype(np.int32) - warp_rev_bundle_tiles(frame, Hs))
+            map_x, map_y = renderer.hs_maps(Hs)
+            mx, my = 2. * out_width / width, 2. * out_height / height
+            inside = (map_x >= mx) & (map_x <= out_width - 1 - mx) & (map_y >= my) & (map_y <= out_height - 1 - my)
+            assert(diff[inside].mean() < 1 and diff[inside].max() <= 16), (diff[inside].mean(), diff[inside].max())
+            renderer.close()
+    print('render: ok')
+
+def benchmark(height=288, width=512, frames=20):
+    # ms per frame of the tile by tile warp vs render_hs (maps from Hs + one remap), by mesh size
+    rng = np.random.RandomState(0)
+    for out_width, out_height in [(width, height), (1920, 1080)]:
+        img = (rng.rand(out_height, out_width, 3) * 255).astype(np.uint8)
+        renderer = Renderer(out_width, out_height, net_size=(width, height))
+        for grid in [4, 8, 16]:
+            Hs = vertices_to_hs(random_vertices(grid, grid, rng, shake=0.2 / grid))
+            times = []
+            # the tiles take seconds per frame at 1080p with the fine meshes, run them twice only
+            for fn, runs in [(lambda: warp_rev_bundle_tiles(img, Hs), 2), (lambda: renderer.render_hs(img, Hs), frames),
+                             (lambda: smooth_maps(Hs, height, width, renderer.rate), frames)]:
+                fn()
+                start = time.time()
+                for t in range(runs):
+                    fn()
+                times.append((time.time() - start) * 1000 / runs)
+            print('{0}x{1} output, {2}x{2} mesh: warpPerspective per cell {3:.2f}ms, render_hs {4:.2f}ms (smooth_maps {5:.3f}ms)'.format(
+                out_width, out_height, grid, *times))
+        renderer.close()
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -13,7 +13,7 @@
 # limitations under the License.
 # =============================================================================
 import tensorflow as tf
-from spatial_transformer3 import transformer
+from spatial_transformer3 import transformer, cell_corners
 import numpy as np
 from tf_utils import weight_variable, bias_variable, dense_to_one_hot
 import cv2
@@ -26,8 +26,24 @@ slim = tf.contrib.slim
 import utils
 logger = utils.get_logger()
 
-def get_4_pts(theta, batch_size):
+def get_4_pts(theta, grid_h=grid_h, grid_w=grid_w):
+    '''
+    theta [batch, (grid_h + 1) * (grid_w + 1) * 2], the offsets of the mesh vertices, ->
+    pts1 [batch, grid_h, grid_w, 8], the x and then the y of the corners (i, j), (i, j + 1), (i + 1, j),
+    (i + 1, j + 1) of every cell, and pts2 [batch, grid_h + 1, grid_w + 1, 2], the vertices, clipped
+    to 1 / do_crop_rate.
+    '''
     with tf.name_scope('get_4_pts'):
+        regular = np.stack(np.meshgrid(np.linspace(-1, 1, grid_w + 1), np.linspace(-1, 1, grid_h + 1)), axis=-1)
+        pts2 = tf.reshape(theta, [-1, grid_h + 1, grid_w + 1, 2]) + tf.constant(regular, dtype=tf.float32)
+        pts2 = tf.clip_by_value(pts2, -1. / do_crop_rate, 1. / do_crop_rate)
+        pts1 = tf.reshape(tf.transpose(cell_corners(pts2), [0, 1, 2, 4, 3]), [-1, grid_h, grid_w, 8])
+    return pts1, pts2
+
+# the vertex by vertex get_4_pts replaced; kept as the reference of test() and benchmark()
+def get_4_pts_loops(theta, grid_h=grid_h, grid_w=grid_w):
+    with tf.name_scope('get_4_pts'):
+        batch_size = tf.shape(theta)[0]
         pts1_ = []
         pts2_ = []
         pts = []
@@ -35,9 +51,6 @@ def get_4_pts(theta, batch_size):
         w = 2.0 / grid_w
         tot = 0
         one_ = tf.ones([batch_size, 1, 2]) / do_crop_rate
-        temp_p = [0.5, 0.5, 0, 0.5, -0.5, 0.5,
-                0.5, 0, 0.3, 0.3, -0.5, 0,
-                0.5, -0.5, 0, -0.5, -0.5, -0.5]
         for i in range(grid_h + 1):
             pts.append([])
             for j in range(grid_w + 1):
@@ -45,18 +58,9 @@ def get_4_pts(theta, batch_size):
                 ww = j * w - 1
                 p = tf.constant([ww, hh], shape=[2], dtype=tf.float32)
                 temp = tf.slice(theta, [0, tot * 2], [-1, 2])
-                #test[v]
-                #temp = tf.constant([0*-temp_p[(i * 3 + j) * 2], 0*-temp_p[(i * 3 + j) * 2 + 1]], shape=[1, 2], dtype=tf.float32)
-                #if (i == 1 and j == 1):
-                #    temp = tf.constant([0.3, 0.3], shape=[1, 2], dtype=tf.float32)
-                #temp = tf.tile(temp, [batch_size, 1])
-                #test[^]
                 tot += 1
                 p = tf.reshape(p + temp, [batch_size, 1, 2])
-                #v2_27
-                #test[v]
                 p = tf.minimum(tf.maximum(p, -1 * one_), one_)
-                #test[^]
                 pts[i].append(tf.reshape(p, [batch_size, 2, 1]))
                 pts2_.append(p)
 
@@ -137,15 +141,58 @@ def reduce_layer(input):
     return out
 
 def get_black_pos(pts):
-    print(batch_size)
-    print('==================')
     with tf.name_scope('black_pos'):
-        one_ = tf.ones([batch_size, grid_h, grid_w, 8]) / do_crop_rate
-        zero_ = tf.zeros([batch_size, grid_h, grid_w, 8])
-        black_err = tf.where(tf.greater(pts, one_), pts - one_, zero_) + tf.where(tf.greater(one_ * -1, pts), one_ * -1 - pts, zero_)
-    return tf.reshape(black_err, [batch_size, -1])
+        one_ = 1. / do_crop_rate
+        black_err = tf.nn.relu(pts - one_) + tf.nn.relu(-one_ - pts)
+    return tf.reshape(black_err, [tf.shape(pts)[0], -1])
 
-def calc_distortion_loss(p0, p1, p2, clock, hw):
+def calc_distortion_loss(p0, p1, p2, clock, hw, grid_h=grid_h, grid_w=grid_w):
+    # p0 -> p1 turned by a right angle (clockwise or not) and scaled to the cell's aspect ratio is p1 -> p2
+    # in a rectangular cell; p0, p1, p2 [..., 2]
+    h = 2.0 / grid_h
+    w = 2.0 / grid_w
+    if (hw == 0):
+        k = h / w
+    else:
+        k = w / h
+    if (clock):
+        k = -k
+    d = p1 - p0
+    loss = tf.abs(tf.stack([-k * d[..., 1], k * d[..., 0]], axis=-1) - (p2 - p1))
+    return loss * loss
+
+def get_distortion_loss(pts, grid_h=grid_h, grid_w=grid_w):
+    # pts [batch, grid_h, grid_w, 8], the four corners of every cell as in get_4_pts
+    with tf.name_scope('distortion_loss'):
+        pts = tf.reshape(pts, [-1, 2, 4])
+        p0, p1, p2, p3 = pts[..., 0], pts[..., 1], pts[..., 2], pts[..., 3]
+        loss = 0
+        for a, b, c, clock, hw in [(p0, p1, p3, 0, 0), (p1, p3, p2, 0, 1), (p3, p2, p0, 0, 0), (p2, p0, p1, 0, 1),
+                                   (p1, p0, p2, 1, 0), (p0, p2, p3, 1, 1), (p2, p3, p1, 1, 0), (p3, p1, p0, 1, 1)]:
+            loss = loss + calc_distortion_loss(a, b, c, clock, hw, grid_h, grid_w)
+    return tf.reduce_mean(loss) / 8
+
+def get_consistency_loss(pts):
+    '''
+    Mean square of the second differences of the vertices pts [batch, grid_h + 1, grid_w + 1, 2]
+    along the rows and the columns of the mesh: straight, evenly spaced grid lines cost nothing.
+    '''
+    with tf.name_scope('consistency_loss'):
+        rows, cols = pts.get_shape().as_list()[1:3]
+        errs = []
+        if (rows > 2):
+            errs.append(tf.reshape(2 * pts[:, 1:-1] - pts[:, :-2] - pts[:, 2:], [-1]))
+        if (cols > 2):
+            errs.append(tf.reshape(2 * pts[:, :, 1:-1] - pts[:, :, :-2] - pts[:, :, 2:], [-1]))
+        if (len(errs) == 0):
+            loss = tf.zeros([])
+        else:
+            loss = tf.concat(errs, 0)
+            loss = tf.reduce_mean(loss * loss)
+    return loss
+
+# the vertex by vertex losses replaced; kept as the reference of test() and benchmark()
+def calc_distortion_loss_loops(p0, p1, p2, clock, hw, grid_h=grid_h, grid_w=grid_w):
     h = 2.0 / grid_h
     w = 2.0 / grid_w
     if (hw == 0):
@@ -158,30 +205,32 @@ def calc_distortion_loss(p0, p1, p2, clock, hw):
     else:
         R_ = [0, k, -k, 0]
     R = tf.constant(R_, shape=[4], dtype=tf.float32)
-    R = tf.tile(R, [batch_size * grid_h * grid_w])
+    R = tf.tile(R, [tf.shape(p0)[0]])
     R = tf.reshape(R, [-1, 2, 2])
     loss = tf.abs(tf.matmul(R, p1 - p0) - (p2 - p1))    #batch_size*grid_h*grid_w, 2, 1
     return loss * loss
 
-def get_distortion_loss(pts):
+def get_distortion_loss_loops(pts, grid_h=grid_h, grid_w=grid_w):
     with tf.name_scope('distortion_loss'):
         pts = tf.reshape(pts, [-1, 2, 4])
         p0 = tf.slice(pts, [0, 0, 0], [-1, -1, 1])
         p1 = tf.slice(pts, [0, 0, 1], [-1, -1, 1])
         p2 = tf.slice(pts, [0, 0, 2], [-1, -1, 1])
         p3 = tf.slice(pts, [0, 0, 3], [-1, -1, 1])
-        loss =          calc_distortion_loss(p0, p1, p3, 0, 0)
-        loss = loss +   calc_distortion_loss(p1, p3, p2, 0, 1)
-        loss = loss +   calc_distortion_loss(p3, p2, p0, 0, 0)
-        loss = loss +   calc_distortion_loss(p2, p0, p1, 0, 1)
-        loss = loss +   calc_distortion_loss(p1, p0, p2, 1, 0)
-        loss = loss +   calc_distortion_loss(p0, p2, p3, 1, 1)
-        loss = loss +   calc_distortion_loss(p2, p3, p1, 1, 0)
-        loss = loss +   calc_distortion_loss(p3, p1, p0, 1, 1)
+        loss =          calc_distortion_loss_loops(p0, p1, p3, 0, 0, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p1, p3, p2, 0, 1, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p3, p2, p0, 0, 0, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p2, p0, p1, 0, 1, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p1, p0, p2, 1, 0, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p0, p2, p3, 1, 1, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p2, p3, p1, 1, 0, grid_h, grid_w)
+        loss = loss +   calc_distortion_loss_loops(p3, p1, p0, 1, 1, grid_h, grid_w)
     return tf.reduce_mean(loss) / 8
 
-def get_consistency_loss(pts):
+def get_consistency_loss_loops(pts):
     with tf.name_scope('consistency_loss'):
+        batch_size = tf.shape(pts)[0]
+        grid_h, grid_w = [n - 1 for n in pts.get_shape().as_list()[1:3]]
         p = []
         for i in range(grid_h + 1):
             p.append([])
@@ -213,11 +262,16 @@ def to_mat(x):
     return tf.reshape(x, [-1, 3, 3])
 
 def warp_pts(pts, flow):
+    # at the resolution of the flow
+    height = tf.shape(flow)[1]
+    width = tf.shape(flow)[2]
+    height_f = tf.cast(height, tf.float32)
+    width_f = tf.cast(width, tf.float32)
     x = pts[:, :, 0]
-    x = tf.clip_by_value((x + 1) / 2 * width, 0, width - 1)
+    x = tf.clip_by_value((x + 1) / 2 * width_f, 0, width_f - 1)
     x = tf.cast(tf.round(x), tf.int32)
     y = pts[:, :, 1]
-    y = tf.clip_by_value((y + 1) / 2 * height, 0, height - 1)
+    y = tf.clip_by_value((y + 1) / 2 * height_f, 0, height_f - 1)
     y = tf.cast(tf.round(y), tf.int32)
 
     out = []
@@ -263,112 +317,115 @@ def get_resnet(x_tensor, reuse, is_training, x_batch_size):
             id2_loss = tf.reduce_mean(tf.abs(theta)) * id_mul
     return theta, id2_loss, id2_loss
 
-def inference_stable_net(reuse):
-    with tf.variable_scope('stable_net'):
-        with tf.name_scope('input'):
-            # %% Since x is currently [batch, height*width], we need to reshape to a
-            # 4-D tensor to use it in a convolutional graph.  If one component of
-            # `shape` is the special value -1, the size of that dimension is
-            # computed so that the total size remains constant.  Since we haven't
-            # defined the batch dimension's shape yet, we use -1 to denote this
-            # dimension should not change size.
-            #tot_ch = before_ch + after_ch + 1=7 , before_ch=6, after_ch=0
-            if input_mask:
-                x_tensor = tf.placeholder(tf.float32, [None, height, width, tot_ch + before_ch], name = 'x_tensor')
-            else:
-                x_tensor = tf.placeholder(tf.float32, [None, height, width, tot_ch], name = 'x_tensor')
-            x_batch_size = tf.shape(x_tensor)[0]
-            if (input_mask):
-                x = tf.slice(x_tensor, [0, 0, 0, before_ch + before_ch], [-1, -1, -1, 1])
-            else:
-                x = tf.slice(x_tensor, [0, 0, 0, before_ch], [-1, -1, -1, 1])
-
-            mask = tf.placeholder(tf.float32, [None, max_matches])
-            matches = tf.placeholder(tf.float32, [None, max_matches, 4])
-           
-            if (input_mask):
-                out_ch = tot_ch + before_ch
-            else:
-                out_ch = tot_ch
-            for i in range(out_ch):
-                temp = tf.slice(x_tensor, [0, 0, 0, i], [-1, -1, -1, 1])
-                tf.summary.image('x' + str(i), temp)
-
-        with tf.name_scope('label'):
-            y = tf.placeholder(tf.float32, [None, height, width, 1])
-            x4 = tf.slice(y, [0, 0, 0, 0], [-1, -1, -1, 1])
-            tf.summary.image('label', x4)
+def net_input():
+    # the placeholders of one frame set: the net input x_tensor, the frame it warps x, the feature matches and their mask, the label y
+    with tf.name_scope('input'):
+        # %% Since x is currently [batch, height*width], we need to reshape to a
+        # 4-D tensor to use it in a convolutional graph.  If one component of
+        # `shape` is the special value -1, the size of that dimension is
+        # computed so that the total size remains constant.  Since we haven't
+        # defined the batch dimension's shape yet, we use -1 to denote this
+        # dimension should not change size.
+        #tot_ch = before_ch + after_ch + 1=7 , before_ch=6, after_ch=0
+        # any resolution: the ResNet is pooled globally and the transformer takes the size of its input
+        if input_mask:
+            x_tensor = tf.placeholder(tf.float32, [None, None, None, tot_ch + before_ch], name = 'x_tensor')
+        else:
+            x_tensor = tf.placeholder(tf.float32, [None, None, None, tot_ch], name = 'x_tensor')
+        if (input_mask):
+            x = tf.slice(x_tensor, [0, 0, 0, before_ch + before_ch], [-1, -1, -1, 1])
+        else:
+            x = tf.slice(x_tensor, [0, 0, 0, before_ch], [-1, -1, -1, 1])
 
-        theta, id_loss, id2_loss = get_resnet(x_tensor, reuse = reuse, is_training=True, x_batch_size = x_batch_size)
-        theta_infer, id_loss_infer, id2_loss_infer = get_resnet(x_tensor, reuse = True, is_training=False, x_batch_size = x_batch_size)
+        mask = tf.placeholder(tf.float32, [None, max_matches])
+        matches = tf.placeholder(tf.float32, [None, max_matches, 4])
+       
+        if (input_mask):
+            out_ch = tot_ch + before_ch
+        else:
+            out_ch = tot_ch
+        for i in range(out_ch):
+            temp = tf.slice(x_tensor, [0, 0, 0, i], [-1, -1, -1, 1])
+            tf.summary.image('x' + str(i), temp)
+
+    with tf.name_scope('label'):
+        y = tf.placeholder(tf.float32, [None, None, None, 1])
+        x4 = tf.slice(y, [0, 0, 0, 0], [-1, -1, -1, 1])
+        tf.summary.image('label', x4)
+    return x_tensor, x, mask, matches, y
+
+def inference_branch(x, theta_infer):
+    # stable_net/inference, the tensors deploy fetches
+    _, pts2_infer = get_4_pts(theta_infer)
+    print('pts2_infer',pts2_infer)
+    with tf.name_scope('inference'):
+        h_trans_infer, black_pix_infer, _ = transformer(x, pts2_infer)
+    return h_trans_infer, black_pix_infer
+
+def net_losses(x_tensor, x, mask, matches, y, theta, id_loss, id2_loss):
+    # the warp of x by the mesh of theta and the losses of one frame set, in the dict train_bundle_nobm.py feeds and fetches
+    pts1, pts2 = get_4_pts(theta)
+    print('pts1',pts1)
+    print('pts2',pts2)
+    with tf.name_scope('theta_loss'):
+        use_theta_loss = tf.placeholder(tf.float32)
+        theta_loss = id_loss #theta_loss * use_theta_loss + id_loss
+        grid_theta_loss = id2_loss
+    with tf.name_scope('black_loss'):
+        use_black_loss = tf.placeholder(tf.float32)
+        black_pos = get_black_pos(pts1)
+        black_pos = black_pos * black_pos
+        black_pos = black_pos * use_black_loss
+        black_pos_loss = tf.reduce_mean(black_pos)
+
+    with tf.name_scope('regu_loss'):
+        #regu_loss = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+        #regu_loss = tf.add_n(regu_loss)
+
+
+        regu_loss = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+        regu_loss = tf.add_n(regu_loss)
+        #regu_loss = tf.add_n(slim.losses.get_regularization_losses())
+
+    distortion_loss = get_distortion_loss(pts1)
+    consistency_loss = get_consistency_loss(pts2)
+    #neighbor_loss = get_neighbor_loss(pts)
+
+    h_trans, black_pix, flow = transformer(x, pts2)
+
+
+    ###h_trans,blcak_pix, flow ==img?
+    
 
-        pts1, pts2 = get_4_pts(theta, x_batch_size)
-        print('pts1',tf.pts1)
-        print('pts2',pts2)
-        _, pts2_infer = get_4_pts(theta_infer, x_batch_size)
-
-        print('pts2_infer',pts2_infer)
-        with tf.name_scope('inference'):
-            h_trans_infer, black_pix_infer, _ = transformer(x, pts2_infer)
-        with tf.name_scope('theta_loss'):
-            use_theta_loss = tf.placeholder(tf.float32)
-            theta_loss = id_loss #theta_loss * use_theta_loss + id_loss
-            grid_theta_loss = id2_loss
-        with tf.name_scope('black_loss'):
-            use_black_loss = tf.placeholder(tf.float32)
-            black_pos = get_black_pos(pts1)
-            black_pos = black_pos * black_pos
-            black_pos = black_pos * use_black_loss
-            black_pos_loss = tf.reduce_mean(black_pos)
-
-        with tf.name_scope('regu_loss'):
-            #regu_loss = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
-            #regu_loss = tf.add_n(regu_loss)
-
-
-            regu_loss = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
-            regu_loss = tf.add_n(regu_loss)
-            #regu_loss = tf.add_n(slim.losses.get_regularization_losses())
-
-        distortion_loss = get_distortion_loss(pts1)
-        consistency_loss = get_consistency_loss(pts2)
-        #neighbor_loss = get_neighbor_loss(pts)
-
-        h_trans, black_pix, flow = transformer(x, pts2)
-
-
-        ###h_trans,blcak_pix, flow ==img?
-        
-
-        print('h_trans',h_trans)
-
-
-        with tf.name_scope('feature_loss'):
-            use_feature_loss = tf.placeholder(tf.float32)
-            stable_pts = matches[:, :, :2]
-            unstable_pts = matches[:, :, 2:]
-            stable_warpped = warp_pts(stable_pts, flow)
-            before_mask = tf.reduce_sum(tf.abs(stable_warpped - unstable_pts), 2)
-            assert(before_mask.shape[1] == max_matches)
-            after_mask = tf.reduce_sum(before_mask * mask, axis=1) / (tf.maximum(tf.reduce_sum(mask, axis=1), 1))
-            feature_loss = tf.reduce_mean(after_mask)
-
-        tf.summary.image('output', h_trans)
-        tf.add_to_collection('output', h_trans)
-        with tf.name_scope('img_loss'):
-            black_pix = tf.reshape(black_pix, [batch_size, height, width, 1]) 
-            #black_pix = tf.stop_gradient(black_pix)
-            img_err = (h_trans - y) * (1 - black_pix)
-            tf.summary.image('err', img_err * img_err)
-            img_loss = tf.reduce_sum(tf.reduce_sum(img_err * img_err, [1, 2, 3]) / (tf.reduce_sum((1 - black_pix), [1, 2, 3]) + 1e-8), [0]) / batch_size
-
-        use_theta_only = tf.placeholder(tf.float32)
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies([tf.group(*update_ops)]):
-            total_loss = theta_loss * theta_mul + grid_theta_loss * grid_theta_mul + ((1 - use_theta_only) * 
-            (img_loss * img_mul + regu_loss * regu_mul + black_pos_loss * black_mul + distortion_loss * distortion_mul + 
-             consistency_loss * consistency_mul + feature_loss * feature_mul))
-        
+    print('h_trans',h_trans)
+
+
+    with tf.name_scope('feature_loss'):
+        use_feature_loss = tf.placeholder(tf.float32)
+        stable_pts = matches[:, :, :2]
+        unstable_pts = matches[:, :, 2:]
+        stable_warpped = warp_pts(stable_pts, flow)
+        before_mask = tf.reduce_sum(tf.abs(stable_warpped - unstable_pts), 2)
+        assert(before_mask.shape[1] == max_matches)
+        after_mask = tf.reduce_sum(before_mask * mask, axis=1) / (tf.maximum(tf.reduce_sum(mask, axis=1), 1))
+        feature_loss = tf.reduce_mean(after_mask)
+
+    tf.summary.image('output', h_trans)
+    tf.add_to_collection('output', h_trans)
+    with tf.name_scope('img_loss'):
+        black_pix = tf.expand_dims(black_pix, 3)
+        #black_pix = tf.stop_gradient(black_pix)
+        img_err = (h_trans - y) * (1 - black_pix)
+        tf.summary.image('err', img_err * img_err)
+        img_loss = tf.reduce_sum(tf.reduce_sum(img_err * img_err, [1, 2, 3]) / (tf.reduce_sum((1 - black_pix), [1, 2, 3]) + 1e-8), [0]) / batch_size
+
+    use_theta_only = tf.placeholder(tf.float32)
+    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    with tf.control_dependencies([tf.group(*update_ops)]):
+        total_loss = theta_loss * theta_mul + grid_theta_loss * grid_theta_mul + ((1 - use_theta_only) * 
+        (img_loss * img_mul + regu_loss * regu_mul + black_pos_loss * black_mul + distortion_loss * distortion_mul + 
+         consistency_loss * consistency_mul + feature_loss * feature_mul))
+    
     ret = {}
     ret['error'] = tf.abs(h_trans - y)
     ret['black_pos'] = black_pos
@@ -395,3 +452,93 @@ def inference_stable_net(reuse):
     #ret['theta_mat'] = theta_mat
     return ret
 
+def inference_stable_net(reuse):
+    # one frame set with a training-mode and an inference-mode ResNet, the losses and the inference branch
+    with tf.variable_scope('stable_net'):
+        x_tensor, x, mask, matches, y = net_input()
+        x_batch_size = tf.shape(x_tensor)[0]
+        theta, id_loss, id2_loss = get_resnet(x_tensor, reuse = reuse, is_training=True, x_batch_size = x_batch_size)
+        theta_infer, id_loss_infer, id2_loss_infer = get_resnet(x_tensor, reuse = True, is_training=False, x_batch_size = x_batch_size)
+        inference_branch(x, theta_infer)
+        ret = net_losses(x_tensor, x, mask, matches, y, theta, id_loss, id2_loss)
+    return ret
+
+def training_stable_net():
+    '''
+    The graph of a training step, ret1 and ret2 of train_bundle_nobm.py: the two frame sets are fed
+    separately but run through one training-mode ResNet as a batch of 2B, and its mesh offsets are
+    split for the losses of each set and the temporal loss between them. There is no inference-mode
+    ResNet; deploy_stable_net() builds the inference branch from the checkpoint.
+    '''
+    with tf.variable_scope('stable_net'):
+        inputs = [net_input() for k in range(2)]
+        n = tf.shape(inputs[0][0])[0]
+        x_tensor = tf.concat([inputs[0][0], inputs[1][0]], 0)
+        theta, _, _ = get_resnet(x_tensor, reuse = False, is_training=True, x_batch_size = tf.shape(x_tensor)[0])
+        rets = []
+        for inp, theta_k in zip(inputs, [theta[:n], theta[n:]]):
+            # per set, as get_resnet would have for B
+            with tf.name_scope('gen_theta'):
+                id_loss = tf.reduce_mean(tf.abs(theta_k)) * id_mul
+            rets.append(net_losses(*(inp + (theta_k, id_loss, id_loss))))
+    return rets
+
+def deploy_stable_net():
+    # stable_net/input/x_tensor -> inference-mode ResNet -> stable_net/inference, with the variable names of training
+    with tf.variable_scope('stable_net'):
+        x_tensor, x, _, _, _ = net_input()
+        theta_infer, _, _ = get_resnet(x_tensor, reuse = False, is_training=False, x_batch_size = tf.shape(x_tensor)[0])
+        inference_branch(x, theta_infer)
+    return x_tensor
+
+def test():
+    # the stencil versions of get_4_pts and the mesh losses against the vertex by vertex ones, values and gradients
+    rng = np.random.RandomState(0)
+    for gh, gw in [(4, 4), (8, 8), (3, 5), (1, 4)]:
+        graph = tf.Graph()
+        with graph.as_default():
+            theta = tf.constant((rng.randn(3, (gh + 1) * (gw + 1) * 2) * 0.2).astype(np.float32))
+            outs = []
+            for pts_fn, distortion_fn, consistency_fn in [(get_4_pts, get_distortion_loss, get_consistency_loss),
+                                                          (get_4_pts_loops, get_distortion_loss_loops, get_consistency_loss_loops)]:
+                pts1, pts2 = pts_fn(theta, gh, gw)
+                distortion = distortion_fn(pts1, gh, gw)
+                consistency = consistency_fn(pts2)
+                black = tf.reduce_mean(tf.square(get_black_pos(pts1)))
+                grad = tf.gradients(distortion + consistency + black, theta)[0]
+                outs.append([pts1, pts2, distortion, consistency, black, grad])
+            with tf.Session(graph=graph) as sess:
+                new, old = sess.run(outs)
+        for name, a, b in zip(['pts1', 'pts2', 'distortion', 'consistency', 'black', 'gradient'], new, old):
+            assert(np.abs(a - b).max() < 1e-5 * max(1., np.abs(b).max())), (name, np.abs(a - b).max())
+        print('mesh losses {}x{}: ok'.format(gh, gw))
+    print('ok')
+
+def benchmark(grids=[4, 8, 16], batch=10, runs=20):
+    # graph size, build time and run time of get_4_pts and the mesh losses with their gradient, vertex
+    # by vertex and as stencils
+    for grid in grids:
+        values = (np.random.RandomState(0).randn(batch, (grid + 1) * (grid + 1) * 2) * 0.2).astype(np.float32)
+        for name, pts_fn, distortion_fn, consistency_fn in [('loops', get_4_pts_loops, get_distortion_loss_loops, get_consistency_loss_loops),
+                                                            ('stencil', get_4_pts, get_distortion_loss, get_consistency_loss)]:
+            graph = tf.Graph()
+            with graph.as_default():
+                theta = tf.placeholder(tf.float32, [None, (grid + 1) * (grid + 1) * 2])
+                start = time.time()
+                pts1, pts2 = pts_fn(theta, grid, grid)
+                loss = distortion_fn(pts1, grid, grid) + consistency_fn(pts2) + tf.reduce_mean(tf.square(get_black_pos(pts1)))
+                grad = tf.gradients(loss, theta)[0]
+                build = time.time() - start
+                ops = len(graph.get_operations())
+                with tf.Session(graph=graph) as sess:
+                    sess.run(grad, feed_dict={theta: values})
+                    start = time.time()
+                    for k in range(runs):
+                        sess.run([loss, grad], feed_dict={theta: values})
+                    step = (time.time() - start) / runs * 1000
+            print('grid {:2d}x{:<2d} {:8s}: {:6d} ops, built in {:7.1f}ms, losses + gradient {:7.3f}ms (batch {})'.format(
+                grid, grid, name, ops, build * 1000, step, batch))
+
+if __name__ == '__main__':
+    test()
+    benchmark()
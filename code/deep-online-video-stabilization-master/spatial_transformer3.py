@@ -13,8 +13,185 @@
 # limitations under the License.
 # ==============================================================================
 import tensorflow as tf
+from tf_utils import bilinear_sample
+import numpy as np
 from config import *
 import math
+import time
+
+def cell_corners(v):
+    # [batch, rows + 1, cols + 1, 2] vertices -> [batch, rows, cols, 4, 2], the corners (i, j), (i, j + 1),
+    # (i + 1, j), (i + 1, j + 1) of every cell
+    return tf.stack([v[:, :-1, :-1], v[:, :-1, 1:], v[:, 1:, :-1], v[:, 1:, 1:]], axis=3)
+
+#input:  batch_size*(grid_h+1)*(grid_w+1)*2
+#output: batch_size*grid_h*grid_w*9
+def get_Hs(theta, grid_h=grid_h, grid_w=grid_w):
+    '''
+    The homography of every cell, from its corners in the regular mesh to the vertices in theta.
+    The damped 8x8 systems of all cells (A + 1e-4 * I) h = b are formed at once from the vertex
+    tensor and solved by one batched matrix_solve, so the graph does not grow with the grid.
+    '''
+    with tf.variable_scope('get_Hs'):
+        num_batch = tf.shape(theta)[0]
+        regular = np.stack(np.meshgrid(np.linspace(-1, 1, grid_w + 1), np.linspace(-1, 1, grid_h + 1)), axis=-1)
+        ori = cell_corners(tf.constant(regular[None], dtype=tf.float32))
+        tar = cell_corners(theta)
+        u, v = tar[..., 0], tar[..., 1]
+        zero = tf.zeros_like(u)
+        one = tf.ones_like(u)
+        x, y = ori[..., 0] + zero, ori[..., 1] + zero
+        A = tf.concat([tf.stack([x, y, one, zero, zero, zero, -x * u, -y * u], axis=-1),
+                       tf.stack([zero, zero, zero, x, y, one, -x * v, -y * v], axis=-1)], axis=-2)
+        b = tf.expand_dims(tf.concat([u, v], axis=-1), -1)
+        h = tf.matrix_solve(tf.reshape(A, [-1, 8, 8]) + tf.eye(8) * 1e-4, tf.reshape(b, [-1, 8, 1]))
+        h = tf.reshape(h, [num_batch, grid_h, grid_w, 8])
+        Hs = tf.reshape(tf.concat([h, tf.ones_like(h[..., :1])], axis=3), [num_batch, grid_h, grid_w, 9], name='Hs')
+    return Hs
+
+# the cell by cell solver get_Hs replaced, one get_H per cell; kept as the reference of test() and benchmark()
+def get_H_cell(ori, tar):
+    num_batch = tf.shape(ori)[0]
+    with tf.variable_scope('get_H'):
+        one = tf.ones([num_batch, 1])
+        zero = tf.zeros([num_batch, 1])
+        x = [tf.slice(ori, [0, 0], [-1, 1]), tf.slice(ori, [0, 2], [-1, 1]), tf.slice(ori, [0, 4], [-1, 1]), tf.slice(ori, [0, 6], [-1, 1])]
+        y = [tf.slice(ori, [0, 1], [-1, 1]), tf.slice(ori, [0, 3], [-1, 1]), tf.slice(ori, [0, 5], [-1, 1]), tf.slice(ori, [0, 7], [-1, 1])]
+        u = [tf.slice(tar, [0, 0], [-1, 1]), tf.slice(tar, [0, 2], [-1, 1]), tf.slice(tar, [0, 4], [-1, 1]), tf.slice(tar, [0, 6], [-1, 1])]
+        v = [tf.slice(tar, [0, 1], [-1, 1]), tf.slice(tar, [0, 3], [-1, 1]), tf.slice(tar, [0, 5], [-1, 1]), tf.slice(tar, [0, 7], [-1, 1])]
+
+        A_ = []
+        A_.extend([x[0], y[0], one, zero, zero, zero, -x[0] * u[0], -y[0] * u[0]])
+        A_.extend([x[1], y[1], one, zero, zero, zero, -x[1] * u[1], -y[1] * u[1]])
+        A_.extend([x[2], y[2], one, zero, zero, zero, -x[2] * u[2], -y[2] * u[2]])
+        A_.extend([x[3], y[3], one, zero, zero, zero, -x[3] * u[3], -y[3] * u[3]])
+        A_.extend([zero, zero, zero, x[0], y[0], one, -x[0] * v[0], -y[0] * v[0]])
+        A_.extend([zero, zero, zero, x[1], y[1], one, -x[1] * v[1], -y[1] * v[1]])
+        A_.extend([zero, zero, zero, x[2], y[2], one, -x[2] * v[2], -y[2] * v[2]])
+        A_.extend([zero, zero, zero, x[3], y[3], one, -x[3] * v[3], -y[3] * v[3]])
+        A = tf.reshape(tf.concat(A_, axis=1), [num_batch, 8, 8])
+        b_ = [u[0], u[1], u[2], u[3], v[0],v[1], v[2], v[3]]
+        b  = tf.reshape(tf.concat(b_, axis=1), [num_batch, 8, 1])
+        ans = tf.concat([tf.reshape(tf.matmul(tf.matrix_inverse(A + tf.eye(8) * 1e-4), b), [num_batch, 8]), tf.ones([num_batch, 1])], axis=1)
+    return ans
+
+def get_Hs_cells(theta, grid_h=grid_h, grid_w=grid_w):
+    with tf.variable_scope('get_Hs'):
+        num_batch = tf.shape(theta)[0]
+        h = 2.0 / grid_h
+        w = 2.0 / grid_w
+        Hs = []
+        for i in range(grid_h):
+            for j in range(grid_w):
+                hh = i * h - 1
+                ww = j * w - 1
+                ori = tf.tile(tf.constant([ww, hh, ww + w, hh, ww, hh + h, ww + w, hh + h], shape=[1, 8], dtype=tf.float32), multiples=[num_batch, 1])
+                tar = tf.concat([tf.slice(theta, [0, i, j, 0], [-1, 1, 1, -1]), tf.slice(theta, [0, i, j + 1, 0], [-1, 1, 1, -1]),
+                tf.slice(theta, [0, i + 1, j, 0], [-1, 1, 1, -1]), tf.slice(theta, [0, i + 1, j + 1, 0], [-1, 1, 1, -1])], axis=1)
+                tar = tf.reshape(tar, [num_batch, 8])
+                Hs.append(tf.reshape(get_H_cell(ori, tar), [num_batch, 1, 9]))
+        Hs = tf.reshape(tf.concat(Hs, axis=1), [num_batch, grid_h, grid_w, 9], name='Hs')
+    return Hs
+
+def transform_maps(Hs, height, width):
+    '''
+    Hs [batch, grid_h, grid_w, 9] -> x_map, y_map [batch, height, width]: the normalized source
+    position of every output pixel under the homography of its cell. Cells are
+    floor(height / grid_h) x floor(width / grid_w) pixels, the last row / column of cells absorbs
+    the remainder; height and width are ints, or scalar tensors for a size known at run time.
+    Like mesh_warp.mesh_maps it runs one band of rows per row of cells: the coefficients of every
+    column are gathered from its cell at cell resolution and broadcast over the rows of the band,
+    so nothing is gathered per pixel and the graph grows with grid_h only.
+    '''
+    with tf.variable_scope('transform_maps'):
+        grid_h, grid_w = Hs.get_shape().as_list()[1:3]
+        gh = height // grid_h
+        cols = tf.minimum(tf.range(width) // (width // grid_w), grid_w - 1)
+        x_t = tf.expand_dims(tf.linspace(-1.0, 1.0, width), 0)
+        y_t = tf.expand_dims(tf.linspace(-1.0, 1.0, height), 1)
+        # [grid_w, batch, grid_h, 9] -> [width, batch, grid_h, 9] -> 9 x [batch, grid_h, 1, width]
+        h = tf.gather(tf.transpose(Hs, [2, 0, 1, 3]), cols)
+        h = tf.unstack(tf.expand_dims(tf.transpose(h, [3, 1, 2, 0]), 3), num=9)
+        x_, y_ = [], []
+        for i in range(grid_h):
+            y = y_t[i * gh:(i + 1) * gh] if i < grid_h - 1 else y_t[i * gh:]
+            c = [hk[:, i] for hk in h]
+            # T_g = H * [x, y, 1], the x terms at [batch, 1, width] once per band
+            z_s = c[7] * y + (c[6] * x_t + c[8])
+            z_s = z_s + (tf.cast(z_s >= 0, tf.float32) * 2 - 1) * 1e-8
+            x_.append((c[1] * y + (c[0] * x_t + c[2])) / z_s)
+            y_.append((c[4] * y + (c[3] * x_t + c[5])) / z_s)
+        x_s = tf.concat(x_, axis=1) if grid_h > 1 else x_[0]
+        y_s = tf.concat(y_, axis=1) if grid_h > 1 else y_[0]
+    return x_s, y_s
+
+def dim(t, axis):
+    # the static size of an axis when the graph knows it, else the size at run time
+    size = t.get_shape().as_list()[axis]
+    return size if size is not None else tf.shape(t)[axis]
+
+def _meshgrid2(height, width, sh, eh, sw, ew):
+    hn = eh - sh + 1
+    wn = ew - sw + 1
+
+    x_t = tf.matmul(tf.ones(shape=tf.stack([hn, 1])),
+                    tf.transpose(tf.expand_dims(tf.slice(tf.linspace(-1.0, 1.0, width), [sw], [wn]), 1), [1, 0]))
+    y_t = tf.matmul(tf.expand_dims(tf.slice(tf.linspace(-1.0, 1.0, height), [sh], [hn]), 1),
+                    tf.ones(shape=tf.stack([1, wn])))
+
+    x_t_flat = tf.reshape(x_t, (1, -1))
+    y_t_flat = tf.reshape(y_t, (1, -1))
+
+    ones = tf.ones_like(x_t_flat)
+    grid = tf.concat([x_t_flat, y_t_flat, ones], 0)
+    return grid
+
+# the cell by cell transform_maps replaced; kept as the reference of test() and benchmark()
+def transform_maps_cells(Hs, height, width):
+    num_batch = tf.shape(Hs)[0]
+    grid_h, grid_w = Hs.get_shape().as_list()[1:3]
+    gh = int(math.floor(height / grid_h))
+    gw = int(math.floor(width / grid_w))
+    x_ = []
+    y_ = []
+    for i in range(grid_h):
+        row_x_ = []
+        row_y_ = []
+        for j in range(grid_w):
+            H = tf.reshape(tf.slice(Hs, [0, i, j, 0], [-1, 1, 1, -1]), [num_batch, 3, 3])
+            sh = i * gh
+            eh = (i + 1) * gh - 1
+            sw = j * gw
+            ew = (j + 1) * gw - 1
+            if (i == grid_h - 1):
+                eh = height - 1
+            if (j == grid_w - 1):
+                ew = width - 1
+            grid = _meshgrid2(height, width, sh, eh, sw, ew)
+            grid = tf.expand_dims(grid, 0)
+            grid = tf.tile(grid, [num_batch, 1, 1])
+
+            T_g = tf.matmul(H, grid)
+            x_s = tf.slice(T_g, [0, 0, 0], [-1, 1, -1])
+            y_s = tf.slice(T_g, [0, 1, 0], [-1, 1, -1])
+            z_s = tf.slice(T_g, [0, 2, 0], [-1, 1, -1])
+
+            z_s_flat = tf.reshape(z_s, [-1])
+            t_1 = tf.ones(shape = tf.shape(z_s_flat))
+            t_0 = tf.zeros(shape = tf.shape(z_s_flat))
+
+            sign_z_flat = tf.where(z_s_flat >= 0, t_1, t_0) * 2 - 1
+            z_s_flat = tf.reshape(z_s, [-1]) + sign_z_flat * 1e-8
+            x_s_flat = tf.reshape(x_s, [-1]) / z_s_flat
+            y_s_flat = tf.reshape(y_s, [-1]) / z_s_flat
+
+            x_s = tf.reshape(x_s_flat, [num_batch, eh - sh + 1, ew - sw + 1])
+            y_s = tf.reshape(y_s_flat, [num_batch, eh - sh + 1, ew - sw + 1])
+            row_x_.append(x_s)
+            row_y_.append(y_s)
+        x_.append(tf.concat(row_x_, axis=2))
+        y_.append(tf.concat(row_y_, axis=2))
+    return tf.concat(x_, axis=1), tf.concat(y_, axis=1)
 
 def transformer(U, theta, name='SpatialTransformer', **kwargs):
     """Spatial Transformer Layer
@@ -51,76 +228,9 @@ def transformer(U, theta, name='SpatialTransformer', **kwargs):
 
     """
 
-    def _repeat(x, n_repeats):
-        with tf.variable_scope('_repeat'):
-            rep = tf.transpose(
-                tf.expand_dims(tf.ones(shape=tf.stack([n_repeats, ])), 1), [1, 0])
-            rep = tf.cast(rep, 'int32')
-            x = tf.matmul(tf.reshape(x, (-1, 1)), rep)
-            return tf.reshape(x, [-1])
-
-    def _interpolate(im, x, y, out_size):  
+    def _interpolate(im, x, y, out_size):
         with tf.variable_scope('_interpolate'):
-            # constants
-            num_batch = tf.shape(im)[0]
-            height = tf.shape(im)[1]
-            width = tf.shape(im)[2]
-            channels = tf.shape(im)[3]
-
-            x = tf.cast(x, 'float32')
-            y = tf.cast(y, 'float32')
-            height_f = tf.cast(height, 'float32')
-            width_f = tf.cast(width, 'float32')
-            out_height = out_size[0]
-            out_width = out_size[1]
-            zero = tf.zeros([], dtype='int32')
-            max_y = tf.cast(tf.shape(im)[1] - 1, 'int32')
-            max_x = tf.cast(tf.shape(im)[2] - 1, 'int32')
-
-            # scale indices from [-1, 1] to [0, width/height]
-            x = (x + 1.0)*(width_f) / 2.0
-            y = (y + 1.0)*(height_f) / 2.0
-
-            # do sampling
-            x0 = tf.cast(tf.floor(x), 'int32')
-            x1 = x0 + 1
-            y0 = tf.cast(tf.floor(y), 'int32')
-            y1 = y0 + 1
-
-            x0 = tf.clip_by_value(x0, zero, max_x)
-            x1 = tf.clip_by_value(x1, zero, max_x)
-            y0 = tf.clip_by_value(y0, zero, max_y)
-            y1 = tf.clip_by_value(y1, zero, max_y)
-            dim2 = width
-            dim1 = width*height
-            base = _repeat(tf.range(num_batch)*dim1, out_height*out_width)
-            base_y0 = base + y0*dim2
-            base_y1 = base + y1*dim2
-            idx_a = base_y0 + x0
-            idx_b = base_y1 + x0
-            idx_c = base_y0 + x1
-            idx_d = base_y1 + x1
-
-            # use indices to lookup pixels in the flat image and restore
-            # channels dim
-            im_flat = tf.reshape(im, tf.stack([-1, channels]))
-            im_flat = tf.cast(im_flat, 'float32')
-            Ia = tf.gather(im_flat, idx_a)
-            Ib = tf.gather(im_flat, idx_b)
-            Ic = tf.gather(im_flat, idx_c)
-            Id = tf.gather(im_flat, idx_d)
-
-            # and finally calculate interpolated values
-            x0_f = tf.cast(x0, 'float32')
-            x1_f = tf.cast(x1, 'float32')
-            y0_f = tf.cast(y0, 'float32')
-            y1_f = tf.cast(y1, 'float32')
-            wa = tf.expand_dims(((x1_f-x) * (y1_f-y)), 1)
-            wb = tf.expand_dims(((x1_f-x) * (y-y0_f)), 1)
-            wc = tf.expand_dims(((x-x0_f) * (y1_f-y)), 1)
-            wd = tf.expand_dims(((x-x0_f) * (y-y0_f)), 1)
-            output = tf.add_n([wa*Ia, wb*Ib, wc*Ic, wd*Id])
-            return output
+            return bilinear_sample(im, x, y, out_size)
 
     def _meshgrid(height, width):
         with tf.variable_scope('_meshgrid'):
@@ -141,135 +251,21 @@ def transformer(U, theta, name='SpatialTransformer', **kwargs):
             grid = tf.concat([x_t_flat, y_t_flat, ones], 0)
             return grid
 
-    def pinv(A):
-        return tf.matrix_inverse(A + tf.eye(8) * 1e-4) 
-
-    # batch_size*8
-    #output: batch_size*9
-    def get_H(ori, tar): 
-        num_batch = tf.shape(ori)[0]
-        with tf.variable_scope('get_H'):
-            one = tf.ones([num_batch, 1])
-            zero = tf.zeros([num_batch, 1])
-            x = [tf.slice(ori, [0, 0], [-1, 1]), tf.slice(ori, [0, 2], [-1, 1]), tf.slice(ori, [0, 4], [-1, 1]), tf.slice(ori, [0, 6], [-1, 1])]
-            y = [tf.slice(ori, [0, 1], [-1, 1]), tf.slice(ori, [0, 3], [-1, 1]), tf.slice(ori, [0, 5], [-1, 1]), tf.slice(ori, [0, 7], [-1, 1])]
-            u = [tf.slice(tar, [0, 0], [-1, 1]), tf.slice(tar, [0, 2], [-1, 1]), tf.slice(tar, [0, 4], [-1, 1]), tf.slice(tar, [0, 6], [-1, 1])]
-            v = [tf.slice(tar, [0, 1], [-1, 1]), tf.slice(tar, [0, 3], [-1, 1]), tf.slice(tar, [0, 5], [-1, 1]), tf.slice(tar, [0, 7], [-1, 1])]
-
-            A_ = []
-            A_.extend([x[0], y[0], one, zero, zero, zero, -x[0] * u[0], -y[0] * u[0]])
-            A_.extend([x[1], y[1], one, zero, zero, zero, -x[1] * u[1], -y[1] * u[1]])
-            A_.extend([x[2], y[2], one, zero, zero, zero, -x[2] * u[2], -y[2] * u[2]])
-            A_.extend([x[3], y[3], one, zero, zero, zero, -x[3] * u[3], -y[3] * u[3]])
-            A_.extend([zero, zero, zero, x[0], y[0], one, -x[0] * v[0], -y[0] * v[0]])
-            A_.extend([zero, zero, zero, x[1], y[1], one, -x[1] * v[1], -y[1] * v[1]])
-            A_.extend([zero, zero, zero, x[2], y[2], one, -x[2] * v[2], -y[2] * v[2]])
-            A_.extend([zero, zero, zero, x[3], y[3], one, -x[3] * v[3], -y[3] * v[3]])
-            A = tf.reshape(tf.concat(A_, axis=1), [num_batch, 8, 8])
-            b_ = [u[0], u[1], u[2], u[3], v[0],v[1], v[2], v[3]]
-            b  = tf.reshape(tf.concat(b_, axis=1), [num_batch, 8, 1])
-            
-            #ans = tf.concat([tf.reshape(tf.matmul(tf.matrix_inverse(A), b), [num_batch, 8]), tf.ones([num_batch, 1])], axis=1)
-            ans = tf.concat([tf.reshape(tf.matmul(pinv(A), b), [num_batch, 8]), tf.ones([num_batch, 1])], axis=1)
-
-        return ans
-
-    #input:  batch_size*(grid_h+1)*(grid_w+1)*2
-    #output: batch_size*grid_h*grid_w*9
-    def get_Hs(theta): 
-        with tf.variable_scope('get_Hs'):
-            num_batch = tf.shape(theta)[0]
-            h = 2.0 / grid_h
-            w = 2.0 / grid_w
-            Hs = []
-            for i in range(grid_h):
-                for j in range(grid_w):
-                    hh = i * h - 1
-                    ww = j * w - 1
-                    ori = tf.tile(tf.constant([ww, hh, ww + w, hh, ww, hh + h, ww + w, hh + h], shape=[1, 8], dtype=tf.float32), multiples=[num_batch, 1])
-                    id = i * (grid_w + 1) + grid_w
-                    tar = tf.concat([tf.slice(theta, [0, i, j, 0], [-1, 1, 1, -1]), tf.slice(theta, [0, i, j + 1, 0], [-1, 1, 1, -1]), 
-                    tf.slice(theta, [0, i + 1, j, 0], [-1, 1, 1, -1]), tf.slice(theta, [0, i + 1, j + 1, 0], [-1, 1, 1, -1])], axis=1)
-                    tar = tf.reshape(tar, [num_batch, 8])
-                    #tar = tf.Print(tar, [tf.slice(ori, [0, 0], [1, -1])],message="[ori--i:"+str(i)+",j:"+str(j)+"]:", summarize=100,first_n=5)
-                    #tar = tf.Print(tar, [tf.slice(tar, [0, 0], [1, -1])],message="[tar--i:"+str(i)+",j:"+str(j)+"]:", summarize=100,first_n=5)
-                    Hs.append(tf.reshape(get_H(ori, tar), [num_batch, 1, 9]))   
-            Hs = tf.reshape(tf.concat(Hs, axis=1), [num_batch, grid_h, grid_w, 9], name='Hs')
-        return Hs 
-
-    def _meshgrid2(height, width, sh, eh, sw, ew):
-        hn = eh - sh + 1
-        wn = ew - sw + 1
-
-        x_t = tf.matmul(tf.ones(shape=tf.stack([hn, 1])),
-                        tf.transpose(tf.expand_dims(tf.slice(tf.linspace(-1.0, 1.0, width), [sw], [wn]), 1), [1, 0]))
-        y_t = tf.matmul(tf.expand_dims(tf.slice(tf.linspace(-1.0, 1.0, height), [sh], [hn]), 1),
-                        tf.ones(shape=tf.stack([1, wn])))
-
-        x_t_flat = tf.reshape(x_t, (1, -1))
-        y_t_flat = tf.reshape(y_t, (1, -1))
-
-        ones = tf.ones_like(x_t_flat)
-        grid = tf.concat([x_t_flat, y_t_flat, ones], 0)
-        return grid
-
-
-
     def _transform3(theta, input_dim):
         with tf.variable_scope('_transform'):
             num_batch = tf.shape(input_dim)[0]
             num_channels = tf.shape(input_dim)[3]
+            # the resolution of the input, so that one graph runs at any size
+            height = dim(input_dim, 1)
+            width = dim(input_dim, 2)
             theta = tf.cast(theta, 'float32')
-            Hs = get_Hs(theta)
+            Hs = get_Hs(theta, dim(theta, 1) - 1, dim(theta, 2) - 1)
             print("!@#$%^==========================")
             print(Hs)
             print("!@#$%^==========================")
-            gh = int(math.floor(height / grid_h))
-            gw = int(math.floor(width / grid_w))
-            x_ = []
-            y_ = []
-            for i in range(grid_h):
-                row_x_ = []
-                row_y_ = []
-                for j in range(grid_w):
-                    H = tf.reshape(tf.slice(Hs, [0, i, j, 0], [-1, 1, 1, -1]), [num_batch, 3, 3])
-                    sh = i * gh
-                    eh = (i + 1) * gh - 1
-                    sw = j * gw
-                    ew = (j + 1) * gw - 1
-                    if (i == grid_h - 1):
-                        eh = height - 1
-                    if (j == grid_w - 1):
-                        ew = width - 1
-                    grid = _meshgrid2(height, width, sh, eh, sw, ew)
-                    grid = tf.expand_dims(grid, 0)
-                    grid = tf.tile(grid, [num_batch, 1, 1])
-
-                    T_g = tf.matmul(H, grid)
-                    x_s = tf.slice(T_g, [0, 0, 0], [-1, 1, -1])
-                    y_s = tf.slice(T_g, [0, 1, 0], [-1, 1, -1])
-                    z_s = tf.slice(T_g, [0, 2, 0], [-1, 1, -1])
-         
-                    z_s_flat = tf.reshape(z_s, [-1])
-                    t_1 = tf.ones(shape = tf.shape(z_s_flat))
-                    t_0 = tf.zeros(shape = tf.shape(z_s_flat))      
-
-                    sign_z_flat = tf.where(z_s_flat >= 0, t_1, t_0) * 2 - 1
-                    z_s_flat = tf.reshape(z_s, [-1]) + sign_z_flat * 1e-8
-                    x_s_flat = tf.reshape(x_s, [-1]) / z_s_flat
-                    y_s_flat = tf.reshape(y_s, [-1]) / z_s_flat
-
-                    x_s = tf.reshape(x_s_flat, [num_batch, eh - sh + 1, ew - sw + 1])
-                    y_s = tf.reshape(y_s_flat, [num_batch, eh - sh + 1, ew - sw + 1])
-                    row_x_.append(x_s)
-                    row_y_.append(y_s)
-                row_x = tf.concat(row_x_, axis=2)
-                row_y = tf.concat(row_y_, axis=2)
-                x_.append(row_x)
-                y_.append(row_y)
-
-            x = tf.reshape(tf.concat(x_, axis=1), [num_batch, height, width, 1], name='x_map')
-            y = tf.reshape(tf.concat(y_, axis=1), [num_batch, height, width, 1], name='y_map')
+            x_s, y_s = transform_maps(Hs, height, width)
+            x = tf.reshape(x_s, [num_batch, height, width, 1], name='x_map')
+            y = tf.reshape(y_s, [num_batch, height, width, 1], name='y_map')
             print('================_transform3==================================')
             print('===============xy===========')
             print(x)
@@ -367,76 +363,9 @@ def transformer(U, theta, name='SpatialTransformer', **kwargs):
 
 
 def interpolate(im, x, y, out_size, name='SpatialInterpolate', **kwargs):
-    def _repeat(x, n_repeats):
-        with tf.variable_scope('_repeat'):
-            rep = tf.transpose(
-                tf.expand_dims(tf.ones(shape=tf.stack([n_repeats, ])), 1), [1, 0])
-            rep = tf.cast(rep, 'int32')
-            x = tf.matmul(tf.reshape(x, (-1, 1)), rep)
-            return tf.reshape(x, [-1])
-
     def _interpolate(im, x, y, out_size):
         with tf.variable_scope('_interpolate'):
-            # constants
-            num_batch = tf.shape(im)[0]
-            height = tf.shape(im)[1]
-            width = tf.shape(im)[2]
-            channels = tf.shape(im)[3]
-
-            x = tf.cast(x, 'float32')
-            y = tf.cast(y, 'float32')
-            height_f = tf.cast(height, 'float32')
-            width_f = tf.cast(width, 'float32')
-            out_height = out_size[0]
-            out_width = out_size[1]
-            zero = tf.zeros([], dtype='int32')
-            max_y = tf.cast(tf.shape(im)[1] - 1, 'int32')
-            max_x = tf.cast(tf.shape(im)[2] - 1, 'int32')
-
-            # scale indices from [-1, 1] to [0, width/height]
-            x = (x + 1.0)*(width_f) / 2.0
-            y = (y + 1.0)*(height_f) / 2.0
-
-            # do sampling
-            x0 = tf.cast(tf.floor(x), 'int32')
-            x1 = x0 + 1
-            y0 = tf.cast(tf.floor(y), 'int32')
-            y1 = y0 + 1
-
-            x0 = tf.clip_by_value(x0, zero, max_x)
-            x1 = tf.clip_by_value(x1, zero, max_x)
-            y0 = tf.clip_by_value(y0, zero, max_y)
-            y1 = tf.clip_by_value(y1, zero, max_y)
-            dim2 = width
-            dim1 = width*height
-            base = _repeat(tf.range(num_batch)*dim1, out_height*out_width)
-            base_y0 = base + y0*dim2
-            base_y1 = base + y1*dim2
-            idx_a = base_y0 + x0
-            idx_b = base_y1 + x0
-            idx_c = base_y0 + x1
-            idx_d = base_y1 + x1
-
-            # use indices to lookup pixels in the flat image and restore
-            # channels dim
-            im_flat = tf.reshape(im, tf.stack([-1, channels]))
-            im_flat = tf.cast(im_flat, 'float32')
-            Ia = tf.gather(im_flat, idx_a)
-            Ib = tf.gather(im_flat, idx_b)
-            Ic = tf.gather(im_flat, idx_c)
-            Id = tf.gather(im_flat, idx_d)
-
-            # and finally calculate interpolated values
-            x0_f = tf.cast(x0, 'float32')
-            x1_f = tf.cast(x1, 'float32')
-            y0_f = tf.cast(y0, 'float32')
-            y1_f = tf.cast(y1, 'float32')
-            wa = tf.expand_dims(((x1_f-x) * (y1_f-y)), 1)
-            wb = tf.expand_dims(((x1_f-x) * (y-y0_f)), 1)
-            wc = tf.expand_dims(((x-x0_f) * (y1_f-y)), 1)
-            wd = tf.expand_dims(((x-x0_f) * (y-y0_f)), 1)
-            output = tf.add_n([wa*Ia, wb*Ib, wc*Ic, wd*Id])
-            return output
+            return bilinear_sample(im, x, y, out_size)
     with tf.variable_scope(name):
         num_batch = tf.shape(im)[0]
         height = out_size[0]
@@ -470,3 +399,111 @@ def batch_transformer(U, thetas, out_size, name='BatchSpatialTransformer'):
         indices = [[i]*num_transforms for i in xrange(num_batch)]
         input_repeated = tf.gather(U, tf.reshape(indices, [-1]))
         return transformer(input_repeated, thetas, out_size)
+
+def warped_corners(Hs, grid_h, grid_w, height=height, width=width):
+    # [batch, grid_h, grid_w, 4, 2] regular corners of every cell mapped by its homography, in pixels of a
+    # height x width frame: what the solvers are compared on, the Hs of small damped cells are ill-conditioned
+    regular = np.stack(np.meshgrid(np.linspace(-1, 1, grid_w + 1), np.linspace(-1, 1, grid_h + 1)), axis=-1)
+    corners = np.stack([regular[:-1, :-1], regular[:-1, 1:], regular[1:, :-1], regular[1:, 1:]], axis=2)
+    corners = np.concatenate([corners, np.ones(corners.shape[:-1] + (1, ))], axis=-1).astype(np.float32)
+    T = tf.matmul(tf.constant(corners[None]), tf.reshape(Hs, [-1, grid_h, grid_w, 3, 3]), transpose_b=True)
+    return T[..., :2] / T[..., 2:] * np.array([width / 2., height / 2.], dtype=np.float32)
+
+def test():
+    # batched get_Hs against the cell by cell solver and mesh_warp's NumPy get_H: the warped cell corners
+    # in pixels and their gradients
+    from mesh_warp import random_vertices, vertices_to_hs
+    rng = np.random.RandomState(0)
+    for gh, gw in [(4, 4), (8, 8), (3, 5)]:
+        vertices = np.stack([random_vertices(gh, gw, rng) for k in range(3)]).astype(np.float32)
+        graph = tf.Graph()
+        with graph.as_default():
+            theta = tf.constant(vertices)
+            with tf.variable_scope('batched'):
+                Hs = get_Hs(theta, gh, gw)
+            with tf.variable_scope('cells'):
+                Hs_cells = get_Hs_cells(theta, gh, gw)
+            ref = np.stack([vertices_to_hs(v) for v in vertices]).astype(np.float32)
+            corners, corners_cells, corners_ref = [warped_corners(h, gh, gw) for h in [Hs, Hs_cells, tf.constant(ref)]]
+            weights = tf.constant(rng.randn(3, gh, gw, 4, 2).astype(np.float32))
+            grad = tf.gradients(tf.reduce_sum(corners * weights), theta)[0]
+            grad_cells = tf.gradients(tf.reduce_sum(corners_cells * weights), theta)[0]
+            with tf.Session(graph=graph) as sess:
+                new, old, ref, g, g_cells = sess.run([corners, corners_cells, corners_ref, grad, grad_cells])
+        assert(np.abs(new - old).max() < 0.02 and np.abs(new - ref).max() < 0.02), (np.abs(new - old).max(), np.abs(new - ref).max())
+        assert(np.linalg.norm(g - g_cells) < 1e-3 * np.linalg.norm(g_cells)), np.linalg.norm(g - g_cells) / np.linalg.norm(g_cells)
+        print('get_Hs {}x{}: ok, corners within {:.4f}px'.format(gh, gw, max(np.abs(new - old).max(), np.abs(new - ref).max())))
+    # maps of the gathered per-pixel homographies against the cell by cell transform, values and gradients
+    from mesh_warp import transform3_maps
+    for gh, gw in [(4, 4), (8, 8), (3, 5)]:
+        vertices = np.stack([random_vertices(gh, gw, rng) for k in range(2)]).astype(np.float32)
+        graph = tf.Graph()
+        with graph.as_default():
+            theta = tf.constant(vertices)
+            Hs = get_Hs(theta, gh, gw)
+            maps = transform_maps(Hs, height, width)
+            maps_cells = transform_maps_cells(Hs, height, width)
+            weights = tf.constant(rng.randn(2, height, width).astype(np.float32))
+            grad = tf.gradients(tf.reduce_sum(maps[0] * weights + maps[1]), theta)[0]
+            grad_cells = tf.gradients(tf.reduce_sum(maps_cells[0] * weights + maps_cells[1]), theta)[0]
+            with tf.Session(graph=graph) as sess:
+                (x, y), (x_cells, y_cells), hs, g, g_cells = sess.run([maps, maps_cells, Hs, grad, grad_cells])
+        assert(np.abs(x - x_cells).max() < 1e-5 and np.abs(y - y_cells).max() < 1e-5), (np.abs(x - x_cells).max(), np.abs(y - y_cells).max())
+        ref_x, ref_y = transform3_maps(hs[0], height, width)
+        assert(np.abs(x[0] - ref_x).max() < 1e-5 and np.abs(y[0] - ref_y).max() < 1e-5)
+        # relative to the whole gradient, single precision sums over every pixel
+        assert(np.linalg.norm(g - g_cells) < 1e-3 * np.linalg.norm(g_cells)), np.linalg.norm(g - g_cells) / np.linalg.norm(g_cells)
+        print('transform_maps {}x{}: ok'.format(gh, gw))
+    # the inference graph still exposes Hs, the maps, the black pixels and the output
+    graph = tf.Graph()
+    with graph.as_default():
+        transformer(tf.zeros([1, height, width, 1]), tf.constant(random_vertices(grid_h, grid_w, rng)[None].astype(np.float32)))
+        for name in ['get_Hs/Hs', 'x_map', 'y_map', 'black_pix', 'output_img']:
+            graph.get_tensor_by_name('SpatialTransformer/_transform/' + name + ':0')
+    # one graph with the size known at run time only, at other resolutions
+    graph = tf.Graph()
+    with graph.as_default():
+        U = tf.placeholder(tf.float32, [None, None, None, 1])
+        theta = tf.placeholder(tf.float32, [None, grid_h + 1, grid_w + 1, 2])
+        transformer(U, theta)
+        fetches = ['SpatialTransformer/_transform/' + name + ':0' for name in ['get_Hs/Hs', 'x_map', 'y_map']]
+        with tf.Session(graph=graph) as sess:
+            for h, w in [(144, 256), (height, width), (361, 640)]:
+                vertices = random_vertices(grid_h, grid_w, rng)[None].astype(np.float32)
+                hs, x, y = sess.run(fetches, feed_dict={U: np.zeros([1, h, w, 1]), theta: vertices})
+                ref_x, ref_y = transform3_maps(hs[0], h, w)
+                assert(np.abs(x[0, ..., 0] - ref_x).max() < 1e-5 and np.abs(y[0, ..., 0] - ref_y).max() < 1e-5)
+                print('transformer {}x{}: ok'.format(w, h))
+    print('ok')
+
+def benchmark(grids=[4, 8, 16], batch=8, runs=20):
+    # graph size, build time and run time of the batched and the cell by cell solver and maps, and of
+    # the maps with their gradient (what a training step adds)
+    from mesh_warp import random_vertices
+    rng = np.random.RandomState(0)
+    for grid in grids:
+        vertices = np.stack([random_vertices(grid, grid, rng) for k in range(batch)]).astype(np.float32)
+        for name, solver, maps in [('cells', get_Hs_cells, transform_maps_cells), ('batched', get_Hs, transform_maps)]:
+            graph = tf.Graph()
+            with graph.as_default():
+                theta = tf.placeholder(tf.float32, [None, grid + 1, grid + 1, 2])
+                start = time.time()
+                Hs = solver(theta, grid, grid)
+                x_s, y_s = maps(Hs, height, width)
+                grad = tf.gradients(tf.reduce_sum(x_s + y_s), theta)[0]
+                build = time.time() - start
+                ops = len(graph.get_operations())
+                times = []
+                with tf.Session(graph=graph) as sess:
+                    for fetches in [Hs, [x_s, y_s], grad]:
+                        sess.run(fetches, feed_dict={theta: vertices})
+                        start = time.time()
+                        for k in range(runs):
+                            sess.run(fetches, feed_dict={theta: vertices})
+                        times.append((time.time() - start) / runs * 1000)
+            print('grid {:2d}x{:<2d} {:8s}: {:6d} ops, built in {:7.1f}ms, Hs {:7.3f}ms, maps {:7.2f}ms, maps + gradient {:7.2f}ms (batch {})'.format(
+                grid, grid, name, ops, build * 1000, times[0], times[1], times[2], batch))
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,410 @@
+import tensorflow as tf
+import numpy as np
+import cv2
+import time
+from collections import deque
+from config import *
+from crop import max_crop_rect, max_valid_rect, scale_rect
+from render import Renderer, parse_size
+from history import InputHistory
+from preprocess import Preprocessor
+from timing import Timers
+from deadline import Deadline
+from mesh_warp import hs_to_vertices, vertices_to_hs, regular_vertices, warp_net_frame, vertex_shift
+
+INFERENCE_SCOPE = 'stable_net/inference/SpatialTransformer/_transform/'
+# longest run of frames between keyframes when only a keyframe threshold is given
+KEYFRAME_GAP = 8
+
+class Model(object):
+    '''
+    A loaded stabilization network: a training checkpoint (model_dir + model_name) or a graph
+    frozen by export_graph.py. It has its own graph and session, and any number of
+    Stabilizers (streams) can share it; sess.run may be called from several threads.
+    '''
+    def __init__(self, model_dir=None, model_name=None, frozen_graph=None, gpu_memory_fraction=0.1,
+                 intra_op_threads=0, inter_op_threads=0):
+        self.graph = tf.Graph()
+        config = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_memory_fraction),
+                                intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        with self.graph.as_default():
+            self.sess = tf.Session(graph=self.graph, config=config)
+            if frozen_graph is not None:
+                # inference-only graph written by export_graph.py, node names are unchanged
+                graph_def = tf.GraphDef()
+                with tf.gfile.GFile(frozen_graph, 'rb') as f:
+                    graph_def.ParseFromString(f.read())
+                tf.import_graph_def(graph_def, name='')
+            else:
+                # the inference branch is rebuilt for checkpoints of the shared-trunk training graph
+                from export_graph import restore_saver
+                saver = restore_saver(model_dir + model_name)
+                saver.restore(self.sess, model_dir + model_name)
+        self.x_tensor = self.graph.get_tensor_by_name('stable_net/input/x_tensor:0')
+        self.output = self.graph.get_tensor_by_name(INFERENCE_SCOPE + 'output_img:0')
+        self.black_pix = self.graph.get_tensor_by_name(INFERENCE_SCOPE + 'black_pix:0')
+        # the remap grids are built from Hs on the CPU (mesh_warp.py), x_map / y_map are not fetched
+        self.Hs_tensor = self.graph.get_tensor_by_name(INFERENCE_SCOPE + 'get_Hs/Hs:0')
+        # (width, height) the graph was built for, None for graphs that take any size
+        dims = self.x_tensor.get_shape().as_list()
+        self.net_size = (dims[2], dims[1]) if dims[1] is not None and dims[2] is not None else None
+
+    def run(self, in_x, refine=1, tol=None, budget=None, iterations=None):
+        '''
+        Runs the net up to refine times, feeding the warped output back as the last channel of in_x.
+        With tol, a row of the batch stops once its mesh vertices moved less than tol pixels in the
+        last run, and later runs only feed the rows still moving. With budget (seconds), no run
+        starts that would end after the budget, judging by the previous one. iterations (int array
+        [batch]) gets the runs of every row.
+        '''
+        start = time.time()
+        rows = np.arange(in_x.shape[0])
+        for j in range(refine):
+            run_start = time.time()
+            # every row at first, only the rows still moving later
+            everything = len(rows) == in_x.shape[0]
+            feed = in_x if everything else in_x[rows]
+            img_j, black_j, Hs_j = self.sess.run([self.output, self.black_pix, self.Hs_tensor], feed_dict={self.x_tensor: feed})
+            moved = np.ones([len(rows)], dtype=bool)
+            if j == 0:
+                img, black, Hs = img_j, black_j, Hs_j
+                black_count = np.round(black).astype(np.int64)
+            else:
+                if tol is not None:
+                    moved = np.array([vertex_shift(Hs[r], Hs_j[k], in_x.shape[1], in_x.shape[2]) >= tol for k, r in enumerate(rows)])
+                img[rows], black[rows], Hs[rows] = img_j, black_j, Hs_j
+                black_count[rows] += np.round(black_j).astype(np.int64)
+            if iterations is not None:
+                iterations[rows] += 1
+            now = time.time()
+            if j == refine - 1 or (budget is not None and now - start + (now - run_start) > budget):
+                break
+            if everything and moved.all():
+                np.subtract(img[..., 0], black, out=in_x[..., -1])
+                continue
+            rows = rows[moved]
+            if len(rows) == 0:
+                break
+            in_x[rows, ..., -1] = img[rows, ..., 0] - black[rows]
+        return img, black, black_count, Hs
+
+    def close(self):
+        self.sess.close()
+
+def make_black_mask(height=height, width=width):
+    # the black-border prior fed as an extra channel by models trained with it (--no_bm 0)
+    dh = int(height * 0.8 / 2)
+    dw = int(width * 0.8 / 2)
+    black_mask = np.zeros([dh, width], dtype=np.float64)
+    temp_mask = np.concatenate([np.zeros([height - 2 * dh, dw], dtype=np.float64), np.ones([height - 2 * dh, width - 2 * dw], dtype=np.float64), np.zeros([height - 2 * dh, dw], dtype=np.float64)], axis=1)
+    return np.reshape(np.concatenate([black_mask, temp_mask, black_mask], axis=0), [1, height, width, 1])
+
+class Stabilizer(object):
+    '''
+    Online stabilization of one stream with a shared Model. push(frame) takes the next BGR frame
+    of any size and returns its stabilized version, or None while the look-ahead of negative
+    indices (after_ch - 1 frames) fills up; the first frame is returned unwarped. Every push
+    runs the network at most once (`refine` times), so latency per frame is bounded by one step.
+
+    The steps of push() are public for drivers that batch or pipeline them (deploy_bundle.py):
+    feed() -> item, infer(item) (or make_input / Model.run / finish_step) -> result, render(result).
+    feed() converts the network input of every frame into a slot of a preallocated ring, sized for
+    the look-ahead and the frames waiting for a keyframe; a result only carries a copy of its
+    network input (result[4], for visualization) with keep_inputs.
+
+    With keyframe_stride > 1 or a keyframe_threshold the network only runs on keyframes: every
+    keyframe_stride-th frame, or, with a threshold, a frame whose mean absolute difference to
+    the last keyframe (train frames, 1/4 resolution) exceeds it, at the latest after
+    keyframe_stride frames (KEYFRAME_GAP when only a threshold is given). The mesh vertices of the frames in between are interpolated
+    linearly between the two keyframes, so they wait for the next keyframe (step() returns the
+    results that are ready, flush() the rest at the end). Their history entries are the frame
+    warped with the last keyframe's mesh.
+
+    The network runs at net_size (width, height), the config's by default; a graph exported with
+    export_graph.py --rebuild takes any size, older ones only the size they were built for.
+
+    With target_fps, a Deadline (deadline.py) measures the time between step() calls and, when
+    frames come slower than the target, first drops the refinement and then runs the network on
+    every deadline_stride-th frame only, extrapolating the mesh vertices of the last two network
+    frames in between (so results are never held back, unlike keyframes). It steps back up when
+    the load drops; deadline.summary() counts the degraded frames and the latency per frame.
+    '''
+    def __init__(self, model, indices=indices[1:], refine=1, output_size='net', no_bm=1,
+                 infer_with_stable=False, infer_with_last=False, max_span=1, keep_inputs=False,
+                 remap_threads=4, pool=None, keyframe_stride=None, keyframe_threshold=None, timers=None,
+                 refine_tol=None, refine_budget=None, target_fps=None, deadline_stride=4, net_size=None):
+        self.model = model
+        self.net_width, self.net_height = net_size if net_size is not None else (width, height)
+        if model.net_size is not None and model.net_size != (self.net_width, self.net_height):
+            raise ValueError('the graph takes {}x{} frames, export it with export_graph.py --rebuild to run at {}x{}'.format(
+                model.net_size[0], model.net_size[1], self.net_width, self.net_height))
+        self.indices = indices
+        self.refine = refine
+        # adaptive refinement (Model.run): stop when the vertices move less than refine_tol pixels,
+        # or before a run would exceed refine_budget seconds for the frame
+        self.refine_tol = refine_tol
+        self.refine_budget = refine_budget
+        # frames per number of network runs used
+        self.refine_counts = {}
+        self.output_size = output_size
+        self.black_mask = make_black_mask(self.net_height, self.net_width) if no_bm == 0 else None
+        self.infer_with_stable = infer_with_stable
+        self.infer_with_last = infer_with_last
+        self.max_span = max_span
+        self.keep_inputs = keep_inputs
+        self.remap_threads = remap_threads
+        self.pool = pool
+        # stages: convert, input, infer, update, interpolate, render
+        self.timers = timers if timers is not None else Timers(enabled=False)
+        self.before_ch = max(indices)
+        self.after_ch = max(1, -min(indices) + 1)
+        self.history = None
+        self.renderer = None
+        self.preprocess = None
+        self.after_temp = []
+        self.after_frames = []
+        self.after_stable = []
+        self.in_xs = []
+        self.all_black = np.zeros([self.net_height, self.net_width], dtype=np.int64)
+        self.tot_time = 0
+        self.length = 0
+        if keyframe_stride is None:
+            keyframe_stride = KEYFRAME_GAP if keyframe_threshold is not None else 1
+        if keyframe_threshold is not None and keyframe_stride <= 1:
+            raise ValueError('keyframe_threshold needs a keyframe_stride > 1, the longest gap between keyframes')
+        self.keyframe_stride = max(1, keyframe_stride)
+        self.keyframe_threshold = keyframe_threshold
+        # frames the network ran on
+        self.keyframes = 0
+        self.pending = []
+        self.ready = deque()
+        self.key_vertices = regular_vertices(grid_h, grid_w)
+        self.key_Hs = vertices_to_hs(self.key_vertices).astype(np.float32)
+        self.key_small = None
+        if target_fps is not None and self.keyframing():
+            raise ValueError('target_fps does not work with keyframes')
+        self.deadline = Deadline(target_fps, deadline_stride) if target_fps is not None else None
+        # mesh vertex motion per frame between the last two network frames, and frames since the last one
+        self.velocity = np.zeros_like(self.key_vertices)
+        self.since_key = 0
+
+    def start(self, frame):
+        # seeds the history with the first frame and returns it, resized to the output size
+        net_size = (self.net_width, self.net_height)
+        size = parse_size(self.output_size, net_size, (frame.shape[1], frame.shape[0]))
+        self.out_width, self.out_height = size
+        self.renderer = Renderer(self.out_width, self.out_height, bands=self.remap_threads, pool=self.pool,
+                                 net_size=net_size)
+        # one resize per frame for the network input and, at the network size, the renderer
+        self.preprocess = Preprocessor(net_size, size)
+        self.history = InputHistory(self.indices, self.net_height, self.net_width, input_mask, self.after_ch, self.black_mask)
+        self.history.seed(self.preprocess.train(frame, crop_rate=crop_rate))
+        self.key_small = self.small(self.preprocess.train(frame))
+        # network inputs of the look-ahead and of the frames waiting for the next keyframe
+        self.train_ring = np.empty([self.after_ch + self.keyframe_stride - 1, 1, self.net_height, self.net_width, 1],
+                                   dtype=np.float32)
+        self.train_head = 0
+        return cv2.resize(frame, size)
+
+    def feed(self, frame, stable_train_frame=None):
+        # queues a frame; returns (frame, after_frames, stable_train_frame) once its look-ahead is there
+        with self.timers.stage('convert'):
+            slot = self.train_ring[self.train_head]
+            self.train_head = (self.train_head + 1) % len(self.train_ring)
+            frame, train_frame = self.preprocess.prepare(frame, slot)
+        self.after_temp.append(frame)
+        self.after_frames.append(train_frame)
+        self.after_stable.append(stable_train_frame)
+        if (len(self.after_frames) < self.after_ch):
+            return None
+        item = (self.after_temp.pop(0), self.after_frames[:], self.after_stable.pop(0))
+        self.after_frames.pop(0)
+        return item
+
+    def make_input(self, after_frames, out=None):
+        self.history.set_after(after_frames)
+        in_x = self.history.make_input(out)
+        # for max span
+        if self.max_span != 1:
+            self.in_xs.append(in_x.copy())
+            if len(self.in_xs) > self.max_span:
+                self.in_xs = self.in_xs[-1:]
+                print('cut')
+            in_x = self.in_xs[0].copy()
+            in_x[0, ..., self.before_ch] = after_frames[0][..., 0]
+        return in_x
+
+    def update(self, img, black, stable_train_frame):
+        if self.infer_with_stable:
+            frame_slot, mask_slot = self.history.push(stable_train_frame)
+            mask_slot[...] = 0
+        else:
+            self.history.push_output(img, black)
+        if self.infer_with_last:
+            self.history.fill_frames(self.history.frame())
+
+    def finish_step(self, item, in_x, img, black, black_count, Hs, iterations=None):
+        # feeds one frame's net outputs (a single slice of a Model.run batch) back into the history
+        frame_unstable, after_frames, stable_train_frame = item
+        iterations = int(iterations) if iterations is not None else self.refine
+        self.refine_counts[iterations] = self.refine_counts.get(iterations, 0) + 1
+        with self.timers.stage('update'):
+            self.all_black += black_count
+            self.update(img, black, stable_train_frame)
+            # in_x is reused for the next frame, keep a copy of what a visualization needs
+            inputs = in_x[..., :1].copy() if self.keep_inputs else None
+        self.length += 1
+        self.keyframes += 1
+        return frame_unstable, Hs, img, inputs, self.kept(after_frames[0]), stable_train_frame
+
+    def infer(self, item, refine=None, budget=None):
+        # refine and budget override the configured ones for this frame
+        with self.timers.stage('input'):
+            in_x = self.make_input(item[1])
+        start = time.time()
+        iterations = np.zeros([1], dtype=np.int64)
+        refine = self.refine if refine is None else refine
+        budget = self.refine_budget if budget is None else budget
+        img, black, black_count, Hs = self.model.run(in_x, refine, self.refine_tol, budget, iterations)
+        elapsed = time.time() - start
+        self.tot_time += elapsed
+        self.timers.add('infer', elapsed, start)
+        return self.finish_step(item, in_x, img[0], black[0], black_count[0], Hs[0], iterations[0])
+
+    def refine_summary(self):
+        # mean network runs per inferred frame and {runs: frames}
+        frames = sum(self.refine_counts.values())
+        mean = sum(k * n for k, n in self.refine_counts.items()) / float(max(frames, 1))
+        return mean, dict(sorted(self.refine_counts.items()))
+
+    def keyframing(self):
+        return self.keyframe_stride > 1 or self.keyframe_threshold is not None
+
+    def small(self, train_frame):
+        return cv2.resize(train_frame.reshape(self.net_height, self.net_width).astype(np.float32),
+                          (self.net_width // 4, self.net_height // 4),
+                          interpolation=cv2.INTER_AREA)
+
+    def is_keyframe(self, item):
+        since = len(self.pending) + 1
+        if since >= self.keyframe_stride:
+            return True
+        if self.keyframe_threshold is None:
+            return False
+        return np.mean(np.abs(self.small(item[1][0]) - self.key_small)) > self.keyframe_threshold
+
+    def step(self, item):
+        # one frame in, the results whose mesh is known out (in order)
+        if self.deadline is not None:
+            return [self.deadline_step(item)]
+        if not self.keyframing():
+            return [self.infer(item)]
+        if not self.is_keyframe(item):
+            # history gets the frame warped with the last keyframe's mesh
+            with self.timers.stage('interpolate'):
+                img, black = warp_net_frame(item[1][0], self.key_Hs)
+                self.update(img, black, item[2])
+            self.length += 1
+            self.pending.append(item)
+            return []
+        result = self.infer(item)
+        vertices = hs_to_vertices(result[1])
+        results = []
+        n = len(self.pending) + 1
+        with self.timers.stage('interpolate'):
+            for k, pending in enumerate(self.pending):
+                t = (k + 1) / float(n)
+                results.append(self.interpolated(pending, (1 - t) * self.key_vertices + t * vertices))
+        results.append(result)
+        self.pending = []
+        self.key_vertices = vertices
+        self.key_Hs = result[1]
+        self.key_small = self.small(item[1][0])
+        return results
+
+    def deadline_step(self, item):
+        self.deadline.tick()
+        decision = self.deadline.plan()
+        if decision == 'extrapolate':
+            self.since_key += 1
+            frame_unstable, after_frames, stable_train_frame = item
+            with self.timers.stage('interpolate'):
+                # constant vertex motion, for at most one stride
+                vertices = self.key_vertices + min(self.since_key, self.deadline.stride) * self.velocity
+                Hs = vertices_to_hs(vertices).reshape(grid_h, grid_w, 9).astype(np.float32)
+                img, black = warp_net_frame(after_frames[0], Hs)
+                self.all_black += np.round(black).astype(np.int64)
+                self.update(img, black, stable_train_frame)
+            self.length += 1
+            self.deadline.record(decision)
+            return frame_unstable, Hs, img, None, self.kept(after_frames[0]), stable_train_frame
+        if decision == 'full':
+            budget = self.deadline.budget()
+            refine, budget = self.refine, budget if self.refine_budget is None else min(self.refine_budget, budget)
+        else:
+            refine, budget = 1, None
+        start = self.tot_time
+        result = self.infer(item, refine, budget)
+        self.deadline.record(decision, self.tot_time - start)
+        vertices = hs_to_vertices(result[1])
+        if self.keyframes > 1:
+            self.velocity = (vertices - self.key_vertices) / float(self.since_key + 1)
+        self.key_vertices = vertices
+        self.since_key = 0
+        return result
+
+    def interpolated(self, item, vertices):
+        frame_unstable, after_frames, stable_train_frame = item
+        Hs = vertices_to_hs(vertices).reshape(grid_h, grid_w, 9).astype(np.float32)
+        img, black = warp_net_frame(after_frames[0], Hs)
+        self.all_black += np.round(black).astype(np.int64)
+        return frame_unstable, Hs, img, None, self.kept(after_frames[0]), stable_train_frame
+
+    def kept(self, train_frame):
+        # the ring slot is reused once the frame leaves the stabilizer
+        return train_frame.copy() if self.keep_inputs else None
+
+    def flush(self):
+        # the frames still waiting for a keyframe, with the last keyframe's mesh
+        results = [self.interpolated(item, self.key_vertices) for item in self.pending]
+        self.pending = []
+        return results
+
+    def render(self, result):
+        # the unstable frame warped by the mesh, at the output size
+        with self.timers.stage('render'):
+            return self.renderer.render_hs(result[0], result[1])
+
+    def push(self, frame, stable_frame=None):
+        if self.history is None:
+            return self.start(frame)
+        stable_train_frame = self.preprocess.train(stable_frame, crop_rate=crop_rate) if stable_frame is not None else None
+        item = self.feed(frame, stable_train_frame)
+        if item is not None:
+            self.ready.extend(self.step(item))
+        if len(self.ready) == 0:
+            return None
+        return self.render(self.ready.popleft())
+
+    def stabilize(self, frames):
+        # generator over the stabilized frames of an iterable of frames
+        for frame in frames:
+            out = self.push(frame)
+            if out is not None:
+                yield out
+        self.ready.extend(self.flush())
+        while self.ready:
+            yield self.render(self.ready.popleft())
+
+    def crop_rect(self, search='grid'):
+        # largest black-free [top, left, bottom, right] of every frame so far, at the output size
+        if search == 'max':
+            ans = max_valid_rect(self.all_black)
+        else:
+            ans = max_crop_rect(self.all_black)
+        return scale_rect(ans, self.out_width / float(self.net_width), self.out_height / float(self.net_height))
+
+    def close(self):
+        if self.renderer is not None:
+            self.renderer.close()
@@ -127,3 +127,141 @@ def dense_to_one_hot(labels, n_classes=2):
     labels_one_hot = np.zeros((n_labels, n_classes), dtype=np.float32)
     labels_one_hot.flat[index_offset + labels.ravel()] = 1
     return labels_one_hot
+
+# %%
+def bilinear_sample(im, x, y, out_size):
+    '''Bilinear sampler of the spatial transformers' _interpolate.
+    Parameters
+    ----------
+    im : Tensor
+        [num_batch, height, width, channels] images.
+    x, y : Tensor
+        [num_batch * out_height * out_width] flat sampling positions in [-1, 1]
+        (scaled by width / 2, height / 2, corners clamped to the image).
+    out_size : tuple of two ints
+        (out_height, out_width)
+    Returns
+    -------
+    output : Tensor
+        [num_batch * out_height * out_width, channels] samples, one gather per corner.
+    '''
+    num_batch = tf.shape(im)[0]
+    height = tf.shape(im)[1]
+    width = tf.shape(im)[2]
+    channels = tf.shape(im)[3]
+
+    x = tf.cast(x, 'float32')
+    y = tf.cast(y, 'float32')
+    height_f = tf.cast(height, 'float32')
+    width_f = tf.cast(width, 'float32')
+    zero = tf.zeros([], dtype='int32')
+    max_y = tf.cast(tf.shape(im)[1] - 1, 'int32')
+    max_x = tf.cast(tf.shape(im)[2] - 1, 'int32')
+
+    # scale indices from [-1, 1] to [0, width/height]
+    x = (x + 1.0)*(width_f) / 2.0
+    y = (y + 1.0)*(height_f) / 2.0
+
+    x0 = tf.cast(tf.floor(x), 'int32')
+    x1 = x0 + 1
+    y0 = tf.cast(tf.floor(y), 'int32')
+    y1 = y0 + 1
+
+    x0 = tf.clip_by_value(x0, zero, max_x)
+    x1 = tf.clip_by_value(x1, zero, max_x)
+    y0 = tf.clip_by_value(y0, zero, max_y)
+    y1 = tf.clip_by_value(y1, zero, max_y)
+    dim2 = width
+    dim1 = width*height
+    base = tf.reshape(tf.tile(tf.expand_dims(tf.range(num_batch)*dim1, 1), [1, out_size[0]*out_size[1]]), [-1])
+    base_y0 = base + y0*dim2
+    base_y1 = base + y1*dim2
+    idx_a = base_y0 + x0
+    idx_b = base_y1 + x0
+    idx_c = base_y0 + x1
+    idx_d = base_y1 + x1
+
+    im_flat = tf.reshape(im, tf.stack([-1, channels]))
+    im_flat = tf.cast(im_flat, 'float32')
+    Ia = tf.gather(im_flat, idx_a)
+    Ib = tf.gather(im_flat, idx_b)
+    Ic = tf.gather(im_flat, idx_c)
+    Id = tf.gather(im_flat, idx_d)
+
+    x0_f = tf.cast(x0, 'float32')
+    x1_f = tf.cast(x1, 'float32')
+    y0_f = tf.cast(y0, 'float32')
+    y1_f = tf.cast(y1, 'float32')
+    wa = tf.expand_dims(((x1_f-x) * (y1_f-y)), 1)
+    wb = tf.expand_dims(((x1_f-x) * (y-y0_f)), 1)
+    wc = tf.expand_dims(((x-x0_f) * (y1_f-y)), 1)
+    wd = tf.expand_dims(((x-x0_f) * (y-y0_f)), 1)
+    return tf.add_n([wa*Ia, wb*Ib, wc*Ic, wd*Id])
+
+def bilinear_sample_np(im, x, y):
+    # NumPy bilinear_sample, the reference of test()
+    b, h, w, c = im.shape
+    x = (x.reshape(b, -1) + 1.) * w / 2.
+    y = (y.reshape(b, -1) + 1.) * h / 2.
+    x0, y0 = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+    x1, y1 = np.clip(x0 + 1, 0, w - 1), np.clip(y0 + 1, 0, h - 1)
+    x0, y0 = np.clip(x0, 0, w - 1), np.clip(y0, 0, h - 1)
+    n = np.arange(b)[:, None]
+    out = (((x1 - x) * (y1 - y))[..., None] * im[n, y0, x0] + ((x1 - x) * (y - y0))[..., None] * im[n, y1, x0] +
+           ((x - x0) * (y1 - y))[..., None] * im[n, y0, x1] + ((x - x0) * (y - y0))[..., None] * im[n, y1, x1])
+    return out.reshape(-1, c)
+
+def test():
+    # bilinear_sample against NumPy, and its gradients against numeric ones, with several channels and
+    # with one (as in training)
+    rng = np.random.RandomState(0)
+    for b, h, w, c in [(2, 5, 7, 3), (2, 5, 7, 1)]:
+        im_value = rng.rand(b, h, w, c).astype(np.float32)
+        # off the pixel lattice, so that the numeric gradient does not cross a corner; some outside the image
+        x_value = (rng.randint(-2, w + 1, b * h * w) + rng.uniform(0.2, 0.8, b * h * w)) * 2. / w - 1
+        y_value = (rng.randint(-2, h + 1, b * h * w) + rng.uniform(0.2, 0.8, b * h * w)) * 2. / h - 1
+        graph = tf.Graph()
+        with graph.as_default():
+            im = tf.constant(im_value)
+            x = tf.constant(x_value.astype(np.float32))
+            y = tf.constant(y_value.astype(np.float32))
+            out = bilinear_sample(im, x, y, (h, w))
+            with tf.Session(graph=graph) as sess:
+                out_value = sess.run(out)
+                assert(np.abs(out_value - bilinear_sample_np(im_value, x_value, y_value)).max() < 1e-5)
+                for t, value in [(im, im_value), (x, x_value), (y, y_value)]:
+                    error = tf.test.compute_gradient_error(t, list(value.shape), out, [b * h * w, c],
+                                                           x_init_value=value.astype(np.float32), delta=1e-3)
+                    assert(error < 1e-2), error
+    print('bilinear_sample: ok')
+
+def benchmark(batch=8, height=288, width=512, channels=1, runs=20):
+    # forward and forward + backward time of the sampler at the training input size
+    import time
+    rng = np.random.RandomState(0)
+    im_value = rng.rand(batch, height, width, channels).astype(np.float32)
+    x_t, y_t = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    x_value = np.tile((x_t * 0.95 + 0.01).reshape(-1), batch).astype(np.float32)
+    y_value = np.tile((y_t * 0.95 - 0.01).reshape(-1), batch).astype(np.float32)
+    graph = tf.Graph()
+    with graph.as_default():
+        im = tf.Variable(im_value)
+        x = tf.Variable(x_value)
+        y = tf.Variable(y_value)
+        out = bilinear_sample(im, x, y, (height, width))
+        grads = tf.gradients(tf.reduce_sum(out), [im, x, y])
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            times = []
+            for fetches in [out, grads]:
+                sess.run(fetches)
+                start = time.time()
+                for k in range(runs):
+                    sess.run(fetches)
+                times.append((time.time() - start) / runs * 1000)
+    print('bilinear_sample: forward {:.2f}ms, forward + backward {:.2f}ms ({}x{}x{}x{})'.format(
+        times[0], times[1], batch, height, width, channels))
+
+if __name__ == '__main__':
+    test()
+    benchmark()
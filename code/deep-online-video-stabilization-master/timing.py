@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+import utils
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullStage()
+
+class _Stage(object):
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.add(self.name, time.time() - self.start, self.start)
+        return False
+
+class Timers(object):
+    '''
+    Named stage timers: `with timers.stage('infer'): ...` records one sample per call (from any
+    thread). report() gives count / total / mean / p50 / p95 / p99 / max in ms per stage, fps and
+    the process peak RSS; with trace=True every sample is also kept as a Chrome trace event
+    (chrome://tracing, Perfetto). A disabled Timers hands out one shared no-op context.
+    '''
+    def __init__(self, enabled=True, trace=False):
+        self.enabled = enabled
+        self.trace = trace and enabled
+        self.samples = {}
+        self.events = []
+        self.order = []
+        self.created = time.time()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def add(self, name, seconds, start=None):
+        if not self.enabled:
+            return
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, [])
+            self.order.append(name)
+        samples.append(seconds)
+        if self.trace:
+            if start is None:
+                start = time.time() - seconds
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.current_thread().name,
+                                'ts': (start - self.created) * 1e6, 'dur': seconds * 1e6})
+
+    def report(self, frames=None, wall=None):
+        stages = []
+        for name in sorted(set(self.order), key=self.order.index):
+            ms = np.array(self.samples[name]) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            stages.append({'stage': name, 'count': len(ms), 'total_ms': float(ms.sum()), 'mean_ms': float(ms.mean()),
+                           'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max())})
+        if wall is None:
+            wall = time.time() - self.created
+        report = {'stages': stages, 'wall_s': wall, 'process_peak_rss_mb': utils.peak_rss_mb()}
+        if frames is not None:
+            report['frames'] = frames
+            report['fps'] = frames / max(wall, 1e-8)
+        return report
+
+    def write(self, path_prefix, frames=None, wall=None, extra=None):
+        # <prefix>.timing.json, <prefix>.timing.csv and, when tracing, <prefix>.trace.json
+        report = self.report(frames, wall)
+        if extra:
+            report.update(extra)
+        with open(path_prefix + '.timing.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        keys = ['stage', 'count', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+        with open(path_prefix + '.timing.csv', 'w') as f:
+            f.write(','.join(keys) + '\n')
+            for stage in report['stages']:
+                f.write(','.join([str(stage[k]) if k == 'stage' or k == 'count' else '{:.3f}'.format(stage[k]) for k in keys]) + '\n')
+        if self.trace:
+            with open(path_prefix + '.trace.json', 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+        return report
+
+def format_report(report):
+    lines = ['{:12s} {:>6s} {:>10s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('stage', 'count', 'total ms', 'p50', 'p95', 'p99', 'max')]
+    for s in report['stages']:
+        lines.append('{:12s} {:6d} {:10.1f} {:8.2f} {:8.2f} {:8.2f} {:8.2f}'.format(
+            s['stage'], s['count'], s['total_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+    if 'fps' in report:
+        line = '{} frames, fps={:.2f}'.format(report['frames'], report['fps'])
+        if 'peak_rss_mb' in report:
+            # the caller's peak (deploy_bundle.py: of the video), not the process's
+            line += ', peak rss={:.1f}MB'.format(report['peak_rss_mb'])
+        lines.append(line + ', process peak rss={:.1f}MB'.format(report['process_peak_rss_mb']))
+    return '\n'.join(lines)
+
+def benchmark(n=100000):
+    # cost of a disabled and of an enabled stage around an empty block
+    for timers in [Timers(enabled=False), Timers(), Timers(trace=True)]:
+        start = time.time()
+        for i in range(n):
+            with timers.stage('x'):
+                pass
+        print('enabled={}, trace={}: {:.2f}us/stage'.format(timers.enabled, timers.trace, (time.time() - start) * 1e6 / n))
+
+if __name__ == '__main__':
+    benchmark()
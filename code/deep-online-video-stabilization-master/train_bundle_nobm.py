@@ -34,7 +34,10 @@ slim = tf.contrib.slim
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu_memory_fraction', type=float, default=0.95)
 parser.add_argument('--restore', action='store_true')
+# training resolution WxH, the config's width x height by default; the net itself takes any size
+parser.add_argument('--size', default=None)
 args = parser.parse_args()
+train_width, train_height = map(int, args.size.lower().split('x')) if args.size is not None else (width, height)
 cnt = 0
 
 
@@ -60,10 +63,10 @@ def save_warpped_features(input_data, stable_warpped_pts_batch, theta_mat, outpu
         # ret * scale_mat * x = scale_mat * x'
         # ret = scale_mat * theta_mat * scale_mat^-1
         scale_mat = np.eye(3)
-        scale_mat[0, 0] = width / 2.
-        scale_mat[0, 2] = width / 2.
-        scale_mat[1, 1] = height / 2.
-        scale_mat[1, 2] = height / 2.
+        scale_mat[0, 0] = train_width / 2.
+        scale_mat[0, 2] = train_width / 2.
+        scale_mat[1, 1] = train_height / 2.
+        scale_mat[1, 2] = train_height / 2.
         assert(theta_mat.shape == (3, 3))
         from numpy.linalg import inv
         return np.matmul(np.matmul(scale_mat, theta_mat), inv(scale_mat))
@@ -106,8 +109,10 @@ def name_in_checkpoint(var):
 def rand_crop():
     return random.random() * (1 - max_crop_rate) + max_crop_rate
 
-ret1 = s_net.inference_stable_net(False) ## reuse = False 不重复利用tf.get_variable 中变量
-ret2 = s_net.inference_stable_net(True)  ## reuse = True  重复利用tf.get_variable 中变量
+graph_start = time.time()
+# both frame sets through one training-mode ResNet (a batch of 2 * batch_size); no inference branch,
+# export_graph.py and deploy build it from the checkpoint
+ret1, ret2 = s_net.training_stable_net()
 
 ####==================
 #在 tf.name_scope下时，tf.get_variable()创建的变量名不受 name_scope 的影响，
@@ -116,14 +121,14 @@ ret2 = s_net.inference_stable_net(True)  ## reuse = True  重复利用tf.get_var
 
 
 with tf.name_scope('data_flow'):  
-    flow = tf.placeholder(tf.float32, [None, height, width, 2])
+    flow = tf.placeholder(tf.float32, [None, train_height, train_width, 2])
     x_flow = tf.slice(flow, [0, 0, 0, 0], [-1, -1, -1, 1])
     y_flow = tf.slice(flow, [0, 0, 0, 1], [-1, -1, -1, 1])
 
 with tf.name_scope('temp_loss'):
     use_temp_loss = tf.placeholder(tf.float32)
-    output2_aft_flow = interpolate(ret2['output'], x_flow, y_flow, (height, width))
-    noblack_pix2_aft_flow = interpolate(1 - ret2['black_pix'], x_flow, y_flow, (height, width))
+    output2_aft_flow = interpolate(ret2['output'], x_flow, y_flow, (train_height, train_width))
+    noblack_pix2_aft_flow = interpolate(1 - ret2['black_pix'], x_flow, y_flow, (train_height, train_width))
     #output2_aft_flow = ret2['output']#28
     temp_err = ret1['output'] - output2_aft_flow
     noblack = (1 - ret1['black_pix']) * noblack_pix2_aft_flow
@@ -139,7 +144,7 @@ with tf.name_scope('errors'):
     show_image('error_2', ret2['error'])
 
 with tf.name_scope('test_flow'):
-    warped_y2 = interpolate(ret2['y'], x_flow, y_flow, (height, width))
+    warped_y2 = interpolate(ret2['y'], x_flow, y_flow, (train_height, train_width))
     show_image('error_black_wy2', tf.abs(ret1['y'] - warped_y2))
     show_image('error_black_nowarp', tf.abs(ret2['y'] - ret1['y']))
 
@@ -166,15 +171,17 @@ learning_rate = tf.train.exponential_decay(initial_learning_rate,
                                            decay_steps=step_size,decay_rate=0.1, staircase=True)
 opt = tf.train.AdamOptimizer(learning_rate)
 optimizer = opt.minimize(total_loss, global_step=global_step)
+print('graph: ' + str(len(tf.get_default_graph().get_operations())) + ' ops, built in ' + str(time.time() - graph_start) + 's')
 
 
 with tf.name_scope('datas'):
     data_x1, data_y1, data_x2, data_y2, data_flow, \
         data_feature_matches1, data_mask1, data_feature_matches2, data_mask2 = get_data_flow.read_and_decode(
-            data_dir + "train/", int(training_iter * batch_size / train_data_size) + 2)
+            data_dir + "train/", int(training_iter * batch_size / train_data_size) + 2, height=train_height, width=train_width)
     test_x1, test_y1, test_x2, test_y2, test_flow, \
         test_feature_matches1, test_mask1, test_feature_matches2, test_mask2 = get_data_flow.read_and_decode(
-            data_dir + "test/", int(training_iter * batch_size * test_batches / test_data_size / test_freq) + 2)
+            data_dir + "test/", int(training_iter * batch_size * test_batches / test_data_size / test_freq) + 2,
+            height=train_height, width=train_width)
 
     x1_batch, y1_batch, x2_batch, y2_batch, flow_batch,\
         feature_matches1_batch, mask1_batch, feature_matches2_batch, mask2_batch = tf.train.shuffle_batch(
@@ -246,6 +253,8 @@ with sv.managed_session(config=tf.ConfigProto(allow_soft_placement=True,gpu_opti
             print('==========================')
             print('read data time:' + str(tot_time / disp_freq) + 's')
             print('train time:' + str(tot_train_time / disp_freq) + 's')
+            if tot_train_time > 0:
+                print('examples/sec:' + str(2 * batch_size * disp_freq / tot_train_time))
             tot_train_time = 0
             tot_time = 0
             time_start = time.time()
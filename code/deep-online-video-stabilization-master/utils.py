@@ -1,4 +1,8 @@
 import logging
+import os
+import sys
+import resource
+import threading
 
 logger = None
 def get_logger(name=None):
@@ -15,3 +19,44 @@ def get_logger(name=None):
     sh.setFormatter(formatter)
     logger.addHandler(sh)
     return logger
+
+def peak_rss_mb():
+    """peak resident set size of this process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+def rss_mb():
+    """current resident set size of this process, in MB (0 if /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return 0.
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024. / 1024.
+
+class RssMonitor(object):
+    """samples rss_mb() every interval seconds on a daemon thread; peak is the largest sample since it was created,
+    e.g. the peak of one video in a multi-video run (peak_rss_mb() is the peak of the whole process)
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='rss')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_mb())
+        return self.peak